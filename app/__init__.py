@@ -2,9 +2,10 @@ from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from config import Config
+from app.depots import DepotSession
 import os
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': DepotSession})
 login_manager = LoginManager()
 login_manager.login_view = 'auth.login'
 login_manager.login_message = 'Ulgama girmeli'
@@ -16,7 +17,10 @@ def create_app():
                 static_folder=os.path.join(base_dir, 'static'))
     app.config.from_object(Config)
     
+    from app.depots import configure_depots, init_depots
+    configure_depots(app)
     db.init_app(app)
+    init_depots(app)
     login_manager.init_app(app)
     
     from app.routes.auth import auth_bp
@@ -24,11 +28,42 @@ def create_app():
     from app.routes.orders import orders_bp
     from app.routes.admin import admin_bp
     from app.routes.main import main_bp
+    from app.routes.reports import reports_bp
+    from app.routes.api import api_bp
     
     app.register_blueprint(main_bp)
     app.register_blueprint(auth_bp, url_prefix='/auth')
     app.register_blueprint(subscribers_bp, url_prefix='/subscribers')
     app.register_blueprint(orders_bp, url_prefix='/orders')
     app.register_blueprint(admin_bp, url_prefix='/admin')
+    app.register_blueprint(reports_bp, url_prefix='/reports')
+    app.register_blueprint(api_bp, url_prefix='/api/v1')
+    
+    from app.cli import register_commands
+    register_commands(app)
+    
+    from app.http_cache import init_http_cache
+    init_http_cache(app)
+    
+    from app.fragment_cache import init_fragment_cache
+    init_fragment_cache(app)
+    
+    from app.warmup import init_template_cache
+    init_template_cache(app)
+    
+    from app.profiler import init_profiler
+    init_profiler(app)
+    
+    from app.metrics import init_metrics
+    init_metrics(app, db)
+    
+    from app.live import init_live
+    init_live(app)
+    
+    from app.outbox import init_outbox
+    init_outbox(app)
+    
+    from app.scheduler import init_scheduler
+    init_scheduler(app)
     
     return app
@@ -0,0 +1,215 @@
+import csv
+import json
+import os
+import sys
+import click
+from flask import current_app
+from app import db
+from app.depots import depot_names, default_depot, use_depot
+from app.models import JobRun, ScheduledJob, User
+from app.outbox import outbox_dir, outbox_streams, read_outbox
+from app.services.backup import BackupError, backup_databases, list_backups, restore_backup, verify_backup
+from app.services.maintenance import backup_dir, invoice_dir
+from app.services.invoices import generate_monthly_invoices, previous_month
+from app.services import log_action
+from app.services.importer import read_rows, import_subscribers, ImportFileError
+from app.services.promo import iter_promo_eligibility, promo_summary
+from app.warmup import template_cache_dir, warm_up
+
+def register_commands(app):
+    @app.cli.command('promo-eligibility')
+    @click.option('--client-type', type=click.Choice(['legal', 'individual']), default=None)
+    @click.option('--status', type=click.Choice(['eligible', 'exhausted']), default=None)
+    @click.option('--summary-only', is_flag=True, help='Print only the totals')
+    def promo_eligibility(client_type, status, summary_only):
+        """Recompute promo eligibility for all subscribers (CSV to stdout)"""
+        summary = promo_summary(client_type)
+        click.echo('active={active} price={price} limit={limit} subscribers={subscribers} '
+                   'eligible={eligible} exhausted={exhausted} remaining_orders={remaining_orders}'.format(**summary),
+                   err=True)
+        if summary_only:
+            return
+
+        columns = ['id', 'client_type', 'address', 'order_count', 'promo_limit', 'remaining', 'eligible']
+        writer = csv.writer(sys.stdout)
+        writer.writerow(columns)
+        for row in iter_promo_eligibility(client_type, status):
+            writer.writerow([row[c] for c in columns])
+
+    @app.cli.command('import-subscribers')
+    @click.argument('path', type=click.Path(exists=True, dir_okay=False))
+    @click.option('--user', 'username', required=True, help='Recorded in the audit log')
+    @click.option('--depot', default=None, help='Depot to import into (default: the first one)')
+    @click.option('--client-type', type=click.Choice(['legal', 'individual']), default='individual',
+                  show_default=True, help='For rows without a type column')
+    @click.option('--allow-collisions', is_flag=True, help='Import rows whose phone already exists')
+    @click.option('--dry-run', is_flag=True, help='Check the file without saving anything')
+    def import_subscribers_command(path, username, depot, client_type, allow_collisions, dry_run):
+        """Bulk import subscribers from a CSV or XLSX file"""
+        user = User.query.filter_by(username=username).first()
+        if user is None:
+            raise click.BadParameter(f'no user {username}', param_hint='--user')
+        depot = depot or default_depot()
+        if depot not in depot_names():
+            raise click.BadParameter(f"choose from {', '.join(depot_names())}", param_hint='--depot')
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        with use_depot(depot):
+            try:
+                report = import_subscribers(read_rows(data, path), client_type, allow_collisions, dry_run)
+            except ImportFileError as e:
+                db.session.rollback()
+                raise click.ClickException(str(e))
+            for line, problem in report['invalid']:
+                click.echo(f'line {line}: {problem}', err=True)
+            for line, phone, owner in report['collisions']:
+                owner = f'subscriber #{owner}' if isinstance(owner, int) else owner.replace('setir', 'line')
+                click.echo(f'line {line}: {phone} already belongs to {owner}', err=True)
+            if dry_run:
+                db.session.rollback()
+            else:
+                log_action('IMPORT', 'subscriber', None, {
+                    'file': path, 'rows': report['rows'], 'imported': report['imported'],
+                    'phones': report['phones'], 'invalid': len(report['invalid']),
+                    'collisions': len(report['collisions']),
+                }, user=user)
+        click.echo('{}rows={rows} imported={imported} phones={phones} invalid={} collisions={}'.format(
+            'dry run: ' if dry_run else '', len(report['invalid']), len(report['collisions']), **report))
+
+    jobs = click.Group('jobs', help='Scheduled maintenance jobs')
+    app.cli.add_command(jobs)
+
+    @jobs.command('list')
+    def jobs_list():
+        """Show registered jobs and their next run"""
+        scheduler = current_app.extensions['scheduler']
+        state = {row.name: row for row in ScheduledJob.query.all()}
+        for job in scheduler.jobs.values():
+            row = state.get(job.name)
+            click.echo('{:20} {:16} next={} last={} {}  {}'.format(
+                job.name, str(job.trigger),
+                row.next_run_at.strftime('%Y-%m-%d %H:%M') if row and row.next_run_at else '-',
+                row.last_run_at.strftime('%Y-%m-%d %H:%M') if row and row.last_run_at else '-',
+                row.last_status or '' if row else '', job.description))
+
+    @jobs.command('run')
+    @click.argument('name')
+    def jobs_run(name):
+        """Run a job now (skipped if another process is running it)"""
+        scheduler = current_app.extensions['scheduler']
+        if name not in scheduler.jobs:
+            raise click.BadParameter(f"choose from {', '.join(scheduler.jobs)}", param_hint='NAME')
+        run = scheduler.run_job(name)
+        if run is None:
+            click.echo(f'{name} is running in another process', err=True)
+            sys.exit(1)
+        click.echo(f'{name}: {run.status} in {run.duration_ms}ms')
+        if run.message:
+            click.echo(run.message)
+        if run.status != 'ok':
+            sys.exit(1)
+
+    @jobs.command('history')
+    @click.option('--name', default=None)
+    @click.option('--limit', default=20, show_default=True)
+    def jobs_history(name, limit):
+        """Show recent job runs with durations"""
+        query = JobRun.query.order_by(JobRun.started_at.desc())
+        if name:
+            query = query.filter(JobRun.name == name)
+        for run in query.limit(limit):
+            message = (run.message or '').strip().splitlines()
+            click.echo('{} {:20} {:8} {:5} {:>8}ms  {}'.format(
+                run.started_at.strftime('%Y-%m-%d %H:%M:%S'), run.name, run.trigger, run.status,
+                run.duration_ms, message[-1] if message else ''))
+
+    @jobs.command('worker')
+    def jobs_worker():
+        """Run the scheduler in the foreground (instead of SCHEDULER_ENABLED in web workers)"""
+        scheduler = current_app.extensions['scheduler']
+        try:
+            scheduler.run_forever()
+        except KeyboardInterrupt:
+            scheduler.stop()
+
+    outbox = click.Group('outbox', help='Change stream of orders, payments, subscribers and prices')
+    app.cli.add_command(outbox)
+
+    @outbox.command('read')
+    @click.option('--after', 'after_offset', default=0, show_default=True, help='Last offset already read')
+    @click.option('--stream', default=None, help='Stream (database) name when there are several')
+    def outbox_read(after_offset, stream):
+        """Print the relayed events after an offset as JSONL"""
+        streams = {os.path.basename(path): path for path, _ in outbox_streams(outbox_dir(current_app))}
+        if len(streams) == 1:
+            path = next(iter(streams.values()))
+        elif stream in streams:
+            path = streams[stream]
+        else:
+            raise click.BadParameter(f"choose from {', '.join(streams)}", param_hint='--stream')
+        for item in read_outbox(path, after_offset):
+            click.echo(json.dumps(item, ensure_ascii=False, separators=(',', ':')))
+
+    backup = click.Group('backup', help='Online database backups')
+    app.cli.add_command(backup)
+
+    @backup.command('create')
+    def backup_create():
+        """Snapshot every database now, while the app keeps running"""
+        try:
+            click.echo(backup_databases(backup_dir(current_app), current_app.config['BACKUP_KEEP'],
+                                        current_app.config['BACKUP_STEP_PAGES'], current_app.config['BACKUP_STEP_PAUSE']))
+        except BackupError as e:
+            raise click.ClickException(str(e))
+
+    @backup.command('list')
+    def backup_list():
+        """Show the snapshots and whether their checksums match"""
+        for path, name in list_backups(backup_dir(current_app)):
+            try:
+                verify_backup(path)
+                status = 'ok'
+            except BackupError as e:
+                status = str(e)
+            click.echo('{:12} {:40} {:>8.1f} MB  {}'.format(
+                name, os.path.basename(path), os.path.getsize(path) / 1024 / 1024, status))
+
+    @backup.command('restore')
+    @click.argument('path', type=click.Path(exists=True, dir_okay=False))
+    @click.option('--yes', is_flag=True, help='Do not ask for confirmation')
+    def backup_restore(path, yes):
+        """Replace a database with a verified snapshot (stop the app and the scheduler first)"""
+        if not yes:
+            click.confirm(f'Overwrite the database {os.path.basename(path)} was taken from?', abort=True)
+        try:
+            click.echo(restore_backup(path, backup_dir(current_app)))
+        except BackupError as e:
+            raise click.ClickException(str(e))
+
+    invoices = click.Group('invoices', help='Monthly invoices of legal clients')
+    app.cli.add_command(invoices)
+
+    @invoices.command('generate')
+    @click.option('--month', default=None, help='YYYY-MM (default: last month)')
+    @click.option('--workers', type=int, default=None, help='Rendering processes (default: INVOICE_WORKERS or one per CPU)')
+    @click.option('--output', default=None, help='Directory (default: INVOICE_DIR or instance/invoices)')
+    def invoices_generate(month, workers, output):
+        """Render every legal client's invoice for a month, with an index"""
+        try:
+            year, month = map(int, month.split('-')) if month else previous_month()
+            if not 1 <= month <= 12:
+                raise ValueError
+        except ValueError:
+            raise click.BadParameter('use YYYY-MM', param_hint='--month')
+        click.echo(generate_monthly_invoices(output or invoice_dir(current_app), year, month,
+                                             workers=workers or current_app.config['INVOICE_WORKERS']))
+
+    @app.cli.command('warm-up')
+    def warm_up_command():
+        """Compile every template into the bytecode cache (run once per deploy, before the workers start)"""
+        if not current_app.config['JINJA_BYTECODE_CACHE']:
+            raise click.ClickException('JINJA_BYTECODE_CACHE is off, there is nothing to fill')
+        timings = warm_up(current_app._get_current_object(), connections=1)
+        click.echo(f"Templates compiled into {template_cache_dir(current_app)} in {timings['templates']:.0f}ms, "
+                   f"warm-up {timings['total']:.0f}ms")
@@ -0,0 +1,184 @@
+"""
+Depots: every depot keeps its subscribers, phones, orders, payments,
+action logs and live events in its own database, while users, prices,
+settings and scheduler state stay in the main one.
+
+DEPOT_DATABASES lists the depots, e.g. "main,north=sqlite:///north.db".
+A depot without a URL uses the main database, so an existing install
+simply becomes the "main" depot. Depot databases are Flask-SQLAlchemy
+binds. DepotSession.get_bind sends statements on depot tables to the
+depot of the current request (the user's depot; admins can switch), or
+of the innermost use_depot() block outside of requests.
+"""
+import contextvars
+import os
+import heapq
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import sqlalchemy as sa
+from sqlalchemy.sql import util as sql_util
+from flask import current_app, g, has_request_context, session, request, redirect, url_for, abort
+from flask_login import current_user, login_required
+from flask_sqlalchemy.session import Session
+
+DEPOT_TABLES = {'subscribers', 'phones', 'orders', 'payments', 'action_logs', 'live_events', 'duplicate_candidates',
+                'refill_forecasts'}
+
+_depot_override = contextvars.ContextVar('depot', default=None)
+
+def parse_depots(value):
+    """'main,north=sqlite:///north.db' -> {'main': None, 'north': 'sqlite:///north.db'}"""
+    if isinstance(value, dict):
+        return dict(value) or {'main': None}
+    depots = {}
+    for entry in (value or '').split(','):
+        name, _, url = entry.strip().partition('=')
+        if name.strip():
+            depots[name.strip()] = url.strip() or None
+    return depots or {'main': None}
+
+def _bind_key(name):
+    return f'depot:{name}'
+
+def configure_depots(app):
+    """Register the depot databases as binds, must run before db.init_app"""
+    depots = parse_depots(app.config.get('DEPOT_DATABASES'))
+    app.config['DEPOTS'] = depots
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    for name, url in depots.items():
+        if url and url != app.config['SQLALCHEMY_DATABASE_URI']:
+            binds[_bind_key(name)] = url
+    app.config['SQLALCHEMY_BINDS'] = binds
+
+def depot_names():
+    return list(current_app.config['DEPOTS'])
+
+def default_depot():
+    return depot_names()[0]
+
+def depot_engine(name):
+    engines = current_app.extensions['sqlalchemy'].engines
+    return engines.get(_bind_key(name), engines[None])
+
+def all_engines():
+    """Distinct engines, the main database first"""
+    engines = [current_app.extensions['sqlalchemy'].engines[None]]
+    for name in depot_names():
+        engine = depot_engine(name)
+        if engine not in engines:
+            engines.append(engine)
+    return engines
+
+def database_name(engine):
+    """Short name of an engine's database (the file name without extension for SQLite)"""
+    return os.path.splitext(os.path.basename(engine.url.database or ''))[0] or engine.url.database
+
+def engine_for_table(name):
+    return depot_engine(current_depot()) if name in DEPOT_TABLES else current_app.extensions['sqlalchemy'].engines[None]
+
+def current_depot():
+    name = _depot_override.get()
+    if name is not None:
+        return name
+    if has_request_context():
+        name = g.get('depot')
+        if name is not None:
+            return name
+    return default_depot()
+
+@contextmanager
+def use_depot(name):
+    token = _depot_override.set(name)
+    try:
+        yield
+    finally:
+        _depot_override.reset(token)
+
+def _request_depot():
+    names = depot_names()
+    if len(names) == 1 or not current_user.is_authenticated:
+        return names[0]
+    if current_user.role == 'admin' and session.get('depot') in names:
+        return session['depot']
+    return current_user.depot if current_user.depot in names else names[0]
+
+def _touches_depot_tables(mapper, clause):
+    if mapper is not None:
+        return sa.inspect(mapper).local_table.name in DEPOT_TABLES
+    if clause is not None:
+        tables = sql_util.find_tables(clause, include_aliases=True, include_joins=True, include_crud=True)
+        return any(getattr(table, 'name', None) in DEPOT_TABLES for table in tables)
+    return False
+
+class DepotSession(Session):
+    """Sends statements on depot tables to the current depot's database"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and len(self._db.engines) > 1 and _touches_depot_tables(mapper, clause):
+            return depot_engine(current_depot())
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+def for_each_depot(func, *args, **kwargs):
+    """Run func once per depot in this thread, returns the results joined as text"""
+    names = depot_names()
+    if len(names) == 1:
+        return func(*args, **kwargs)
+    results = []
+    for name in names:
+        with use_depot(name):
+            results.append(f'{name}: {func(*args, **kwargs)}')
+    return '; '.join(results)
+
+def fan_out(func, *args, names=None, **kwargs):
+    """Run func in every depot in parallel (own app context each), returns {depot: result}"""
+    app = current_app._get_current_object()
+    names = names or depot_names()
+
+    def run(name):
+        with app.app_context(), use_depot(name):
+            return func(*args, **kwargs)
+
+    with ThreadPoolExecutor(max_workers=min(len(names), 8)) as pool:
+        return dict(zip(names, pool.map(run, names)))
+
+def _tagged(name, first, rows):
+    first['depot'] = name
+    yield first
+    for row in rows:
+        row['depot'] = name
+        yield row
+
+def iter_all_depots(func, *args, names=None, key=None, **kwargs):
+    """
+    Rows (dicts) yielded by func in every depot, with a 'depot' key added.
+    With key the per-depot streams (each sorted by key) are merged in order,
+    otherwise they are concatenated.
+    """
+    streams = []
+    for name in names or depot_names():
+        rows = func(*args, **kwargs)
+        with use_depot(name):
+            # The query runs on the first row, so it is bound to this depot
+            first = next(rows, None)
+        if first is not None:
+            streams.append(_tagged(name, first, rows))
+    return heapq.merge(*streams, key=key) if key else itertools.chain(*streams)
+
+def init_depots(app):
+    @app.before_request
+    def set_request_depot():
+        if request.endpoint != 'static' and len(app.config['DEPOTS']) > 1:
+            g.depot = _request_depot()
+
+    @app.context_processor
+    def depot_context():
+        return {'depots': depot_names(), 'current_depot': current_depot()}
+
+    @app.route('/depot', methods=['POST'])
+    @login_required
+    def switch_depot():
+        if current_user.role != 'admin' or request.form.get('depot') not in depot_names():
+            abort(403)
+        session['depot'] = request.form['depot']
+        return redirect(url_for('main.index'))
@@ -0,0 +1,62 @@
+"""
+In-memory LRU cache for rendered template fragments.
+
+Templates wrap per-row markup in a macro and call it through the
+`fragment` global with a stamp of everything the row displays:
+
+    {{ fragment('subscriber', s.id, (s.address, s.debt, ...), subscriber_row, s) }}
+
+The macro only runs when (kind, id, stamp) is not cached, so unchanged
+rows cost a dict lookup instead of template logic.
+"""
+import threading
+from collections import OrderedDict
+from app.depots import current_depot
+
+class FragmentCache:
+    def __init__(self, max_entries=20000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_render(self, key, render):
+        with self._lock:
+            html = self._entries.get(key)
+            if html is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return html
+            self.misses += 1
+
+        # Render outside the lock, a duplicate render on a race is harmless
+        html = render()
+        with self._lock:
+            self._entries[key] = html
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return html
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+def init_fragment_cache(app):
+    app.config.setdefault('FRAGMENT_CACHE_SIZE', 20000)
+    cache = FragmentCache(app.config['FRAGMENT_CACHE_SIZE'])
+    app.extensions['fragment_cache'] = cache
+
+    def fragment(kind, id, stamp, macro, *args):
+        if not app.config['FRAGMENT_CACHE_SIZE']:
+            return macro(*args)
+        # Macro name is part of the key so two row layouts never collide, and ids repeat across depots
+        key = (current_depot(), kind, macro.name, id, stamp)
+        return cache.get_or_render(key, lambda: macro(*args))
+
+    app.jinja_env.globals['fragment'] = fragment
+    return cache
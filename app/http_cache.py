@@ -0,0 +1,168 @@
+"""
+HTTP caching and compression.
+
+- Responses are gzip (or brotli, if installed) compressed above a size threshold.
+- Views decorated with @conditional get weak ETag / Last-Modified headers
+  derived from table versions and answer 304 without rendering.
+- url_for('static', ...) adds a content hash, and hashed static URLs are
+  served with a one-year immutable Cache-Control.
+"""
+import gzip
+import hashlib
+import os
+import zlib
+from functools import wraps
+from flask import request, session, make_response
+from flask_login import current_user
+from app.depots import current_depot
+from app.services.table_versions import get_table_versions
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = {
+    'text/html', 'text/css', 'text/csv', 'text/plain', 'text/javascript',
+    'application/javascript', 'application/json', 'image/svg+xml',
+}
+
+_conditional_stats = {'hits': 0, 'misses': 0}
+
+def conditional_stats():
+    """(304 answers, full renders) of @conditional views in this process"""
+    return _conditional_stats['hits'], _conditional_stats['misses']
+
+def conditional(*tables):
+    """
+    Make a GET view conditional on the versions of the given tables.
+
+    The ETag covers the tables, the URL, the current user with their role
+    and depot (pages differ by both, and an admin can change them) and the
+    current depot, so an unchanged page is answered with 304 before the view runs.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            # Pending flash messages must be rendered, never answer 304 then
+            if request.method != 'GET' or session.get('_flashes'):
+                return f(*args, **kwargs)
+
+            versions = get_table_versions(tables)
+            if current_user.is_authenticated:
+                user = f'{current_user.get_id()}:{current_user.role}:{current_user.depot or ""}'
+            else:
+                user = '-'
+            key = '|'.join([request.full_path, user, current_depot()] +
+                           [f'{name}:{versions[name][0]}' for name in sorted(versions)])
+            etag = hashlib.sha1(key.encode('utf-8')).hexdigest()
+            stamps = [updated_at for _, updated_at in versions.values() if updated_at]
+            last_modified = max(stamps).replace(microsecond=0) if stamps else None
+
+            if request.if_none_match.contains_weak(etag):
+                _conditional_stats['hits'] += 1
+                response = make_response('', 304)
+            else:
+                _conditional_stats['misses'] += 1
+                response = make_response(f(*args, **kwargs))
+            response.set_etag(etag, weak=True)
+            if last_modified:
+                response.last_modified = last_modified
+            # Browser keeps the copy but must revalidate every time
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+        return decorated_function
+    return decorator
+
+_static_hashes = {}
+
+def _static_hash(app, filename):
+    path = os.path.join(app.static_folder, filename)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    digest = _static_hashes.get(key)
+    if digest is None:
+        with open(path, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()[:12]
+        _static_hashes[key] = digest
+    return digest
+
+def _choose_encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+def _compress_stream(iterable, level):
+    # gzip container via zlib (wbits=31), streamed chunk by chunk. Each chunk
+    # is sync-flushed, zlib would otherwise hold the output until its buffer fills
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    try:
+        for chunk in iterable:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            if not chunk:
+                continue
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+    finally:
+        if hasattr(iterable, 'close'):
+            iterable.close()
+
+def init_http_cache(app):
+    app.config.setdefault('COMPRESS_MIN_SIZE', 500)
+    app.config.setdefault('COMPRESS_LEVEL', 6)
+    app.config.setdefault('STATIC_MAX_AGE', 365 * 24 * 3600)
+
+    @app.url_defaults
+    def hashed_static_url(endpoint, values):
+        if endpoint == 'static' and 'filename' in values and 'v' not in values:
+            digest = _static_hash(app, values['filename'])
+            if digest:
+                values['v'] = digest
+
+    @app.after_request
+    def cache_and_compress(response):
+        if request.endpoint == 'static' and request.args.get('v') and response.status_code in (200, 304):
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = app.config['STATIC_MAX_AGE']
+            response.cache_control.immutable = True
+
+        if (response.status_code != 200
+                or 'Content-Encoding' in response.headers
+                or response.mimetype not in COMPRESSIBLE_TYPES):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = _choose_encoding()
+        if encoding is None:
+            return response
+
+        level = app.config['COMPRESS_LEVEL']
+        if response.direct_passthrough:
+            # send_file responses (static) read lazily from disk, they are small
+            response.direct_passthrough = False
+        elif response.is_streamed:
+            # Unknown length: compress incrementally (gzip only)
+            if request.accept_encodings['gzip']:
+                response.response = _compress_stream(response.response, level)
+                response.headers.pop('Content-Length', None)
+                response.headers['Content-Encoding'] = 'gzip'
+            return response
+
+        data = response.get_data()
+        if len(data) < app.config['COMPRESS_MIN_SIZE']:
+            return response
+        if encoding == 'br':
+            data = brotli.compress(data, quality=min(level, 11))
+        else:
+            data = gzip.compress(data, compresslevel=level)
+        response.set_data(data)
+        response.headers['Content-Encoding'] = encoding
+        return response
@@ -0,0 +1,262 @@
+"""
+Live change feed for the orders and subscribers pages.
+
+Changes are written to live_events in the same transaction as the data
+(see the session listener below), so clients only ever see committed
+changes. In each process one thread polls the table while browsers are
+connected and fans new rows out to them, which makes the feed work across
+worker processes. /live/events streams the events as server-sent events.
+Event ids are row ids, so a reconnecting browser resumes from Last-Event-ID.
+
+Each open stream holds a request thread. LIVE_MAX_CLIENTS caps them per
+process (a browser over the cap gets an empty stream that asks it to
+retry later, an error status would stop EventSource for good), and
+streams end after LIVE_STREAM_SECONDS so they stay below the server's
+request timeout. EventSource reconnects on its own.
+
+live_events is a depot table, so every depot has its own broker and a
+browser only sees its depot's changes.
+"""
+import json
+import queue
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from flask import Response, request
+from flask_login import login_required
+from sqlalchemy import event, select, func, or_
+from sqlalchemy.orm import Session, attributes
+from app import db
+from app.depots import current_depot, depot_engine
+from app.models import LiveEvent, Order, Payment, Subscriber
+
+def _money(value):
+    return float(value or 0)
+
+def order_payload(order):
+    return {
+        'id': order.id,
+        'subscriber_id': order.subscriber_id,
+        'new_bottles': order.new_bottles or 0,
+        'exchange_bottles': order.exchange_bottles or 0,
+        'water_only': order.water_only or 0,
+        'free_bottles': order.free_bottles or 0,
+        'total': _money(order.total_amount),
+        'paid': _money(order.paid_amount),
+        'is_free': bool(order.is_free),
+        'created_at': order.created_at.isoformat() if order.created_at else None,
+    }
+
+def publish(connection, events):
+    """Insert (kind, payload) events on the given connection, i.e. in its transaction"""
+    if not events:
+        return
+    now = datetime.now()
+    connection.execute(LiveEvent.__table__.insert(), [
+        {'kind': kind, 'payload': json.dumps(payload, ensure_ascii=False), 'created_at': now}
+        for kind, payload in events
+    ])
+
+def publish_debts(subscriber_ids):
+    """Publish the current debt of the given subscribers (after bulk updates that bypass the ORM)"""
+    if not subscriber_ids:
+        return
+    rows = db.session.query(Subscriber.id, Subscriber.debt).filter(Subscriber.id.in_(list(subscriber_ids))).all()
+    publish(_events_connection(db.session), [('debt', {'subscriber_id': id, 'debt': _money(debt)}) for id, debt in rows])
+
+def publish_subscriber_deletions(subscriber_ids):
+    """Publish subscriber_deleted events (after bulk deletes that bypass the ORM)"""
+    publish(_events_connection(db.session), [('subscriber_deleted', {'subscriber_id': id}) for id in subscriber_ids])
+
+def _events_connection(session):
+    return session.connection(bind_arguments={'mapper': LiveEvent})
+
+@event.listens_for(Session, 'after_flush')
+def _collect_events(session, flush_context):
+    events = []
+    for obj in session.new:
+        if isinstance(obj, Order):
+            events.append(('order', order_payload(obj)))
+        elif isinstance(obj, Payment):
+            events.append(('payment', {
+                'id': obj.id, 'subscriber_id': obj.subscriber_id, 'amount': _money(obj.amount),
+                'created_at': obj.created_at.isoformat() if obj.created_at else None,
+            }))
+    for obj in session.dirty:
+        if isinstance(obj, Subscriber) and attributes.get_history(obj, 'debt').has_changes():
+            events.append(('debt', {'subscriber_id': obj.id, 'debt': _money(obj.debt)}))
+        # Soft deletes (app.services.trash) look the same as real ones to the pages
+        if isinstance(obj, (Order, Subscriber)) and obj.deleted_at is not None \
+                and attributes.get_history(obj, 'deleted_at').has_changes():
+            if isinstance(obj, Order):
+                events.append(('order_deleted', {'id': obj.id, 'subscriber_id': obj.subscriber_id}))
+            else:
+                events.append(('subscriber_deleted', {'subscriber_id': obj.id}))
+    for obj in session.deleted:
+        if isinstance(obj, Order):
+            events.append(('order_deleted', {'id': obj.id, 'subscriber_id': obj.subscriber_id}))
+        elif isinstance(obj, Subscriber):
+            events.append(('subscriber_deleted', {'subscriber_id': obj.id}))
+    if events:
+        publish(_events_connection(session), events)
+
+class Listener:
+    def __init__(self, size):
+        self.queue = queue.Queue(maxsize=size)
+        self.overflowed = False
+
+class LiveBroker:
+    """Polls live_events while listeners are connected and hands new rows to each of them"""
+
+    def __init__(self, engine, poll_interval=0.5, gap_seconds=10):
+        self.engine = engine
+        self.poll_interval = poll_interval
+        self.gap_seconds = gap_seconds
+        self.listeners = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.last_id = None
+        self.gaps = {}  # ids skipped by the poller -> when first seen missing
+
+    def subscribe(self, size=1000):
+        listener = Listener(size)
+        with self._lock:
+            self.listeners.add(listener)
+            if self._thread is None:
+                self.last_id = None
+                self.gaps = {}
+                self._thread = threading.Thread(target=self._run, name='live-events', daemon=True)
+                self._thread.start()
+        return listener
+
+    def unsubscribe(self, listener):
+        with self._lock:
+            self.listeners.discard(listener)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self.listeners:
+                    self._thread = None
+                    return
+            try:
+                with self.engine.connect() as conn:
+                    self.poll(conn)
+            except Exception:
+                pass  # database busy or restarting, the next poll catches up
+            time.sleep(self.poll_interval)
+
+    def poll(self, conn):
+        table = LiveEvent.__table__
+        if self.last_id is None:
+            self.last_id = conn.execute(select(func.max(table.c.id))).scalar() or 0
+            return
+        # Ids are taken at insert but committed later, a lower id can show up after a higher one
+        condition = table.c.id > self.last_id
+        if self.gaps:
+            condition = or_(condition, table.c.id.in_(list(self.gaps)))
+        rows = conn.execute(select(table.c.id, table.c.kind, table.c.payload)
+                            .where(condition).order_by(table.c.id).limit(1000)).all()
+        now = time.monotonic()
+        for row in rows:
+            if row.id > self.last_id:
+                for missing in range(self.last_id + 1, row.id):
+                    self.gaps[missing] = now
+                self.last_id = row.id
+            else:
+                self.gaps.pop(row.id, None)
+            self.dispatch((row.id, row.kind, row.payload))
+        for missing, seen in list(self.gaps.items()):
+            if now - seen > self.gap_seconds:
+                del self.gaps[missing]
+
+    def dispatch(self, item):
+        with self._lock:
+            listeners = list(self.listeners)
+        for listener in listeners:
+            try:
+                listener.queue.put_nowait(item)
+            except queue.Full:
+                # A stuck client: end its stream, it resumes from Last-Event-ID
+                listener.overflowed = True
+
+def backlog(engine, after_id, limit=500):
+    table = LiveEvent.__table__
+    with engine.connect() as conn:
+        return conn.execute(select(table.c.id, table.c.kind, table.c.payload)
+                            .where(table.c.id > after_id).order_by(table.c.id).limit(limit)).all()
+
+def prune_events(retention_hours):
+    """Delete live events older than retention_hours"""
+    cutoff = datetime.now() - timedelta(hours=retention_hours)
+    deleted = LiveEvent.query.filter(LiveEvent.created_at < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+    return f'{deleted} live events deleted'
+
+def _format(id, kind, payload):
+    return f'id: {id}\nevent: {kind}\ndata: {payload}\n\n'
+
+def init_live(app):
+    app.config.setdefault('LIVE_POLL_INTERVAL', 0.5)
+    app.config.setdefault('LIVE_MAX_CLIENTS', 4)
+    app.config.setdefault('LIVE_BUSY_RETRY_SECONDS', 10)
+    app.config.setdefault('LIVE_STREAM_SECONDS', 50)
+    app.config.setdefault('LIVE_HEARTBEAT_SECONDS', 15)
+    app.config.setdefault('LIVE_EVENT_RETENTION_HOURS', 24)
+
+    brokers = {}
+    app.extensions['live'] = brokers
+
+    def get_broker(depot):
+        if depot not in brokers:
+            # setdefault keeps one broker per depot when two requests race here
+            brokers.setdefault(depot, LiveBroker(depot_engine(depot), app.config['LIVE_POLL_INTERVAL']))
+        return brokers[depot]
+
+    @app.route('/live/events')
+    @login_required
+    def live_events():
+        if sum(len(b.listeners) for b in list(brokers.values())) >= app.config['LIVE_MAX_CLIENTS']:
+            # Too many live connections: end at once, EventSource reconnects after retry
+            retry = app.config['LIVE_BUSY_RETRY_SECONDS'] * 1000
+            return Response(f'retry: {retry}\n\n', mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache'})
+
+        last_event_id = request.headers.get('Last-Event-ID', type=int)
+        broker = get_broker(current_depot())
+        engine = broker.engine
+        listener = broker.subscribe()
+        # Subscribe first, then read what was missed, so nothing falls in between
+        missed = backlog(engine, last_event_id) if last_event_id is not None else []
+        lifetime = app.config['LIVE_STREAM_SECONDS']
+        heartbeat = app.config['LIVE_HEARTBEAT_SECONDS']
+
+        def stream():
+            try:
+                yield 'retry: 2000\n\n'
+                sent = set()
+                for row in missed:
+                    sent.add(row.id)
+                    yield _format(row.id, row.kind, row.payload)
+                deadline = time.monotonic() + lifetime
+                while not listener.overflowed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        id, kind, payload = listener.queue.get(timeout=min(heartbeat, remaining))
+                    except queue.Empty:
+                        yield ': ping\n\n'
+                        continue
+                    if id not in sent:
+                        yield _format(id, kind, payload)
+            finally:
+                broker.unsubscribe(listener)
+
+        response = Response(stream(), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+    return brokers
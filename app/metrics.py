@@ -0,0 +1,359 @@
+"""
+Prometheus text-format metrics that aggregate across worker processes.
+
+Every serving process keeps its metrics in memory and periodically writes
+them to METRICS_DIR/<pid>-<start>.json (start_metrics, called by the web
+server and run.py, never by CLI commands). The snapshots of processes that
+have exited are folded into cumulative.json and deleted. /metrics sums
+counters and histograms over all files (so numbers survive worker
+restarts) and gauges over the files of processes that are still alive.
+"""
+import atexit
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from flask import Response, request, g, abort
+from sqlalchemy import event
+
+HTTP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HELP = {
+    'sarwan_http_requests_total': ('counter', 'HTTP requests by endpoint and status'),
+    'sarwan_http_request_duration_seconds': ('histogram', 'HTTP request latency until the response is returned'),
+    'sarwan_db_statements_total': ('counter', 'SQL statements executed'),
+    'sarwan_db_statement_seconds_total': ('counter', 'Time spent executing SQL statements'),
+    'sarwan_db_pool_checked_out': ('gauge', 'Database connections in use'),
+    'sarwan_db_pool_size': ('gauge', 'Database connections kept in the pool'),
+    'sarwan_cache_hits_total': ('counter', 'Cache hits by cache'),
+    'sarwan_cache_misses_total': ('counter', 'Cache misses by cache'),
+    'sarwan_orders_created_total': ('counter', 'Orders inserted'),
+    'sarwan_payments_posted_total': ('counter', 'Payments inserted'),
+    'sarwan_audit_log_writes_total': ('counter', 'Action log rows inserted'),
+    'sarwan_process_up': ('gauge', 'Live processes reporting metrics'),
+}
+
+class Metrics:
+    def __init__(self):
+        self.counters = defaultdict(float)   # (name, labels) -> value
+        self.histograms = {}                 # (name, labels) -> [bucket counts..., sum, count]
+        self.collectors = []                 # callables returning [(kind, name, labels, value)]
+        self._lock = threading.Lock()
+
+    def inc(self, name, labels=(), value=1):
+        with self._lock:
+            self.counters[(name, labels)] += value
+
+    def observe(self, name, labels, value, buckets=HTTP_BUCKETS):
+        with self._lock:
+            data = self.histograms.get((name, labels))
+            if data is None:
+                data = self.histograms[(name, labels)] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    data[i] += 1
+                    break
+            data[-2] += value
+            data[-1] += 1
+
+    def snapshot(self):
+        """JSON-serializable state of this process"""
+        with self._lock:
+            counters = [[name, list(labels), value] for (name, labels), value in self.counters.items()]
+            histograms = [[name, list(labels), list(data)] for (name, labels), data in self.histograms.items()]
+        gauges = []
+        for collector in self.collectors:
+            for kind, name, labels, value in collector():
+                target = counters if kind == 'counter' else gauges
+                target.append([name, list(labels), value])
+        return {'pid': os.getpid(), 'counters': counters, 'histograms': histograms, 'gauges': gauges}
+
+metrics = Metrics()
+_model_events_registered = False
+_own_file = None      # snapshot file of this process once start_metrics ran
+_started_pid = None
+
+CUMULATIVE_FILE = 'cumulative.json'
+FOLD_LOCK = 'fold.lock'
+FOLD_LOCK_STALE = 60
+
+if os.name == 'nt':
+    # os.kill() terminates the process on Windows, ask for its exit code instead
+    import ctypes
+    from ctypes import wintypes
+
+    _kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+    _kernel32.OpenProcess.argtypes = (wintypes.DWORD, wintypes.BOOL, wintypes.DWORD)
+    _kernel32.OpenProcess.restype = wintypes.HANDLE
+    _kernel32.GetExitCodeProcess.argtypes = (wintypes.HANDLE, ctypes.POINTER(wintypes.DWORD))
+    _kernel32.GetExitCodeProcess.restype = wintypes.BOOL
+    _kernel32.CloseHandle.argtypes = (wintypes.HANDLE,)
+    PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+    STILL_ACTIVE = 259
+    ERROR_ACCESS_DENIED = 5
+
+    def _pid_alive(pid):
+        handle = _kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not handle:
+            # Access denied: the process exists but belongs to someone else
+            return ctypes.get_last_error() == ERROR_ACCESS_DENIED
+        try:
+            code = wintypes.DWORD()
+            if not _kernel32.GetExitCodeProcess(handle, ctypes.byref(code)):
+                return True
+            return code.value == STILL_ACTIVE
+        finally:
+            _kernel32.CloseHandle(handle)
+else:
+    def _pid_alive(pid):
+        try:
+            os.kill(pid, 0)
+        except PermissionError:
+            return True
+        except OSError:
+            return False
+        return True
+
+def _labels_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + '}'
+
+def _read_snapshots(directory):
+    """[(file name, snapshot)] of the other processes (and cumulative.json)"""
+    snapshots = []
+    if os.path.isdir(directory):
+        for name in os.listdir(directory):
+            if not name.endswith('.json') or name == _own_file:
+                continue
+            try:
+                with open(os.path.join(directory, name), encoding='utf-8') as f:
+                    snapshots.append((name, json.load(f)))
+            except (OSError, ValueError):
+                continue
+    return snapshots
+
+def _add_snapshot(counters, histograms, snap):
+    for name, labels, value in snap['counters']:
+        counters[(name, tuple(map(tuple, labels)))] += value
+    for name, labels, data in snap['histograms']:
+        key = (name, tuple(map(tuple, labels)))
+        total = histograms.setdefault(key, [0] * len(data))
+        for i, value in enumerate(data):
+            total[i] += value
+
+def _write_json(path, data):
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(path + '.tmp', path)
+
+def fold_dead_snapshots(directory):
+    """
+    Add the counters and histograms of exited processes to cumulative.json
+    and delete their snapshots. A lock directory keeps two processes from
+    folding at once. Returns how many snapshots were folded.
+    """
+    lock = os.path.join(directory, FOLD_LOCK)
+    try:
+        os.mkdir(lock)
+    except FileExistsError:
+        try:
+            if time.time() - os.path.getmtime(lock) < FOLD_LOCK_STALE:
+                return 0
+        except OSError:
+            return 0
+        # Left behind by a process that died while folding
+        os.utime(lock)
+    except OSError:
+        return 0
+    try:
+        dead = [(name, snap) for name, snap in _read_snapshots(directory)
+                if name != CUMULATIVE_FILE and snap.get('pid') and not _pid_alive(snap['pid'])]
+        if not dead:
+            return 0
+        counters, histograms = defaultdict(float), {}
+        path = os.path.join(directory, CUMULATIVE_FILE)
+        try:
+            with open(path, encoding='utf-8') as f:
+                _add_snapshot(counters, histograms, json.load(f))
+        except FileNotFoundError:
+            pass
+        for _, snap in dead:
+            _add_snapshot(counters, histograms, snap)
+        _write_json(path, {
+            'pid': None,
+            'counters': [[name, list(labels), value] for (name, labels), value in counters.items()],
+            'histograms': [[name, list(labels), data] for (name, labels), data in histograms.items()],
+            'gauges': [],
+        })
+        for name, _ in dead:
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+        return len(dead)
+    finally:
+        try:
+            os.rmdir(lock)
+        except OSError:
+            pass
+
+def render_metrics(directory):
+    counters = defaultdict(float)
+    histograms = {}
+    gauges = defaultdict(float)
+
+    snapshots = [metrics.snapshot()] + [snap for _, snap in _read_snapshots(directory)]
+    for snap in snapshots:
+        pid = snap.get('pid')
+        alive = pid == os.getpid() or (pid is not None and _pid_alive(pid))
+        _add_snapshot(counters, histograms, snap)
+        if alive:
+            gauges[('sarwan_process_up', ())] += 1
+            for name, labels, value in snap['gauges']:
+                gauges[(name, tuple(map(tuple, labels)))] += value
+
+    lines = []
+    by_name = defaultdict(list)
+    for (name, labels), value in list(counters.items()) + list(gauges.items()):
+        by_name[name].append((labels, value))
+    for (name, labels), data in histograms.items():
+        by_name[name].append((labels, data))
+
+    for name in sorted(by_name):
+        kind, help_text = HELP.get(name, ('untyped', name))
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in sorted(by_name[name]):
+            if kind != 'histogram':
+                lines.append(f'{name}{_labels_text(labels)} {value:g}')
+                continue
+            cumulative = 0
+            for bound, count in zip(HTTP_BUCKETS, value):
+                cumulative += count
+                lines.append(f'{name}_bucket{_labels_text(labels + (("le", f"{bound:g}"),))} {cumulative:g}')
+            lines.append(f'{name}_bucket{_labels_text(labels + (("le", "+Inf"),))} {value[-1]:g}')
+            lines.append(f'{name}_sum{_labels_text(labels)} {value[-2]:g}')
+            lines.append(f'{name}_count{_labels_text(labels)} {value[-1]:g}')
+    return '\n'.join(lines) + '\n'
+
+def metrics_dir(app):
+    return app.config['METRICS_DIR'] or os.path.join(app.instance_path, 'metrics')
+
+def init_metrics(app, db):
+    app.config.setdefault('METRICS_DIR', None)
+    app.config.setdefault('METRICS_FLUSH_INTERVAL', 5)
+    app.config.setdefault('METRICS_TOKEN', None)
+
+    directory = metrics_dir(app)
+
+    # HTTP latency and status
+    @app.before_request
+    def start_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        started = g.pop('metrics_started', None)
+        if started is not None and request.endpoint != 'static':
+            labels = (('blueprint', request.blueprint or ''), ('endpoint', request.endpoint or 'unknown'),
+                      ('method', request.method))
+            metrics.observe('sarwan_http_request_duration_seconds', labels, time.perf_counter() - started)
+            metrics.inc('sarwan_http_requests_total', labels + (('status', str(response.status_code)),))
+        return response
+
+    # DB statements, timed on the cursor (main and depot databases)
+    with app.app_context():
+        from app.depots import all_engines
+        engines = all_engines()
+
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+    def after_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info['metrics_started'].pop()
+        metrics.inc('sarwan_db_statements_total')
+        metrics.inc('sarwan_db_statement_seconds_total', value=time.perf_counter() - started)
+
+    def on_error(context):
+        if context.connection is not None and context.connection.info.get('metrics_started'):
+            context.connection.info['metrics_started'].pop()
+
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute', before_execute)
+        event.listen(engine, 'after_cursor_execute', after_execute)
+        event.listen(engine, 'handle_error', on_error)
+
+    # Business counters (mapper events are global, register them once per process)
+    global _model_events_registered
+    if not _model_events_registered:
+        from app.models import Order, Payment, ActionLog
+        event.listen(Order, 'after_insert', lambda *a: metrics.inc('sarwan_orders_created_total'))
+        event.listen(Payment, 'after_insert', lambda *a: metrics.inc('sarwan_payments_posted_total'))
+        event.listen(ActionLog, 'after_insert', lambda *a: metrics.inc('sarwan_audit_log_writes_total'))
+        _model_events_registered = True
+
+    # Pool usage and cache statistics are read when a snapshot is taken, from
+    # the first app of the process (metrics is one per process)
+    def collect():
+        pools = [engine.pool for engine in engines]
+        samples = []
+        if all(hasattr(pool, 'checkedout') for pool in pools):
+            samples.append(('gauge', 'sarwan_db_pool_checked_out', (), sum(pool.checkedout() for pool in pools)))
+        if all(hasattr(pool, 'size') for pool in pools):
+            samples.append(('gauge', 'sarwan_db_pool_size', (), sum(pool.size() for pool in pools)))
+        for cache_name, hits, misses in cache_stats(app):
+            samples.append(('counter', 'sarwan_cache_hits_total', (('cache', cache_name),), hits))
+            samples.append(('counter', 'sarwan_cache_misses_total', (('cache', cache_name),), misses))
+        return samples
+
+    if not metrics.collectors:
+        metrics.collectors.append(collect)
+
+    @app.route('/metrics')
+    def metrics_endpoint():
+        token = app.config['METRICS_TOKEN']
+        if token and request.headers.get('Authorization') != f'Bearer {token}':
+            abort(401)
+        return Response(render_metrics(directory), mimetype='text/plain; version=0.0.4')
+
+def start_metrics(app):
+    """
+    Write this process's snapshots for /metrics of the other workers. Runs
+    once per process, from the web server entry points only: CLI commands
+    and test apps keep their metrics in memory.
+    """
+    global _own_file, _started_pid
+    if _started_pid == os.getpid():
+        return
+    _started_pid = os.getpid()
+    _own_file = f'{os.getpid()}-{int(time.time())}.json'
+    directory = metrics_dir(app)
+
+    def flush():
+        try:
+            os.makedirs(directory, exist_ok=True)
+            _write_json(os.path.join(directory, _own_file), metrics.snapshot())
+            fold_dead_snapshots(directory)
+        except OSError as e:
+            app.logger.warning('Could not write metrics: %s', e)
+
+    def flush_loop():
+        while True:
+            time.sleep(app.config['METRICS_FLUSH_INTERVAL'])
+            flush()
+
+    flush()
+    threading.Thread(target=flush_loop, name='metrics-flush', daemon=True).start()
+    atexit.register(flush)
+
+def cache_stats(app):
+    """(name, hits, misses) for the caches of this process"""
+    from app.services.pricing import pricing_cache_stats
+    from app.http_cache import conditional_stats
+    stats = [('pricing', *pricing_cache_stats()), ('http_etag', *conditional_stats())]
+    fragment_cache = app.extensions.get('fragment_cache')
+    if fragment_cache is not None:
+        stats.append(('fragment', fragment_cache.hits, fragment_cache.misses))
+    return stats
@@ -13,6 +13,7 @@ class User(UserMixin, db.Model):
     username = db.Column(db.String(64), unique=True, nullable=False)
     password_hash = db.Column(db.String(256), nullable=False)
     role = db.Column(db.String(20), default='user')  # admin or user
+    depot = db.Column(db.String(32))  # see app.depots, None = the first depot
     created_at = db.Column(db.DateTime, default=datetime.now)
     
     logs = db.relationship('ActionLog', backref='user', lazy='dynamic')
@@ -36,6 +37,10 @@ class Subscriber(db.Model):
     promo_start_date = db.Column(db.DateTime, nullable=True) # If set, only count orders after this date
     promo_custom_limit = db.Column(db.Integer, nullable=True) # If set, override global limit
     
+    # Soft delete: hidden at once, purged later with its orders and payments (see app.services.trash)
+    deleted_at = db.Column(db.DateTime, nullable=True, index=True)
+    deleted_by = db.Column(db.Integer, nullable=True)
+    
     phones = db.relationship('Phone', backref='subscriber', lazy='dynamic', cascade='all, delete-orphan')
     orders = db.relationship('Order', backref='subscriber', lazy='dynamic')
     payments = db.relationship('Payment', backref='subscriber', lazy='dynamic')
@@ -48,6 +53,10 @@ class Phone(db.Model):
 
 class Order(db.Model):
     __tablename__ = 'orders'
+    __table_args__ = (
+        db.Index('ix_orders_subscriber_created', 'subscriber_id', 'created_at'),
+        db.Index('ux_orders_client_key', 'client_key', unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
     subscriber_id = db.Column(db.Integer, db.ForeignKey('subscribers.id'), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
@@ -59,14 +68,39 @@ class Order(db.Model):
     paid_amount = db.Column(db.Numeric(12, 2), default=0)  # Tölenen mukdar (kredit = total - paid)
     is_free = db.Column(db.Boolean, default=False)  # Mugt sargyt
     created_at = db.Column(db.DateTime, default=datetime.now)
+    client_key = db.Column(db.String(64))  # Idempotency key from the browser (offline sync, form resubmits)
+    deleted_at = db.Column(db.DateTime, nullable=True, index=True)
+    deleted_by = db.Column(db.Integer, nullable=True)
 
 class Payment(db.Model):
     __tablename__ = 'payments'
+    __table_args__ = (
+        db.Index('ix_payments_subscriber_created', 'subscriber_id', 'created_at'),
+        db.Index('ux_payments_client_key', 'client_key', unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
     subscriber_id = db.Column(db.Integer, db.ForeignKey('subscribers.id'), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     amount = db.Column(db.Numeric(12, 2), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.now)
+    client_key = db.Column(db.String(64))
+
+class DuplicateCandidate(db.Model):
+    """Pair of subscribers that look like the same customer, waiting for review (see app.services.duplicates)"""
+    __tablename__ = 'duplicate_candidates'
+    __table_args__ = (
+        db.Index('ux_duplicate_candidates_pair', 'subscriber_id', 'duplicate_id', unique=True),
+        db.Index('ix_duplicate_candidates_status_score', 'status', 'score'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    subscriber_id = db.Column(db.Integer, nullable=False)  # lower id of the pair
+    duplicate_id = db.Column(db.Integer, nullable=False)
+    score = db.Column(db.Float, nullable=False)
+    reasons = db.Column(db.String(64))  # phone, address
+    status = db.Column(db.String(16), nullable=False, default='pending')  # pending, merged or dismissed
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    reviewed_at = db.Column(db.DateTime)
+    reviewed_by = db.Column(db.Integer)
 
 class Price(db.Model):
     __tablename__ = 'prices'
@@ -90,3 +124,73 @@ class Settings(db.Model):
     key = db.Column(db.String(64), primary_key=True)
     value = db.Column(db.String(256))
     description = db.Column(db.String(256))
+
+class TableVersion(db.Model):
+    """Change counter per table, bumped in the same transaction as the change (see app.services.table_versions)"""
+    __tablename__ = 'table_versions'
+    name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.now)
+
+class RefillForecast(db.Model):
+    """When a subscriber is expected to need water again, from their order history (see app.services.refills)"""
+    __tablename__ = 'refill_forecasts'
+    __table_args__ = (
+        db.Index('ix_refill_forecasts_due', 'due_at'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    subscriber_id = db.Column(db.Integer, nullable=False, unique=True)
+    orders = db.Column(db.Integer, nullable=False)            # orders the estimate is based on
+    interval_days = db.Column(db.Float, nullable=False)       # average days between orders
+    bottles_per_day = db.Column(db.Float, nullable=False)
+    last_order_at = db.Column(db.DateTime, nullable=False)
+    last_bottles = db.Column(db.Integer, nullable=False)
+    due_at = db.Column(db.DateTime, nullable=False)
+    computed_at = db.Column(db.DateTime, default=datetime.now)
+
+class ScheduledJob(db.Model):
+    """Next run and lock of a scheduled job, shared by all processes (see app.scheduler)"""
+    __tablename__ = 'scheduled_jobs'
+    name = db.Column(db.String(64), primary_key=True)
+    next_run_at = db.Column(db.DateTime)
+    locked_by = db.Column(db.String(128))
+    locked_until = db.Column(db.DateTime)
+    last_run_at = db.Column(db.DateTime)
+    last_status = db.Column(db.String(16))
+
+class JobRun(db.Model):
+    __tablename__ = 'job_runs'
+    __table_args__ = (
+        db.Index('ix_job_runs_name_started', 'name', 'started_at'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(64), nullable=False)
+    trigger = db.Column(db.String(16), nullable=False)  # schedule or manual
+    status = db.Column(db.String(16), nullable=False)   # ok or error
+    started_at = db.Column(db.DateTime, nullable=False)
+    duration_ms = db.Column(db.Integer)
+    owner = db.Column(db.String(128))
+    message = db.Column(db.Text)
+
+class LiveEvent(db.Model):
+    """Change feed read by every process for the live pages (see app.live)"""
+    __tablename__ = 'live_events'
+    __table_args__ = (
+        db.Index('ix_live_events_created', 'created_at'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(32), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+class OutboxEvent(db.Model):
+    """Committed changes waiting to be relayed to the JSONL change stream (see app.outbox)"""
+    __tablename__ = 'outbox_events'
+    # Ids must never be reused after the relay empties the table
+    __table_args__ = {'sqlite_autoincrement': True}
+    id = db.Column(db.Integer, primary_key=True)
+    entity = db.Column(db.String(32), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(8), nullable=False)  # insert, update or delete
+    data = db.Column(db.Text)  # the row as JSON, none for deletes
+    created_at = db.Column(db.DateTime, default=datetime.now)
@@ -0,0 +1,247 @@
+"""
+Change stream of orders, payments, subscribers and prices for analytics.
+
+Changed rows are remembered during the transaction (ORM flushes, and
+Query.update()/delete() through a select of the matching ids first) and
+written to outbox_events just before commit, in the same transaction, as
+the row as it is then. So the stream only has committed changes, one
+event per row per transaction. Subscriber events carry the phones too.
+Bulk inserts bypass both hooks and call record_changes().
+
+outbox_events lives next to the data (every depot database and the main
+one, for prices). The relay_outbox job moves the rows in batches into
+gzipped JSONL segments, one directory (stream) per database:
+
+    <OUTBOX_DIR>/<stream>/00000000000001.jsonl.gz
+                          00000000050001.jsonl.gz
+                          state.json
+
+Every event gets the next offset of its stream, a segment is named after
+its first offset and rotates after OUTBOX_SEGMENT_EVENTS events. Each
+batch is appended as a gzip member and state.json records the offset and
+the valid length of the open segment, written before the batch leaves the
+table. Delivery is at least once: after a crash a batch can repeat with
+new offsets, so consumers skip event ids they have seen. read_outbox()
+(and `flask outbox read`) reads a stream from an offset.
+"""
+import gzip
+import io
+import json
+import os
+import time
+from datetime import date, datetime
+from decimal import Decimal
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+from app import db
+from app.depots import all_engines, database_name, engine_for_table
+from app.models import OutboxEvent
+
+# Tables in the stream; phone changes are events of their subscriber
+STREAM_TABLES = {'orders', 'payments', 'subscribers', 'prices'}
+_OWNERS = {'phones': ('subscribers', 'subscriber_id')}
+
+CHUNK_SIZE = 500
+
+def _json_value(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+def _changes(session):
+    return session.info.setdefault('outbox', {})
+
+def _record(session, table, ids, op):
+    group = _changes(session).setdefault((engine_for_table(table), table), {})
+    for id in ids:
+        if id is not None and group.get(id) != 'insert':
+            group[id] = op
+
+def record_changes(model, ids, op='update'):
+    """Put rows changed by a bulk statement the hooks don't see (inserts) into this transaction's events"""
+    _record(db.session, model.__tablename__, ids, op)
+
+@event.listens_for(Session, 'after_flush')
+def _collect_changes(session, flush_context):
+    for objects, op in ((session.new, 'insert'), (session.dirty, 'update'), (session.deleted, 'delete')):
+        for obj in objects:
+            name = getattr(obj, '__tablename__', None)
+            if name in STREAM_TABLES:
+                _record(session, name, [obj.id], op)
+            elif name in _OWNERS:
+                owner, column = _OWNERS[name]
+                _record(session, owner, [getattr(obj, column)], 'update')
+
+@event.listens_for(Session, 'do_orm_execute')
+def _collect_bulk_changes(orm_execute_state):
+    state = orm_execute_state
+    if not (state.is_update or state.is_delete) or state.bind_mapper is None:
+        return
+    table = state.bind_mapper.local_table
+    if table.name in STREAM_TABLES:
+        owner, column = table.name, table.c.id
+    elif table.name in _OWNERS:
+        owner, column = _OWNERS[table.name][0], table.c[_OWNERS[table.name][1]]
+    else:
+        return
+    # The rows have to be found before the statement changes them
+    query = select(column)
+    if state.statement.whereclause is not None:
+        query = query.where(state.statement.whereclause)
+    ids = state.session.execute(
+        query, execution_options={'include_deleted': state.execution_options.get('include_deleted', False)},
+        bind_arguments={'bind': engine_for_table(table.name)}).scalars().all()
+    _record(state.session, owner, set(ids), 'delete' if state.is_delete and owner == table.name else 'update')
+
+@event.listens_for(Session, 'before_commit')
+def _write_outbox(session):
+    session.flush()  # commit flushes after this hook, the pending changes have to be seen now
+    changes = session.info.pop('outbox', None)
+    if not changes:
+        return
+    now = datetime.now()
+    for (engine, name), group in changes.items():
+        table = db.metadata.tables[name]
+        connection = session.connection(bind_arguments={'bind': engine})
+        ids = sorted(group)
+        for start in range(0, len(ids), CHUNK_SIZE):
+            chunk = ids[start:start + CHUNK_SIZE]
+            rows = {row.id: dict(row._mapping) for row in connection.execute(select(table).where(table.c.id.in_(chunk)))}
+            if name == 'subscribers':
+                for row in rows.values():
+                    row['phones'] = []
+                phones = db.metadata.tables['phones']
+                for subscriber_id, number in connection.execute(
+                        select(phones.c.subscriber_id, phones.c.number)
+                        .where(phones.c.subscriber_id.in_(list(rows))).order_by(phones.c.id)):
+                    rows[subscriber_id]['phones'].append(number)
+            events = []
+            for id in chunk:
+                row = rows.get(id)
+                if row is None:
+                    events.append({'entity': name, 'entity_id': id, 'op': 'delete', 'data': None, 'created_at': now})
+                    continue
+                data = json.dumps({key: _json_value(value) for key, value in row.items()},
+                                  ensure_ascii=False, separators=(',', ':'))
+                op = 'update' if group[id] == 'delete' else group[id]  # deleted, then written again
+                events.append({'entity': name, 'entity_id': id, 'op': op, 'data': data, 'created_at': now})
+            connection.execute(OutboxEvent.__table__.insert(), events)
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_changes(session):
+    session.info.pop('outbox', None)
+
+# Relay
+
+def outbox_dir(app):
+    return app.config['OUTBOX_DIR'] or os.path.join(app.instance_path, 'outbox')
+
+def _segment_name(offset):
+    return f'{offset:014d}.jsonl.gz'
+
+def outbox_streams(directory):
+    """(stream directory, engine) for every database; one database streams into directory itself"""
+    engines = all_engines()
+    if len(engines) == 1:
+        return [(directory, engines[0])]
+    return [(os.path.join(directory, database_name(engine)), engine) for engine in engines]
+
+def _load_state(stream):
+    try:
+        with open(os.path.join(stream, 'state.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'next_offset': 1, 'segment': _segment_name(1), 'events': 0, 'size': 0}
+
+def _save_state(stream, state):
+    path = os.path.join(stream, 'state.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+def _append(path, size, data):
+    """Write data after the first size bytes of path (dropping a batch a crash left half written)"""
+    with open(path, 'r+b' if os.path.exists(path) else 'wb') as f:
+        f.truncate(size)
+        f.seek(size)
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    return size + len(data)
+
+def _relay_stream(stream, engine, batch_size, segment_events):
+    os.makedirs(stream, exist_ok=True)
+    state = _load_state(stream)
+    table = OutboxEvent.__table__
+    relayed = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(select(table).order_by(table.c.id).limit(batch_size)).all()
+            if not rows:
+                return relayed
+            if state['events'] >= segment_events:
+                state.update(segment=_segment_name(state['next_offset']), events=0, size=0)
+            lines = []
+            for offset, row in enumerate(rows, start=state['next_offset']):
+                lines.append(json.dumps({
+                    'offset': offset, 'id': row.id, 'entity': row.entity, 'entity_id': row.entity_id, 'op': row.op,
+                    'at': row.created_at.isoformat() if row.created_at else None,
+                    'data': json.loads(row.data) if row.data else None,
+                }, ensure_ascii=False, separators=(',', ':')))
+            # The file and state.json first: if the delete is lost the batch repeats, it is never lost
+            state['size'] = _append(os.path.join(stream, state['segment']), state['size'],
+                                    gzip.compress(('\n'.join(lines) + '\n').encode('utf-8')))
+            state['next_offset'] += len(rows)
+            state['events'] += len(rows)
+            _save_state(stream, state)
+            conn.execute(table.delete().where(table.c.id.in_([row.id for row in rows])))
+        relayed += len(rows)
+
+def _prune_segments(stream, retention_days):
+    cutoff = time.time() - retention_days * 86400
+    current = _load_state(stream)['segment']
+    removed = 0
+    for name in os.listdir(stream):
+        path = os.path.join(stream, name)
+        if name.endswith('.jsonl.gz') and name != current and os.path.getmtime(path) < cutoff:
+            os.remove(path)
+            removed += 1
+    return removed
+
+def relay_outbox(directory, batch_size=1000, segment_events=50000, retention_days=30):
+    """Move outbox events into the rotating JSONL segments"""
+    db.session.remove()  # the relay uses its own connections
+    results = []
+    for stream, engine in outbox_streams(directory):
+        relayed = _relay_stream(stream, engine, batch_size, segment_events)
+        removed = _prune_segments(stream, retention_days)
+        results.append(f'{os.path.basename(stream)}: {relayed} events' + (f', {removed} old segments removed' if removed else ''))
+    return '; '.join(results)
+
+def read_outbox(stream, after_offset=0):
+    """Events (dicts) of a stream directory with an offset above after_offset, in order"""
+    state = _load_state(stream)
+    segments = sorted(name for name in os.listdir(stream) if name.endswith('.jsonl.gz')) \
+        if os.path.isdir(stream) else []
+    for index, name in enumerate(segments):
+        if index + 1 < len(segments) and int(segments[index + 1].split('.')[0]) <= after_offset + 1:
+            continue  # every event of this segment was read already
+        with open(os.path.join(stream, name), 'rb') as f:
+            # The open segment is only valid up to the length in state.json
+            data = f.read(state['size']) if name == state['segment'] else f.read()
+        with gzip.GzipFile(fileobj=io.BytesIO(data)) as lines:
+            for line in lines:
+                item = json.loads(line)
+                if item['offset'] > after_offset:
+                    yield item
+
+def init_outbox(app):
+    app.config.setdefault('OUTBOX_DIR', None)
+    app.config.setdefault('OUTBOX_BATCH_SIZE', 1000)
+    app.config.setdefault('OUTBOX_SEGMENT_EVENTS', 50000)
+    app.config.setdefault('OUTBOX_RETENTION_DAYS', 30)
+
@@ -0,0 +1,114 @@
+"""
+On-demand sampling profiler for single requests.
+
+A request is profiled when an admin adds ?_profile=1 (or the header
+X-Profile: 1), or at random with probability PROFILE_SAMPLE_RATE.
+While the request runs a background thread samples the request thread's
+stack every PROFILE_INTERVAL seconds. The samples are written to
+PROFILE_DIR in collapsed-stack format ("outer;inner;leaf count"), which
+speedscope and flamegraph.pl open directly.
+"""
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from flask import g, request
+from flask_login import current_user
+
+class Sampler:
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.duration = time.perf_counter() - self.started
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def collapsed(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.samples.most_common())
+
+def profile_dir(app):
+    return app.config['PROFILE_DIR'] or os.path.join(app.instance_path, 'profiles')
+
+def list_profiles(app):
+    """Saved profiles, newest first, as (name, size, modified)"""
+    directory = profile_dir(app)
+    if not os.path.isdir(directory):
+        return []
+    entries = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.endswith('.txt') and os.path.isfile(path):
+            stat = os.stat(path)
+            entries.append((name, stat.st_size, datetime.fromtimestamp(stat.st_mtime)))
+    return sorted(entries, key=lambda e: e[2], reverse=True)
+
+def _save(app, sampler):
+    directory = profile_dir(app)
+    os.makedirs(directory, exist_ok=True)
+    endpoint = re.sub(r'[^A-Za-z0-9_.-]', '_', request.endpoint or 'unknown')
+    name = '{}_{}_{}ms_{}.txt'.format(datetime.now().strftime('%Y%m%d-%H%M%S'), endpoint,
+                                      int(sampler.duration * 1000), os.getpid())
+    with open(os.path.join(directory, name), 'w', encoding='utf-8') as f:
+        f.write(sampler.collapsed())
+
+    # Keep only the newest PROFILE_KEEP files
+    for old_name, _, _ in list_profiles(app)[app.config['PROFILE_KEEP']:]:
+        try:
+            os.remove(os.path.join(directory, old_name))
+        except OSError:
+            pass
+
+def init_profiler(app):
+    app.config.setdefault('PROFILE_SAMPLE_RATE', 0.0)
+    app.config.setdefault('PROFILE_INTERVAL', 0.005)
+    app.config.setdefault('PROFILE_DIR', None)
+    app.config.setdefault('PROFILE_KEEP', 200)
+
+    def wants_profile():
+        if request.endpoint == 'static':
+            return False
+        if request.args.get('_profile') or request.headers.get('X-Profile'):
+            return current_user.is_authenticated and current_user.role == 'admin'
+        rate = app.config['PROFILE_SAMPLE_RATE']
+        return rate > 0 and random.random() < rate
+
+    @app.before_request
+    def start_profiler():
+        if wants_profile():
+            g.profiler = Sampler(threading.get_ident(), app.config['PROFILE_INTERVAL'])
+            g.profiler.start()
+
+    @app.teardown_request
+    def stop_profiler(exc):
+        sampler = g.pop('profiler', None)
+        if sampler is None:
+            return
+        sampler.stop()
+        try:
+            _save(app, sampler)
+        except OSError as e:
+            app.logger.warning('Could not save profile: %s', e)
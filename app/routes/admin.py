@@ -1,10 +1,17 @@
+from datetime import datetime
 from decimal import Decimal
-from flask import Blueprint, render_template, request, redirect, url_for, flash
+from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app, send_from_directory, abort
 from flask_login import login_required, current_user
 from functools import wraps
 from app import db
-from app.models import User, Price, ActionLog, Settings
+from app.depots import depot_names
+from app.models import User, Price, ActionLog, Settings, Subscriber, Phone, DuplicateCandidate
 from app.services import log_action
+from app.services.duplicates import scan_duplicates, merge_subscribers, group_pairs
+from app.services.importer import read_rows, import_subscribers, ImportFileError
+from app.services.pricing import bump_pricing_version
+from app.services.promo import promo_summary
+from app.profiler import list_profiles, profile_dir
 
 admin_bp = Blueprint('admin', __name__)
 
@@ -24,6 +31,10 @@ def users():
     users = User.query.order_by(User.id).all()
     return render_template('admin/users.html', users=users)
 
+def _form_depot():
+    depot = request.form.get('depot')
+    return depot if depot in depot_names() else None
+
 @admin_bp.route('/users/create', methods=['POST'])
 @login_required
 @admin_required
@@ -31,12 +42,13 @@ def create_user():
     username = request.form.get('username')
     password = request.form.get('password')
     role = request.form.get('role', 'user')
+    depot = _form_depot()
     
     if User.query.filter_by(username=username).first():
         flash('Bu ulanyjy ady eýýäm bar', 'error')
         return redirect(url_for('admin.users'))
     
-    user = User(username=username, role=role)
+    user = User(username=username, role=role, depot=depot)
     user.set_password(password)
     db.session.add(user)
     db.session.commit()
@@ -51,6 +63,7 @@ def edit_user(id):
     user = User.query.get_or_404(id)
     user.username = request.form.get('username')
     user.role = request.form.get('role')
+    user.depot = _form_depot() or user.depot
     
     password = request.form.get('password')
     if password:
@@ -91,6 +104,7 @@ def prices():
         for op, legal, individual in defaults:
             p = Price(operation_type=op, legal_price=legal, individual_price=individual)
             db.session.add(p)
+        bump_pricing_version()
         db.session.commit()
         prices = Price.query.all()
     
@@ -108,6 +122,7 @@ def update_prices():
         if individual is not None:
             price.individual_price = Decimal(str(individual))
     
+    bump_pricing_version()
     db.session.commit()
     log_action('UPDATE', 'prices', None, {'updated': 'all'})
     flash('Bahalar täzelendi', 'success')
@@ -121,6 +136,104 @@ def logs():
     logs = ActionLog.query.order_by(ActionLog.created_at.desc()).paginate(page=page, per_page=50)
     return render_template('admin/logs.html', logs=logs)
 
+@admin_bp.route('/duplicates')
+@login_required
+@admin_required
+def duplicates():
+    page = request.args.get('page', 1, type=int)
+    candidates = DuplicateCandidate.query.filter_by(status='pending') \
+        .order_by(DuplicateCandidate.score.desc(), DuplicateCandidate.id).paginate(page=page, per_page=50)
+
+    # Both sides of every listed pair with their phones, in two queries
+    ids = {c.subscriber_id for c in candidates.items} | {c.duplicate_id for c in candidates.items}
+    subscribers = {s.id: s for s in Subscriber.query.filter(Subscriber.id.in_(ids))}
+    phones = {}
+    for subscriber_id, number in db.session.query(Phone.subscriber_id, Phone.number) \
+            .filter(Phone.subscriber_id.in_(ids)).order_by(Phone.id):
+        phones.setdefault(subscriber_id, []).append(number)
+    return render_template('admin/duplicates.html', candidates=candidates, subscribers=subscribers,
+                           phones={k: ', '.join(v) for k, v in phones.items()})
+
+@admin_bp.route('/duplicates/scan', methods=['POST'])
+@login_required
+@admin_required
+def scan_duplicate_subscribers():
+    result = scan_duplicates()
+    flash(f'Gözleg tamamlandy: {result}', 'success')
+    return redirect(url_for('admin.duplicates'))
+
+def _selected_candidates():
+    # A row button sends only its own pair, the bulk button every ticked one
+    ids = [request.form.get('only', type=int)] if request.form.get('only') else request.form.getlist('ids', type=int)
+    return DuplicateCandidate.query.filter(DuplicateCandidate.id.in_(ids),
+                                           DuplicateCandidate.status == 'pending').all()
+
+@admin_bp.route('/duplicates/merge', methods=['POST'])
+@login_required
+@admin_required
+def merge_duplicates():
+    candidates = _selected_candidates()
+    if not candidates:
+        flash('Birleşdirmek üçin jübüt saýlaň', 'error')
+        return redirect(url_for('admin.duplicates'))
+
+    groups = group_pairs((c.subscriber_id, c.duplicate_id) for c in candidates)
+    moved = merge_subscribers(groups)
+    log_action('MERGE', 'subscriber', None, {'groups': {str(k): v for k, v in groups.items()}, **moved})
+    flash(f"{moved['subscribers']} müşderi birleşdirildi ({moved['orders']} sargyt, "
+          f"{moved['payments']} töleg göçürildi)", 'success')
+    return redirect(url_for('admin.duplicates'))
+
+@admin_bp.route('/duplicates/dismiss', methods=['POST'])
+@login_required
+@admin_required
+def dismiss_duplicates():
+    candidates = _selected_candidates()
+    for candidate in candidates:
+        candidate.status = 'dismissed'
+        candidate.reviewed_at = datetime.now()
+        candidate.reviewed_by = current_user.id
+    db.session.commit()
+    flash(f'{len(candidates)} jübüt dublikat däl diýlip bellendi', 'success')
+    return redirect(url_for('admin.duplicates'))
+
+@admin_bp.route('/import', methods=['GET', 'POST'])
+@login_required
+@admin_required
+def import_file():
+    if request.method == 'GET':
+        return render_template('admin/import.html', report=None)
+
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        flash('Faýl saýlaň', 'error')
+        return redirect(url_for('admin.import_file'))
+    client_type = request.form.get('client_type', 'individual')
+    if client_type not in ('legal', 'individual'):
+        flash('Müşderi görnüşi nädogry', 'error')
+        return redirect(url_for('admin.import_file'))
+    dry_run = bool(request.form.get('dry_run'))
+    try:
+        report = import_subscribers(read_rows(upload.read(), upload.filename),
+                                    default_type=client_type,
+                                    allow_collisions=bool(request.form.get('allow_collisions')),
+                                    dry_run=dry_run)
+    except ImportFileError as e:
+        db.session.rollback()
+        flash(str(e), 'error')
+        return redirect(url_for('admin.import_file'))
+
+    if dry_run:
+        db.session.rollback()
+    else:
+        # One audit entry for the whole file, its commit also commits the import
+        log_action('IMPORT', 'subscriber', None, {
+            'file': upload.filename, 'rows': report['rows'], 'imported': report['imported'],
+            'phones': report['phones'], 'invalid': len(report['invalid']), 'collisions': len(report['collisions']),
+        })
+        flash(f"{report['imported']} müşderi goşuldy", 'success')
+    return render_template('admin/import.html', report=report, dry_run=dry_run, filename=upload.filename)
+
 @admin_bp.route('/settings')
 @login_required
 @admin_required
@@ -181,7 +294,27 @@ def update_settings():
         db.session.add(s)
     s.value = 'true' if promo_active == 'on' else 'false'
         
+    bump_pricing_version()
     db.session.commit()
     log_action('UPDATE', 'settings', None, {'updated': 'promo_settings'})
     flash('Sazlamalar täzelendi', 'success')
+    
+    # Show the effect of the change right away (one grouped query)
+    summary = promo_summary()
+    flash(f"Aksiýada: {summary['eligible']} müşderi, limiti gutaran: {summary['exhausted']}", 'success')
     return redirect(url_for('admin.settings'))
+
+@admin_bp.route('/profiles')
+@login_required
+@admin_required
+def profiles():
+    return render_template('admin/profiles.html', profiles=list_profiles(current_app),
+                           sample_rate=current_app.config['PROFILE_SAMPLE_RATE'])
+
+@admin_bp.route('/profiles/<name>')
+@login_required
+@admin_required
+def download_profile(name):
+    if name not in {p[0] for p in list_profiles(current_app)}:
+        abort(404)
+    return send_from_directory(profile_dir(current_app), name, as_attachment=True, mimetype='text/plain')
@@ -0,0 +1,250 @@
+"""
+Versioned JSON API for subscribers, orders and payments (the mobile client).
+
+    GET /api/v1/subscribers?fields=address,phones,promo&limit=50
+    GET /api/v1/subscribers?cursor=<next_cursor of the previous page>
+    GET /api/v1/orders?ids=12,15,40&fields=total_amount,created_at
+    GET /api/v1/payments/7
+
+fields= picks what each item has (id is always there, without fields= a
+resource's default fields). Only the requested columns are selected, and
+computed fields (phones, promo) are loaded for the whole page with one
+query each, only when requested.
+
+ids= returns up to MAX_IDS items from one IN query, in the requested order,
+and lists the ids that don't exist under `missing`. Without ids= items come
+newest first, `limit` at a time; next_cursor (null on the last page) goes
+back as cursor= for the next page. The cursor is the position after the
+last item (keyset), so new rows don't shift the pages.
+"""
+import base64
+import binascii
+from datetime import date, datetime
+from decimal import Decimal
+from functools import wraps
+from flask import Blueprint, request, jsonify
+from flask_login import current_user
+from sqlalchemy.orm import load_only
+from app import db
+from app.models import Subscriber, Phone, Order, Payment
+from app.http_cache import conditional
+from app.services.pricing import get_pricing, promo_order_counts
+
+api_bp = Blueprint('api', __name__)
+
+API_PAGE = 50
+MAX_API_PAGE = 200
+MAX_IDS = 200
+
+class ApiError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+@api_bp.errorhandler(ApiError)
+def api_error(e):
+    return jsonify(error=str(e)), e.status
+
+def api_login_required(f):
+    """login_required, but a client without a session gets 401 instead of the login page"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not current_user.is_authenticated:
+            return jsonify(error='Ulgama girmeli'), 401
+        return f(*args, **kwargs)
+    return decorated_function
+
+# Computed fields: loader(ids) -> {id: value}
+
+def _phones(ids):
+    phones = {id: [] for id in ids}
+    for subscriber_id, number in db.session.query(Phone.subscriber_id, Phone.number) \
+            .filter(Phone.subscriber_id.in_(ids)).order_by(Phone.id):
+        phones[subscriber_id].append(number)
+    return phones
+
+def _promo(ids):
+    # Same rules as order pricing: PricingSnapshot.limit_for / promo_applies
+    pricing = get_pricing()
+    counts = promo_order_counts(ids)
+    subscribers = {subscriber.id: subscriber for subscriber in Subscriber.query
+                   .options(load_only(Subscriber.promo_custom_limit)).filter(Subscriber.id.in_(ids))}
+    promo = {}
+    for id in ids:
+        subscriber = subscribers.get(id)
+        limit = pricing.limit_for(subscriber)
+        promo[id] = {
+            'is_active': pricing.promo_applies(subscriber, counts[id]),
+            'price': float(pricing.promo_price),
+            'limit': limit,
+            'count': counts[id],
+            'remaining': max(limit - counts[id], 0),
+        }
+    return promo
+
+RESOURCES = {
+    'subscribers': {
+        'model': Subscriber,
+        'columns': {
+            'client_type': Subscriber.client_type,
+            'address': Subscriber.address,
+            'debt': Subscriber.debt,
+            'created_at': Subscriber.created_at,
+            'promo_start_date': Subscriber.promo_start_date,
+            'promo_custom_limit': Subscriber.promo_custom_limit,
+        },
+        'computed': {'phones': _phones, 'promo': _promo},
+        'default': ['client_type', 'address', 'phones'],
+        'filters': {'client_type': Subscriber.client_type},
+    },
+    'orders': {
+        'model': Order,
+        'columns': {
+            'subscriber_id': Order.subscriber_id,
+            'user_id': Order.user_id,
+            'new_bottles': Order.new_bottles,
+            'exchange_bottles': Order.exchange_bottles,
+            'water_only': Order.water_only,
+            'free_bottles': Order.free_bottles,
+            'total_amount': Order.total_amount,
+            'paid_amount': Order.paid_amount,
+            'is_free': Order.is_free,
+            'created_at': Order.created_at,
+        },
+        'computed': {},
+        'default': ['subscriber_id', 'new_bottles', 'exchange_bottles', 'water_only', 'free_bottles',
+                    'total_amount', 'created_at'],
+        'filters': {'subscriber_id': Order.subscriber_id},
+    },
+    'payments': {
+        'model': Payment,
+        'columns': {
+            'subscriber_id': Payment.subscriber_id,
+            'user_id': Payment.user_id,
+            'amount': Payment.amount,
+            'created_at': Payment.created_at,
+        },
+        'computed': {},
+        'default': ['subscriber_id', 'amount', 'created_at'],
+        'filters': {'subscriber_id': Payment.subscriber_id},
+    },
+}
+
+def _json_value(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+def _int_list(text, name):
+    try:
+        return [int(part) for part in text.split(',') if part.strip()]
+    except ValueError:
+        raise ApiError(f'{name} must be comma separated integers')
+
+def _fields(resource):
+    """Requested field names, checked against the resource"""
+    text = request.args.get('fields')
+    if not text:
+        return resource['default']
+    fields = [name.strip() for name in text.split(',') if name.strip() and name.strip() != 'id']
+    unknown = [name for name in fields if name not in resource['columns'] and name not in resource['computed']]
+    if unknown:
+        allowed = ['id'] + list(resource['columns']) + list(resource['computed'])
+        raise ApiError(f"unknown fields: {', '.join(unknown)} (allowed: {', '.join(allowed)})")
+    return list(dict.fromkeys(fields))
+
+def encode_cursor(id):
+    return base64.urlsafe_b64encode(str(id).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        return int(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode())
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ApiError('invalid cursor')
+
+def _items(resource, fields, query):
+    """Run query (already filtered and ordered) for the selected columns and add the computed fields"""
+    model = resource['model']
+    columns = [name for name in fields if name in resource['columns']]
+    query = query.with_only_columns(model.id, *(resource['columns'][name].label(name) for name in columns))
+    items = [{'id': row.id, **{name: _json_value(row._mapping[name]) for name in columns}}
+             for row in db.session.execute(query)]
+    ids = [item['id'] for item in items]
+    for name in fields:
+        if name in resource['computed']:
+            values = resource['computed'][name](ids) if ids else {}
+            for item in items:
+                item[name] = values.get(item['id'])
+    return items
+
+def _list(name):
+    resource = RESOURCES[name]
+    model = resource['model']
+    fields = _fields(resource)
+    query = db.select(model.id)
+
+    if 'ids' in request.args:
+        ids = list(dict.fromkeys(_int_list(request.args['ids'], 'ids')))
+        if len(ids) > MAX_IDS:
+            raise ApiError(f'at most {MAX_IDS} ids')
+        items = {item['id']: item for item in _items(resource, fields, query.where(model.id.in_(ids)))} if ids else {}
+        return jsonify(data=[items[id] for id in ids if id in items],
+                       missing=[id for id in ids if id not in items])
+
+    for param, column in resource['filters'].items():
+        if request.args.get(param):
+            query = query.where(column == request.args[param])
+    limit = request.args.get('limit', API_PAGE, type=int)
+    if not 0 < limit <= MAX_API_PAGE:
+        raise ApiError(f'limit must be between 1 and {MAX_API_PAGE}')
+    if request.args.get('cursor'):
+        query = query.where(model.id < decode_cursor(request.args['cursor']))
+    # One row more than asked for tells whether there is a next page
+    items = _items(resource, fields, query.order_by(model.id.desc()).limit(limit + 1))
+    next_cursor = encode_cursor(items[limit - 1]['id']) if len(items) > limit else None
+    return jsonify(data=items[:limit], next_cursor=next_cursor)
+
+def _item(name, id):
+    resource = RESOURCES[name]
+    items = _items(resource, _fields(resource), db.select(resource['model'].id).where(resource['model'].id == id))
+    if not items:
+        raise ApiError('not found', 404)
+    return jsonify(data=items[0])
+
+@api_bp.route('/subscribers')
+@api_login_required
+@conditional('subscribers', 'phones', 'orders', 'settings', 'prices')
+def subscribers():
+    return _list('subscribers')
+
+@api_bp.route('/subscribers/<int:id>')
+@api_login_required
+@conditional('subscribers', 'phones', 'orders', 'settings', 'prices')
+def subscriber(id):
+    return _item('subscribers', id)
+
+@api_bp.route('/orders')
+@api_login_required
+@conditional('orders')
+def orders():
+    return _list('orders')
+
+@api_bp.route('/orders/<int:id>')
+@api_login_required
+@conditional('orders')
+def order(id):
+    return _item('orders', id)
+
+@api_bp.route('/payments')
+@api_login_required
+@conditional('payments')
+def payments():
+    return _list('payments')
+
+@api_bp.route('/payments/<int:id>')
+@api_login_required
+@conditional('payments')
+def payment(id):
+    return _item('payments', id)
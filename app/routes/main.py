@@ -1,9 +1,43 @@
-from flask import Blueprint, redirect, url_for
+from flask import Blueprint, redirect, request, url_for, jsonify
 from flask_login import login_required
+from sqlalchemy.exc import OperationalError
+from app import db
 
 main_bp = Blueprint('main', __name__)
 
+# SQLite busy timeout, MySQL lock wait timeout (1205) and deadlock (1213)
+LOCK_ERRORS = ('database is locked', 'database table is locked', '(1205', '(1213')
+
+@main_bp.app_errorhandler(OperationalError)
+def database_busy(e):
+    """
+    A lock the request could not get in time: 503 with Retry-After and an
+    X-Lock-Timeout header, so clients (load_test.py) can tell it from other
+    errors. Any other OperationalError stays a 500.
+    """
+    if not any(marker in str(e.orig) for marker in LOCK_ERRORS):
+        raise e
+    db.session.rollback()
+    headers = {'Retry-After': '1', 'X-Lock-Timeout': '1'}
+    if request.accept_mimetypes.best == 'application/json' or request.path.startswith('/api/'):
+        return jsonify(error='Maglumat bazasy meşgul, gaýtadan synanyşyň'), 503, headers
+    return 'Maglumat bazasy meşgul, gaýtadan synanyşyň', 503, headers
+
 @main_bp.route('/')
 @login_required
 def index():
     return redirect(url_for('subscribers.index'))
+
+@main_bp.route('/healthz')
+def healthz():
+    """Liveness: the worker process is serving requests"""
+    return jsonify({'status': 'ok'})
+
+@main_bp.route('/readyz')
+def readyz():
+    """Readiness: the worker can reach the database"""
+    try:
+        db.session.execute(db.text('SELECT 1'))
+    except Exception as e:
+        return jsonify({'status': 'unavailable', 'error': str(e)}), 503
+    return jsonify({'status': 'ready'})
@@ -1,65 +1,83 @@
-from decimal import Decimal
+from decimal import Decimal, InvalidOperation
 from datetime import datetime
 from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify
 from flask_login import login_required, current_user
+from sqlalchemy.exc import IntegrityError
 from app import db
-from app.models import Order, Subscriber, Price, Payment
+from app.models import Order, Subscriber, Payment
 from app.services import log_action
-from app.services.pricing import get_promo_water_price
+from app.services.ledger import recalculate_debts
+from app.services.trash import soft_delete_order, restore
+from app.services.columnar import LIST_WINDOW, list_window, encode_columns
+from app.http_cache import conditional
+from app.services.pricing import get_promo_water_price, get_pricing, promo_order_counts, QUANTITY_OPERATIONS
 
 orders_bp = Blueprint('orders', __name__)
 
-def calculate_order_total(subscriber, new_bottles, exchange_bottles, water_only, free_bottles):
-    """Calculate total based on client type and prices"""
-    prices = {p.operation_type: p for p in Price.query.all()}
-    
-    # Defaults based on new requirements:
-    # Water: 15
-    # Container: 90
-    # New Bottle (Water+Container): 105
-    # Exchange: 50
-    # "Goýup bermek" -> Container Only: 90
-    
-    if subscriber.client_type == 'legal':
-        # Magazinlar prices (Adjust if legal prices differ, for now using same or existing logic if present)
-        # Using existing pattern but updating defaults if missing
-        new_price = prices.get('new_bottle', Price(legal_price=105)).legal_price
-        exchange_price = prices.get('exchange', Price(legal_price=50)).legal_price
-        water_price = prices.get('water_only', Price(legal_price=15)).legal_price
-        container_price = prices.get('container', Price(legal_price=90)).legal_price
+MAX_QUOTE_LINES = 1000
+MAX_SYNC_ITEMS = 500
+
+def _to_int(value):
+    try:
+        return int(value or 0)
+    except (TypeError, ValueError):
+        return 0
+
+def order_quantities(values):
+    """
+    Read order quantities from a form or JSON dict.
+
+    Returns (credit, quantities). Credit fields take precedence when used:
+    gap_bilen is a new bottle, dine_suw is water only.
+    """
+    gap_bilen = _to_int(values.get('gap_bilen'))  # Gap bilen
+    dine_suw = _to_int(values.get('dine_suw'))    # Diňe suw
+    if gap_bilen > 0 or dine_suw > 0:
+        return True, {'new_bottles': gap_bilen, 'exchange_bottles': 0, 'water_only': dine_suw, 'free_bottles': 0}
+    return False, {column: _to_int(values.get(column)) for column in QUANTITY_OPERATIONS}
+
+def _to_decimal(value):
+    if value is None or value == '':
+        return None
+    try:
+        number = Decimal(str(value))
+    except InvalidOperation:
+        return None
+    return number if number.is_finite() else None
+
+def order_amounts(values, total, credit):
+    """Return (total, paid, is_free) after the credit and free order rules"""
+    is_free = values.get('is_free') in ('on', True, 'true', 1)
+    paid_amount = _to_decimal(values.get('paid_amount'))
+    if credit:
+        # Credit implies taking debt, so paid is 0
+        paid = Decimal('0')
+    elif paid_amount is None:
+        # If paid_amount not specified, assume full payment
+        paid = total
     else:
-        # Rayat prices
-        new_price = prices.get('new_bottle', Price(individual_price=105)).individual_price
-        exchange_price = prices.get('exchange', Price(individual_price=50)).individual_price
-        water_price = prices.get('water_only', Price(individual_price=15)).individual_price
-        container_price = prices.get('container', Price(individual_price=90)).individual_price
-    
-    # Check for promo price for water_only
-    # Check for promo price for water_only and others
-    promo_price = get_promo_water_price(subscriber.id)
-    if promo_price is not None:
-        # Calculate discount delta (Standard - Promo)
-        # Assuming Standard is the price we just fetched for water_only? 
-        # Actually, water_price above is the specific price for this client type (15 or 11).
-        # PROMO is fixed at 10.
-        # If Client Type is legal (11 TMT), promo (10) is 1 TMT off.
-        # If Client Type is individual (15 TMT), promo (10) is 5 TMT off.
-        
-        # Apply promo directly to water_only
-        delta = water_price - promo_price
-        
-        # Apply same delta to other water-containing products
-        # Ensure we don't go below 0 or break logic if delta is negative (unlikely unless promo > standard)
-        if delta > 0:
-            water_price = promo_price # Set water to promo
-            new_price = new_price - delta
-            exchange_price = exchange_price - delta
+        paid = paid_amount
 
-    total = (Decimal(new_bottles) * new_price + 
-             Decimal(exchange_bottles) * exchange_price + 
-             Decimal(water_only) * water_price +
-             Decimal(free_bottles) * container_price)
-    return total
+    # Free Order override
+    if is_free:
+        total = Decimal('0')
+        paid = Decimal('0')
+    return total, paid, is_free
+
+def _existing_keys(model, keys):
+    """{client_key: id} of rows already stored for the given keys, soft-deleted ones included"""
+    if not keys:
+        return {}
+    return dict(db.session.query(model.client_key, model.id).execution_options(include_deleted=True)
+                .filter(model.client_key.in_(list(keys))).all())
+
+def calculate_order_total(subscriber, new_bottles, exchange_bottles, water_only, free_bottles):
+    """Calculate total based on client type, prices and promo state"""
+    pricing = get_pricing()
+    promo = get_promo_water_price(subscriber.id) is not None
+    return pricing.quote(subscriber.client_type, promo,
+                         new_bottles=new_bottles, exchange_bottles=exchange_bottles,
+                         water_only=water_only, free_bottles=free_bottles)
 
 def recalculate_debt(subscriber):
     """Recalculate subscriber debt from orders and payments"""
@@ -78,14 +96,7 @@ def recalculate_debt(subscriber):
     subscriber.debt = Decimal(total_orders) - (Decimal(total_order_payments) + Decimal(total_direct_payments))
     db.session.commit()
 
-@orders_bp.route('/')
-@login_required
-def index():
-    search = request.args.get('search', '')
-    search_type = request.args.get('type', 'all')
-    date_from = request.args.get('date_from', '')
-    date_to = request.args.get('date_to', '')
-    
+def _filtered_orders(search, search_type, date_from, date_to):
     query = Order.query.join(Subscriber)
     
     if search:
@@ -105,114 +116,76 @@ def index():
         query = query.filter(Order.created_at >= datetime.strptime(date_from, '%Y-%m-%d'))
     if date_to:
         query = query.filter(Order.created_at <= datetime.strptime(date_to + ' 23:59:59', '%Y-%m-%d %H:%M:%S'))
+    return query
+
+def _order_filters():
+    return (request.args.get('search', ''), request.args.get('type', 'all'),
+            request.args.get('date_from', ''), request.args.get('date_to', ''))
+
+@orders_bp.route('/')
+@login_required
+@conditional('orders', 'subscribers', 'phones', 'prices')
+def index():
+    search, search_type, date_from, date_to = _order_filters()
+    query = _filtered_orders(search, search_type, date_from, date_to)
     
-    orders = query.order_by(Order.id.desc()).all()
-    subscribers = Subscriber.query.order_by(Subscriber.id.desc()).all()
-    prices = {p.operation_type: p for p in Price.query.all()}
-    
-    # Calculate total bottles for each subscriber
-    subscriber_bottles = {}
-    for s in subscribers:
-        total_new = db.session.query(db.func.sum(Order.new_bottles)).filter(
-            Order.subscriber_id == s.id
-        ).scalar() or 0
-        total_exchange = db.session.query(db.func.sum(Order.exchange_bottles)).filter(
-            Order.subscriber_id == s.id
-        ).scalar() or 0
-        total_free = db.session.query(db.func.sum(Order.free_bottles)).filter(
-            Order.subscriber_id == s.id
-        ).scalar() or 0
-        subscriber_bottles[s.id] = total_new + total_exchange + total_free
+    # Only the first window is rendered here, the table loads the rest from list.json as it scrolls.
+    # Subscriber is already joined, load it from the same row instead of one query per order
+    total = query.order_by(None).count()
+    orders = query.options(db.contains_eager(Order.subscriber)).order_by(Order.id.desc()).limit(LIST_WINDOW).all()
     
-    return render_template('orders.html', orders=orders, subscribers=subscribers, prices=prices,
-                          search=search, search_type=search_type, date_from=date_from, date_to=date_to,
-                          subscriber_bottles=subscriber_bottles)
+    return render_template('orders.html', orders=orders, search=search, search_type=search_type,
+                          date_from=date_from, date_to=date_to, total=total)
+
+@orders_bp.route('/list.json')
+@login_required
+@conditional('orders', 'subscribers')
+def list_json():
+    """A window of the orders table as columns (see app.services.columnar)"""
+    offset, limit = list_window()
+    query = _filtered_orders(*_order_filters())
+    total = query.order_by(None).count()
+    rows = query.with_entities(
+        Order.id, Order.subscriber_id, Subscriber.address, Order.new_bottles, Order.exchange_bottles,
+        Order.water_only, Order.free_bottles, Order.is_free, Order.total_amount, Order.created_at
+    ).order_by(Order.id.desc()).offset(offset).limit(limit)
+    data = encode_columns(({
+        'id': row.id,
+        'subscriber_id': row.subscriber_id,
+        'address': row.address,
+        'new_bottles': row.new_bottles,
+        'exchange_bottles': row.exchange_bottles,
+        'water_only': row.water_only,
+        'free_bottles': row.free_bottles,
+        'is_free': 1 if row.is_free else 0,
+        'total': float(row.total_amount or 0),
+        'created_at': row.created_at.strftime('%d.%m.%Y %H:%M') if row.created_at else None,
+    } for row in rows), ['id', 'subscriber_id', 'address', 'new_bottles', 'exchange_bottles', 'water_only',
+                         'free_bottles', 'is_free', 'total', 'created_at'], dictionary=['address'])
+    return jsonify(total=total, offset=offset, **data)
 
 @orders_bp.route('/create', methods=['POST'])
 @login_required
 def create():
     subscriber_id = request.form.get('subscriber_id', type=int)
-    # Standard fields
-    new_bottles = request.form.get('new_bottles', 0, type=int)
-    exchange_bottles = request.form.get('exchange_bottles', 0, type=int)
-    water_only = request.form.get('water_only', 0, type=int)
-    free_bottles = request.form.get('free_bottles', 0, type=int)
+    client_key = request.form.get('client_key') or None
     
-    # Credit fields
-    gap_bilen = request.form.get('gap_bilen', 0, type=int)  # Gap bilen × 105 TMT
-    dine_suw = request.form.get('dine_suw', 0, type=int)    # Diňe suw × 15 TMT
+    subscriber = Subscriber.query.get_or_404(subscriber_id)
     
-    paid_amount = request.form.get('paid_amount', type=float)
-    is_free = request.form.get('is_free') == 'on'
+    # A resubmitted form (double click, browser retry) carries the same key
+    if client_key and _existing_keys(Order, [client_key]):
+        flash('Sargyt eýýäm döredilen', 'success')
+        return redirect(url_for('orders.index'))
     
-    subscriber = Subscriber.query.get_or_404(subscriber_id)
+    # Credit fields (Gap bilen / Diňe suw) are priced by the same engine as standard orders
+    credit, quantities = order_quantities(request.form)
+    new_bottles = quantities['new_bottles']
+    exchange_bottles = quantities['exchange_bottles']
+    water_only = quantities['water_only']
+    free_bottles = quantities['free_bottles']
     
-    # Determine mode: if Credit fields are > 0, use Credit logic
-    # (Check if standard fields are 0 to be safe, or just prioritize Credit?)
-    # Let's check if credit fields are used
-    if gap_bilen > 0 or dine_suw > 0:
-        # Credit Mode: Prices 105/15 (or promo)
-        
-        # Determine water price (15 or 10)
-        water_price = Decimal('15.00')
-        promo_price = get_promo_water_price(subscriber.id)
-        if promo_price is not None:
-            water_price = promo_price
-            # Also apply discount to New Bottle (Gap bilen)
-            # Standard Gap Bilen is 105. 
-            # If promo applies (10 vs 15), delta is 5.
-            # So Gap Bilen becomes 100.
-            # But wait, credit mode logic below calculates total manually:
-            # total = Decimal(gap_bilen * 105 + dine_suw * water_price)
-            # We need to adjust the 105 constant too if promo active.
-            pass # Logic handled below
-            
-        # Calculate totals with potential promo
-        gap_bilen_price = Decimal('105.00')
-        if promo_price is not None:
-             # Apply 5 TMT discount to new bottle too (105 -> 100)
-             # Assumption: Standard water is 15. Promo is 10. Delta 5.
-             gap_bilen_price = Decimal('100.00')
-             
-        total = Decimal(gap_bilen) * gap_bilen_price + Decimal(dine_suw) * water_price
-        # Map credit fields to db fields
-        # gap_bilen -> new_bottles (assuming buying bottle)
-        # dine_suw -> exchange_bottles (assuming just water)
-        # But wait, standard logic:
-        # new_bottles = bottle + water
-        # exchange_bottles = just water (but bringing bottle)
-        # water_only = just water (no bottle exchange?) - DB says water_only price 15(ind)/11(leg).
-        # exchange price: 65(ind)/61(leg).
-        # Ah, "Dine suw x 15" implies standard water price.
-        # "Gap bilen x 105" implies standard new bottle price.
-        
-        # Override counts for DB
-        new_bottles = gap_bilen
-        # dine_suw (15 TMT) maps to water_only price (15 TMT). 
-        # But 'exchange_bottles' usually costs 65 TMT (includes service/exchange?).
-        # 'water_only' price is 15 TMT. So dine_suw -> water_only.
-        water_only = dine_suw
-        # Reset others
-        exchange_bottles = 0
-        free_bottles = 0
-        
-        # Credit implies taking debt, so paid is 0
-        paid = Decimal('0')
-        
-    else:
-        # Standard Mode
-        total = calculate_order_total(subscriber, new_bottles, exchange_bottles, water_only, free_bottles)
-        
-        # If paid_amount not specified, assume full payment
-        if paid_amount is None:
-            paid = Decimal(str(float(total)))
-        else:
-            paid = Decimal(str(paid_amount))
-
-    # Free Order override
-    if is_free:
-        total = Decimal('0')
-        paid = Decimal('0')
+    total = calculate_order_total(subscriber, new_bottles, exchange_bottles, water_only, free_bottles)
+    total, paid, is_free = order_amounts(request.form, total, credit)
     
     order = Order(
         subscriber_id=subscriber_id,
@@ -223,10 +196,17 @@ def create():
         free_bottles=free_bottles,
         total_amount=total,
         paid_amount=paid,
-        is_free=is_free
+        is_free=is_free,
+        client_key=client_key
     )
     db.session.add(order)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # The other submit with this key won the race
+        db.session.rollback()
+        flash('Sargyt eýýäm döredilen', 'success')
+        return redirect(url_for('orders.index'))
     
     recalculate_debt(subscriber)
     log_action('CREATE', 'order', order.id, {
@@ -242,35 +222,120 @@ def create():
     flash('Sargyt döredildi', 'success')
     return redirect(url_for('orders.index'))
 
+@orders_bp.route('/quote', methods=['POST'])
+@login_required
+def quote():
+    """
+    Price many order lines in one call.
+
+    Each line has the order quantities (or credit fields) and either a
+    subscriber_id (client type and promo state are looked up) or a
+    client_type with an optional promo flag. Lines are quoted independently.
+    """
+    data = request.get_json(silent=True) or {}
+    lines = data.get('lines')
+    if not isinstance(lines, list) or len(lines) > MAX_QUOTE_LINES:
+        return jsonify({'error': f'lines must be a list of at most {MAX_QUOTE_LINES} items'}), 400
+    
+    pricing = get_pricing()
+    subscriber_ids = {_to_int(line.get('subscriber_id')) for line in lines if isinstance(line, dict)} - {0}
+    subscribers = {s.id: s for s in Subscriber.query.filter(Subscriber.id.in_(subscriber_ids))} if subscriber_ids else {}
+    counts = promo_order_counts(list(subscribers))
+    
+    results = []
+    grand_total = Decimal('0')
+    for line in lines:
+        if not isinstance(line, dict):
+            results.append({'error': 'Invalid line'})
+            continue
+        
+        subscriber_id = _to_int(line.get('subscriber_id'))
+        if subscriber_id:
+            subscriber = subscribers.get(subscriber_id)
+            if not subscriber:
+                results.append({'subscriber_id': subscriber_id, 'error': 'Not found'})
+                continue
+            client_type = subscriber.client_type
+            promo = pricing.promo_applies(subscriber, counts[subscriber_id])
+        else:
+            client_type = line.get('client_type', 'individual')
+            promo = bool(line.get('promo')) and pricing.promo_active
+        
+        credit, quantities = order_quantities(line)
+        is_free = bool(line.get('is_free'))
+        total = Decimal('0') if is_free else pricing.quote(client_type, promo, **quantities)
+        grand_total += total
+        
+        results.append({
+            'subscriber_id': subscriber_id or None,
+            'client_type': client_type,
+            'promo': promo,
+            'credit': credit,
+            'is_free': is_free,
+            'quantities': quantities,
+            'unit_prices': {op: float(price) for op, price in pricing.unit_prices(client_type, promo).items()},
+            'total': float(total)
+        })
+    
+    return jsonify({
+        'version': pricing.version,
+        'lines': results,
+        'total': float(grand_total)
+    })
+
 @orders_bp.route('/<int:id>/delete', methods=['POST'])
 @login_required
 def delete(id):
     order = Order.query.get_or_404(id)
     subscriber = order.subscriber
-    db.session.delete(order)
+    soft_delete_order(order)
     db.session.commit()
     recalculate_debt(subscriber)
     log_action('DELETE', 'order', id)
     flash('Sargyt öçürildi', 'success')
     return redirect(url_for('orders.index'))
 
+@orders_bp.route('/<int:id>/restore', methods=['POST'])
+@login_required
+def restore_order(id):
+    order = restore(Order, id)
+    if order is None:
+        flash('Sargyt tapylmady, eýýäm arassalanan bolmagy mümkin', 'error')
+        return redirect(url_for('subscribers.trash'))
+    recalculate_debts([order.subscriber_id])
+    db.session.commit()
+    log_action('RESTORE', 'order', id)
+    flash('Sargyt dikeldildi', 'success')
+    return redirect(url_for('orders.index'))
+
 @orders_bp.route('/payment', methods=['POST'])
 @login_required
 def add_payment():
     subscriber_id = request.form.get('subscriber_id', type=int)
     amount = request.form.get('amount', type=float)
+    client_key = request.form.get('client_key') or None
     
     if current_user.role not in ['admin', 'accountant']:
         flash('Diňe hasapçy töleg kabul edip bilýär!', 'danger')
         return redirect(url_for('subscribers.index'))
 
+    if client_key and _existing_keys(Payment, [client_key]):
+        flash('Töleg eýýäm goşulan', 'success')
+        return redirect(url_for('subscribers.index'))
+
     payment = Payment(
         subscriber_id=subscriber_id,
         user_id=current_user.id,
-        amount=Decimal(str(amount))
+        amount=Decimal(str(amount)),
+        client_key=client_key
     )
     db.session.add(payment)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        flash('Töleg eýýäm goşulan', 'success')
+        return redirect(url_for('subscribers.index'))
     
     subscriber = Subscriber.query.get(subscriber_id)
     recalculate_debt(subscriber)
@@ -278,3 +343,118 @@ def add_payment():
     
     flash('Töleg goşuldy', 'success')
     return redirect(url_for('subscribers.index'))
+
+def _captured_at(value, now):
+    # Capture time from the device in ms since epoch, never in the future
+    try:
+        captured = datetime.fromtimestamp(float(value) / 1000)
+    except (TypeError, ValueError, OverflowError, OSError):
+        return now
+    return min(captured, now)
+
+def _apply_sync(items):
+    """Apply a sync batch in the current transaction and return the per-item results"""
+    now = datetime.now()
+    pricing = get_pricing()
+    keys = {item.get('key') for item in items if isinstance(item, dict) and isinstance(item.get('key'), str)}
+    stored = {'order': _existing_keys(Order, keys), 'payment': _existing_keys(Payment, keys)}
+    subscriber_ids = {_to_int(item.get('subscriber_id')) for item in items if isinstance(item, dict)} - {0}
+    subscribers = {s.id: s for s in Subscriber.query.filter(Subscriber.id.in_(subscriber_ids))} if subscriber_ids else {}
+    counts = promo_order_counts(list(subscribers))
+    can_take_payments = current_user.role in ['admin', 'accountant']
+    
+    results = []
+    created = []  # (result, row) pairs, ids are known after the flush
+    seen = set()
+    for item in items:
+        if not isinstance(item, dict):
+            results.append({'key': None, 'status': 'error', 'error': 'Invalid item'})
+            continue
+        key = item.get('key')
+        kind = item.get('type')
+        result = {'key': key, 'type': kind}
+        results.append(result)
+        
+        if not isinstance(key, str) or not 0 < len(key) <= 64:
+            result.update(status='error', error='Invalid key')
+            continue
+        if kind not in stored:
+            result.update(status='error', error='Invalid type')
+            continue
+        if key in stored['order'] or key in stored['payment']:
+            result.update(status='duplicate', id=stored['order'].get(key) or stored['payment'].get(key))
+            continue
+        if key in seen:
+            result.update(status='duplicate')
+            continue
+        subscriber = subscribers.get(_to_int(item.get('subscriber_id')))
+        if subscriber is None:
+            result.update(status='error', error='Müşderi tapylmady')
+            continue
+        
+        created_at = _captured_at(item.get('captured_at'), now)
+        if kind == 'order':
+            credit, quantities = order_quantities(item)
+            promo = pricing.promo_applies(subscriber, counts[subscriber.id])
+            total, paid, is_free = order_amounts(item, pricing.quote(subscriber.client_type, promo, **quantities), credit)
+            row = Order(subscriber_id=subscriber.id, user_id=current_user.id, total_amount=total,
+                        paid_amount=paid, is_free=is_free, created_at=created_at, client_key=key, **quantities)
+            counts[subscriber.id] += 1
+            result.update(total=float(total), paid=float(paid))
+        else:
+            amount = _to_decimal(item.get('amount'))
+            if not can_take_payments:
+                result.update(status='error', error='Diňe hasapçy töleg kabul edip bilýär!')
+                continue
+            if amount is None or amount <= 0:
+                result.update(status='error', error='Invalid amount')
+                continue
+            row = Payment(subscriber_id=subscriber.id, user_id=current_user.id, amount=amount,
+                          created_at=created_at, client_key=key)
+            result.update(amount=float(amount))
+        
+        seen.add(key)
+        db.session.add(row)
+        created.append((result, row))
+        result.update(status='created', subscriber_id=subscriber.id)
+    
+    db.session.flush()
+    for result, row in created:
+        result['id'] = row.id
+    touched = {row.subscriber_id for _, row in created}
+    recalculate_debts(touched)
+    
+    summary = {status: sum(1 for r in results if r['status'] == status) for status in ('created', 'duplicate', 'error')}
+    # log_action commits the batch together with its audit entry
+    if created:
+        log_action('SYNC', 'order', None, dict(summary, subscribers=len(touched)))
+    else:
+        db.session.commit()
+    return results, summary
+
+@orders_bp.route('/sync', methods=['POST'])
+@login_required
+def sync():
+    """
+    Apply orders and payments captured offline.
+
+    Every item carries a client-generated key. Items whose key is already
+    stored are reported as duplicates, so a batch can be resent safely
+    after a lost response. The batch is applied in one transaction.
+    """
+    data = request.get_json(silent=True) or {}
+    items = data.get('items')
+    if not isinstance(items, list) or len(items) > MAX_SYNC_ITEMS:
+        return jsonify({'error': f'items must be a list of at most {MAX_SYNC_ITEMS} items'}), 400
+    
+    for attempt in range(2):
+        try:
+            results, summary = _apply_sync(items)
+            break
+        except IntegrityError:
+            # A concurrent request stored one of the keys first, the retry reports it as a duplicate
+            db.session.rollback()
+            if attempt:
+                raise
+    
+    return jsonify(dict(summary, results=results))
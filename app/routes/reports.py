@@ -0,0 +1,141 @@
+import csv
+import io
+from datetime import datetime, timedelta
+from decimal import Decimal
+from functools import wraps
+from flask import Blueprint, request, redirect, url_for, flash, Response, stream_template, stream_with_context
+from flask_login import login_required, current_user
+from app.depots import fan_out, iter_all_depots
+from app.services.aging import AGING_BUCKETS, iter_aging
+from app.services.pricing import get_pricing
+from app.services.promo import iter_promo_eligibility, promo_summary
+from app.services.refills import iter_due_refills
+
+reports_bp = Blueprint('reports', __name__)
+
+def accountant_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not current_user.is_authenticated or current_user.role not in ['admin', 'accountant']:
+            flash('Diňe hasapçy üçin', 'error')
+            return redirect(url_for('main.index'))
+        return f(*args, **kwargs)
+    return decorated_function
+
+def _all_depots():
+    """?depot=all merges the report over every depot"""
+    return request.args.get('depot') == 'all'
+
+def _aging_rows(client_type, totals=None):
+    if not _all_depots():
+        return iter_aging(client_type, totals=totals)
+
+    def merged():
+        keys = [key for key, _, _ in AGING_BUCKETS] + ['total']
+        if totals is not None:
+            totals.update({key: Decimal('0.00') for key in keys}, count=0)
+        # Each depot streams largest debts first, merge keeps that order
+        for row in iter_all_depots(iter_aging, client_type, key=lambda row: -row['total']):
+            if totals is not None:
+                for key in keys:
+                    totals[key] += row[key]
+                totals['count'] += 1
+            yield row
+    return merged()
+
+def _merge_promo_summaries(summaries):
+    merged = dict(summaries[0])
+    for key in ('subscribers', 'eligible', 'exhausted', 'remaining_orders'):
+        merged[key] = sum(summary[key] for summary in summaries)
+    return merged
+
+@reports_bp.route('/aging')
+@login_required
+@accountant_required
+def aging():
+    client_type = request.args.get('client_type', '')
+    totals = {}
+    return Response(stream_with_context(stream_template(
+        'reports/aging.html',
+        rows=_aging_rows(client_type or None, totals=totals),
+        totals=totals,
+        buckets=AGING_BUCKETS,
+        client_type=client_type,
+        all_depots=_all_depots()
+    )))
+
+@reports_bp.route('/aging.csv')
+@login_required
+@accountant_required
+def aging_csv():
+    client_type = request.args.get('client_type', '')
+    columns = ['id', 'client_type', 'address'] + [key for key, _, _ in AGING_BUCKETS] + ['total']
+    if _all_depots():
+        columns.insert(0, 'depot')
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        for row in _aging_rows(client_type or None):
+            writer.writerow([row[c] for c in columns])
+            if buffer.tell() > 8192:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate(0)
+        yield buffer.getvalue()
+
+    return Response(stream_with_context(generate()), mimetype='text/csv', headers={
+        'Content-Disposition': 'attachment; filename=aging.csv'
+    })
+
+@reports_bp.route('/promo')
+@login_required
+@accountant_required
+def promo():
+    client_type = request.args.get('client_type', '')
+    status = request.args.get('status', '')
+    pricing = get_pricing()
+    if _all_depots():
+        summary = _merge_promo_summaries(list(fan_out(promo_summary, client_type or None, pricing).values()))
+        rows = iter_all_depots(iter_promo_eligibility, client_type or None, status or None, pricing)
+    else:
+        summary = promo_summary(client_type or None, pricing)
+        rows = iter_promo_eligibility(client_type or None, status or None, pricing)
+    return Response(stream_with_context(stream_template(
+        'reports/promo.html',
+        summary=summary,
+        rows=rows,
+        client_type=client_type,
+        status=status,
+        all_depots=_all_depots()
+    )))
+
+def _date_arg(name):
+    try:
+        return datetime.strptime(request.args.get(name, ''), '%Y-%m-%d')
+    except ValueError:
+        return None
+
+@reports_bp.route('/refills')
+@login_required
+def refills():
+    """Subscribers expected to need water by a date (operators call them)"""
+    client_type = request.args.get('client_type', '')
+    until = _date_arg('until') or datetime.combine(datetime.now().date(), datetime.min.time())
+    since = _date_arg('since')
+    # The until day is included
+    args = (until + timedelta(days=1), since, client_type or None)
+    if _all_depots():
+        rows = iter_all_depots(iter_due_refills, *args, key=lambda row: row['due_at'])
+    else:
+        rows = iter_due_refills(*args)
+    return Response(stream_with_context(stream_template(
+        'reports/refills.html',
+        rows=rows,
+        until=until.strftime('%Y-%m-%d'),
+        since=since.strftime('%Y-%m-%d') if since else '',
+        today=datetime.now(),
+        client_type=client_type,
+        all_depots=_all_depots()
+    )))
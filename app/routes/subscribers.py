@@ -1,19 +1,22 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify
+import csv
+import io
+import json
+from datetime import timedelta
+from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, Response, stream_template, stream_with_context, current_app
 from flask_login import login_required, current_user
 from app import db
-from app.models import Subscriber, Phone, Order, Payment
+from app.models import Subscriber, Phone, Order
 from app.services import log_action
+from app.services.ledger import recalculate_debts
+from app.services.statement import iter_statement, STATEMENT_COLUMNS
+from app.services.columnar import LIST_WINDOW, list_window, encode_columns
+from app.services.trash import soft_delete_subscriber, deleted_query, restore
+from app.http_cache import conditional
 
 subscribers_bp = Blueprint('subscribers', __name__)
 
-@subscribers_bp.route('/')
-@login_required
-def index():
-    search = request.args.get('search', '')
-    search_type = request.args.get('type', 'phone')  # phone, name, address, all
-    
+def _filtered_subscribers(search, search_type):
     query = Subscriber.query
-    
     if search:
         if search_type == 'phone':
             query = query.join(Phone).filter(Phone.number.ilike(f'%{search}%'))
@@ -26,25 +29,55 @@ def index():
                     Subscriber.address.ilike(f'%{search}%')
                 )
             ).distinct()
+    return query
+
+def _phones_of(ids):
+    """{subscriber id: 'phone, phone'} in one query"""
+    phones = {}
+    for subscriber_id, number in db.session.query(Phone.subscriber_id, Phone.number) \
+            .filter(Phone.subscriber_id.in_(ids)).order_by(Phone.id):
+        phones.setdefault(subscriber_id, []).append(number)
+    return {k: ', '.join(v) for k, v in phones.items()}
+
+@subscribers_bp.route('/')
+@login_required
+@conditional('subscribers', 'phones', 'orders', 'payments')
+def index():
+    search = request.args.get('search', '')
+    search_type = request.args.get('type', 'phone')  # phone, name, address, all
     
-    subscribers = query.order_by(Subscriber.id.desc()).all()
+    # Only the first window is rendered here, the table loads the rest from list.json as it scrolls
+    query = _filtered_subscribers(search, search_type)
+    total = query.order_by(None).count()
+    subscribers = query.order_by(Subscriber.id.desc()).limit(LIST_WINDOW).all()
     
-    # Calculate credit for each subscriber (total_amount - paid_amount from all orders)
-    subscriber_credits = {}
-    for s in subscribers:
-        total_orders = db.session.query(db.func.sum(Order.total_amount)).filter(
-            Order.subscriber_id == s.id
-        ).scalar() or 0
-        total_order_paid = db.session.query(db.func.sum(Order.paid_amount)).filter(
-            Order.subscriber_id == s.id
-        ).scalar() or 0
-        total_direct_paid = db.session.query(db.func.sum(Payment.amount)).filter(
-            Payment.subscriber_id == s.id
-        ).scalar() or 0
-        subscriber_credits[s.id] = float(total_orders) - (float(total_order_paid) + float(total_direct_paid))
+    # Phones for the listed subscribers in one query (row fragments are keyed on them)
+    subscriber_phones = _phones_of([s.id for s in subscribers])
     
     return render_template('subscribers.html', subscribers=subscribers, search=search, 
-                          search_type=search_type, subscriber_credits=subscriber_credits)
+                          search_type=search_type, subscriber_phones=subscriber_phones, total=total)
+
+@subscribers_bp.route('/list.json')
+@login_required
+@conditional('subscribers', 'phones')
+def list_json():
+    """A window of the subscribers table as columns (see app.services.columnar)"""
+    offset, limit = list_window()
+    query = _filtered_subscribers(request.args.get('search', ''), request.args.get('type', 'phone'))
+    total = query.order_by(None).count()
+    subscribers = query.order_by(Subscriber.id.desc()).offset(offset).limit(limit).all()
+    phones = _phones_of([s.id for s in subscribers])
+    rows = ({
+        'id': s.id,
+        'client_type': s.client_type,
+        'address': s.address,
+        'phones': phones.get(s.id, ''),
+        'debt': float(s.debt or 0),
+        'promo_start': s.promo_start_date.strftime('%Y-%m-%d') if s.promo_start_date else None,
+    } for s in subscribers)
+    data = encode_columns(rows, ['id', 'client_type', 'address', 'phones', 'debt', 'promo_start'],
+                          dictionary=['client_type'])
+    return jsonify(total=total, offset=offset, **data)
 
 @subscribers_bp.route('/create', methods=['POST'])
 @login_required
@@ -120,40 +153,52 @@ def edit(id):
 def delete(id):
     subscriber = Subscriber.query.get_or_404(id)
     
-    # Delete all associated orders first
-    orders_deleted = Order.query.filter_by(subscriber_id=id).delete()
-    
-    # Delete all associated payments
-    payments_deleted = Payment.query.filter_by(subscriber_id=id).delete()
-    
-    db.session.delete(subscriber)
+    # Only the subscriber row is marked, orders and payments are purged later in the background
+    soft_delete_subscriber(subscriber)
     db.session.commit()
-    log_action('DELETE', 'subscriber', id, {
-        'orders_deleted': orders_deleted,
-        'payments_deleted': payments_deleted
-    })
-    flash('Müşderi öçürildi', 'success')
+    log_action('DELETE', 'subscriber', id, {'address': subscriber.address})
+    flash(f"Müşderi öçürildi, {current_app.config['PURGE_AFTER_HOURS']} sagadyň dowamynda dikeldip bolýar", 'success')
+    return redirect(url_for('subscribers.index'))
+
+@subscribers_bp.route('/trash')
+@login_required
+def trash():
+    """Deleted subscribers and orders that can still be restored"""
+    subscribers = deleted_query(Subscriber).limit(200).all()
+    orders = deleted_query(Order).limit(200).all()
+    return render_template('trash.html', subscribers=subscribers, orders=orders,
+                           purge_after=timedelta(hours=current_app.config['PURGE_AFTER_HOURS']))
+
+@subscribers_bp.route('/<int:id>/restore', methods=['POST'])
+@login_required
+def restore_subscriber(id):
+    subscriber = restore(Subscriber, id)
+    if subscriber is None:
+        flash('Müşderi tapylmady, eýýäm arassalanan bolmagy mümkin', 'error')
+        return redirect(url_for('subscribers.trash'))
+    recalculate_debts([id])
+    db.session.commit()
+    log_action('RESTORE', 'subscriber', id)
+    flash('Müşderi dikeldildi', 'success')
     return redirect(url_for('subscribers.index'))
 
 @subscribers_bp.route('/<int:id>/json')
 @login_required
+@conditional('subscribers', 'phones', 'orders', 'settings', 'prices')
 def get_json(id):
     subscriber = Subscriber.query.get_or_404(id)
     if not subscriber:
         return jsonify({'error': 'Not found'}), 404
     
     # Check promo status
-    from app.services.pricing import get_promo_water_price
-    from app.models import Settings, Order
+    from app.services.pricing import get_promo_water_price, get_pricing, promo_order_counts
     
     promo_price = get_promo_water_price(id)
     is_promo = promo_price is not None
     
-    # Get limit for display
-    promo_limit_setting = Settings.query.get('promo_water_limit')
-    limit = int(promo_limit_setting.value) if promo_limit_setting else 10
-    
-    order_count = Order.query.filter_by(subscriber_id=id).count()
+    # Get limit and counted orders for display (same rules as pricing)
+    limit = get_pricing().limit_for(subscriber)
+    order_count = promo_order_counts([id])[id]
 
     return jsonify({
         'id': subscriber.id,
@@ -168,3 +213,53 @@ def get_json(id):
             'count': order_count
         }
     })
+
+@subscribers_bp.route('/<int:id>/statement')
+@login_required
+@conditional('subscribers', 'orders', 'payments')
+def statement(id):
+    subscriber = Subscriber.query.get_or_404(id)
+    return Response(stream_with_context(
+        stream_template('statement.html', subscriber=subscriber, rows=iter_statement(id))
+    ))
+
+@subscribers_bp.route('/<int:id>/statement.json')
+@login_required
+@conditional('subscribers', 'orders', 'payments')
+def statement_json(id):
+    subscriber = Subscriber.query.get_or_404(id)
+
+    def generate():
+        yield '{"subscriber_id": %d, "rows": [' % subscriber.id
+        for i, row in enumerate(iter_statement(id)):
+            row['created_at'] = row['created_at'].isoformat() if row['created_at'] else None
+            for key in ('debit', 'credit', 'balance'):
+                row[key] = float(row[key])
+            yield (',' if i else '') + json.dumps(row, ensure_ascii=False)
+        yield ']}'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+@subscribers_bp.route('/<int:id>/statement.csv')
+@login_required
+@conditional('subscribers', 'orders', 'payments')
+def statement_csv(id):
+    subscriber = Subscriber.query.get_or_404(id)
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(STATEMENT_COLUMNS)
+        for row in iter_statement(id):
+            row['created_at'] = row['created_at'].strftime('%Y-%m-%d %H:%M:%S') if row['created_at'] else ''
+            writer.writerow([row[c] for c in STATEMENT_COLUMNS])
+            # Send in ~8KB chunks instead of building the whole file in memory
+            if buffer.tell() > 8192:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate(0)
+        yield buffer.getvalue()
+
+    return Response(stream_with_context(generate()), mimetype='text/csv', headers={
+        'Content-Disposition': f'attachment; filename=statement_{subscriber.id}.csv'
+    })
@@ -0,0 +1,253 @@
+"""
+Background job scheduler.
+
+Jobs are registered with a Cron or Interval trigger. Every process that
+runs the scheduler (web workers with SCHEDULER_ENABLED, see
+start_scheduler, or the `flask jobs worker` command) checks for due jobs every
+SCHEDULER_POLL_INTERVAL seconds. The row in scheduled_jobs is the lock:
+a process runs a job only if its UPDATE claims the row, so each
+occurrence runs once no matter how many processes are polling. Every run
+is recorded in job_runs with its duration.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError, OperationalError, ProgrammingError
+from app import db
+from app.models import ScheduledJob, JobRun
+
+logger = logging.getLogger('sarwan.scheduler')
+
+class Interval:
+    def __init__(self, seconds=0, minutes=0, hours=0):
+        self.delta = timedelta(seconds=seconds, minutes=minutes, hours=hours)
+
+    def next_after(self, dt):
+        return dt + self.delta
+
+    def __str__(self):
+        return f'every {int(self.delta.total_seconds())}s'
+
+class Cron:
+    """Five-field cron expression: minute hour day-of-month month day-of-week (0 = Sunday)"""
+
+    RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 6)]
+
+    def __init__(self, expression):
+        self.expression = expression
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f'Cron expression needs 5 fields: {expression!r}')
+        self.minutes, self.hours, self.days, self.months, self.weekdays = [
+            self._parse(field, low, high) for field, (low, high) in zip(fields, self.RANGES)
+        ]
+        # As in cron, a restricted day-of-month and day-of-week match either one
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    @staticmethod
+    def _parse(field, low, high):
+        values = set()
+        for part in field.split(','):
+            part, _, step = part.partition('/')
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start, end = map(int, part.split('-'))
+            else:
+                start = end = int(part)
+            if step and part != '*' and '-' not in part:
+                end = high
+            if start < low or end > high:
+                raise ValueError(f'Cron value out of range: {field!r}')
+            values.update(range(start, end + 1, int(step or 1)))
+        return values
+
+    def _day_matches(self, dt):
+        day_ok = dt.day in self.days
+        weekday_ok = (dt.isoweekday() % 7) in self.weekdays
+        if self.any_day:
+            return weekday_ok
+        if self.any_weekday:
+            return day_ok
+        return day_ok or weekday_ok
+
+    def next_after(self, dt):
+        dt = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = dt + timedelta(days=366 * 5)
+        while dt < limit:
+            if dt.month not in self.months:
+                dt = (dt.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(dt):
+                dt = dt.replace(hour=0, minute=0) + timedelta(days=1)
+            elif dt.hour not in self.hours:
+                dt = dt.replace(minute=0) + timedelta(hours=1)
+            elif dt.minute not in self.minutes:
+                dt += timedelta(minutes=1)
+            else:
+                return dt
+        raise ValueError(f'Cron expression never matches: {self.expression!r}')
+
+    def __str__(self):
+        return self.expression
+
+class Job:
+    def __init__(self, name, func, trigger, timeout=3600, description=None):
+        self.name = name
+        self.func = func
+        self.trigger = trigger
+        self.timeout = timeout
+        self.description = description or (func.__doc__ or '').strip().split('\n')[0]
+
+class Scheduler:
+    def __init__(self, app):
+        self.app = app
+        self.jobs = {}
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add_job(self, name, func, trigger, timeout=3600, description=None):
+        self.jobs[name] = Job(name, func, trigger, timeout, description)
+
+    def job(self, name, trigger, timeout=3600):
+        """Decorator form of add_job"""
+        def decorator(f):
+            self.add_job(name, f, trigger, timeout)
+            return f
+        return decorator
+
+    # Locking (runs on its own connection, independent of db.session)
+
+    def _acquire(self, job, now, scheduled):
+        table = ScheduledJob.__table__
+        with db.engine.begin() as conn:
+            condition = (table.c.name == job.name) & or_(table.c.locked_until.is_(None), table.c.locked_until < now)
+            if scheduled:
+                condition &= table.c.next_run_at <= now
+            result = conn.execute(table.update().where(condition).values(
+                locked_by=self.owner, locked_until=now + timedelta(seconds=job.timeout)
+            ))
+            return result.rowcount == 1
+
+    def _release(self, job, status, finished, scheduled):
+        table = ScheduledJob.__table__
+        values = {'locked_by': None, 'locked_until': None, 'last_run_at': finished, 'last_status': status}
+        if scheduled:
+            values['next_run_at'] = job.trigger.next_after(finished)
+        with db.engine.begin() as conn:
+            conn.execute(table.update().where(table.c.name == job.name).values(**values))
+
+    def _ensure_rows(self, now):
+        table = ScheduledJob.__table__
+        with db.engine.begin() as conn:
+            existing = {row.name for row in conn.execute(table.select().with_only_columns(table.c.name))}
+        for job in self.jobs.values():
+            if job.name in existing:
+                continue
+            try:
+                with db.engine.begin() as conn:
+                    conn.execute(table.insert().values(name=job.name, next_run_at=job.trigger.next_after(now)))
+            except IntegrityError:
+                pass  # another process inserted it first
+
+    # Running
+
+    def run_job(self, name, trigger='manual'):
+        """
+        Run a job now if no other process holds its lock. Returns the JobRun,
+        or None when the job is locked (or, for scheduled runs, not due).
+        """
+        job = self.jobs[name]
+        scheduled = trigger == 'schedule'
+        now = datetime.now()
+        self._ensure_rows(now)
+        if not self._acquire(job, now, scheduled):
+            return None
+
+        started = time.perf_counter()
+        status, message = 'ok', None
+        try:
+            result = job.func()
+            message = None if result is None else str(result)
+        except Exception:
+            db.session.rollback()
+            status, message = 'error', traceback.format_exc(limit=5)
+            logger.exception('Job %s failed', name)
+        finally:
+            duration_ms = int((time.perf_counter() - started) * 1000)
+            finished = datetime.now()
+            self._release(job, status, finished, scheduled)
+
+        run = JobRun(name=name, trigger=trigger, status=status, started_at=now,
+                     duration_ms=duration_ms, owner=self.owner, message=message)
+        db.session.add(run)
+        db.session.commit()
+        # Callers read the run after later jobs may have reset the session
+        db.session.refresh(run)
+        db.session.expunge(run)
+        logger.info('Job %s %s in %dms%s', name, status, duration_ms, f': {message}' if message and status == 'ok' else '')
+        return run
+
+    def run_pending(self):
+        """Run every job that is due, returns the JobRuns"""
+        now = datetime.now()
+        self._ensure_rows(now)
+        due = db.session.query(ScheduledJob.name).filter(
+            ScheduledJob.next_run_at <= now,
+            ScheduledJob.name.in_(list(self.jobs))
+        ).all()
+        db.session.rollback()  # don't hold a read transaction while jobs run
+        runs = []
+        for (name,) in due:
+            run = self.run_job(name, trigger='schedule')
+            if run is not None:
+                runs.append(run)
+        return runs
+
+    def run_forever(self):
+        interval = self.app.config['SCHEDULER_POLL_INTERVAL']
+        logger.info('Scheduler started in %s with %d jobs', self.owner, len(self.jobs))
+        while not self._stop.is_set():
+            with self.app.app_context():
+                try:
+                    self.run_pending()
+                except (OperationalError, ProgrammingError) as e:
+                    # Tables missing (run upgrade_schema) or database busy, try again later
+                    logger.warning('Scheduler poll failed: %s', e)
+                finally:
+                    db.session.remove()
+            self._stop.wait(interval)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run_forever, name='scheduler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+def init_scheduler(app):
+    app.config.setdefault('SCHEDULER_ENABLED', False)
+    app.config.setdefault('SCHEDULER_POLL_INTERVAL', 30)
+
+    scheduler = Scheduler(app)
+    app.extensions['scheduler'] = scheduler
+
+    from app.services.maintenance import register_jobs
+    register_jobs(scheduler, app)
+    return scheduler
+
+def start_scheduler(app):
+    """
+    Poll for due jobs in a thread of this web worker if SCHEDULER_ENABLED.
+    Called by the server entry points only, never by CLI commands (a
+    restore must not run next to jobs, `flask jobs worker` polls itself).
+    """
+    if app.config['SCHEDULER_ENABLED'] and not app.config.get('TESTING'):
+        app.extensions['scheduler'].start()
@@ -0,0 +1,52 @@
+from sqlalchemy import MetaData, inspect, text
+from app import db
+from app.depots import DEPOT_TABLES, depot_names, depot_engine
+
+def _depot_copy(tables):
+    """Copies of the depot tables without foreign keys to shared tables, which live in another database"""
+    metadata = MetaData()
+    copies = [table.to_metadata(metadata) for table in tables]
+    for table in copies:
+        for constraint in list(table.foreign_key_constraints):
+            if constraint.elements[0].target_fullname.split('.')[0] not in DEPOT_TABLES:
+                table.constraints.discard(constraint)
+                for element in constraint.elements:
+                    element.parent.foreign_keys.discard(element)
+                    table.foreign_keys.discard(element)
+    return copies
+
+def _upgrade(engine, tables):
+    tables[0].metadata.create_all(engine, tables=tables)
+    inspector = inspect(engine)
+    quote = engine.dialect.identifier_preparer.quote
+    with engine.begin() as conn:
+        for table in tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    conn.execute(text(f'ALTER TABLE {quote(table.name)} ADD COLUMN {quote(column.name)} {column_type}'))
+    for table in tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+def upgrade_schema():
+    """
+    Create missing tables, columns and indexes.
+
+    db.create_all() only creates indexes together with new tables, so
+    indexes added to existing models are created here one by one. New
+    columns on existing tables are added as nullable columns.
+
+    Shared tables go to the main database, depot tables to every depot
+    database, and table_versions and outbox_events to both.
+    """
+    tables = db.metadata.sorted_tables
+    shared = [table for table in tables if table.name not in DEPOT_TABLES]
+    main = db.engine
+    depot_engines = {depot_engine(name) for name in depot_names()}
+    _upgrade(main, tables if main in depot_engines else shared)
+
+    depot_tables = [table for table in tables if table.name in DEPOT_TABLES or table.name in ('table_versions', 'outbox_events')]
+    for engine in depot_engines - {main}:
+        _upgrade(engine, _depot_copy(depot_tables))
@@ -0,0 +1,293 @@
+"""
+Pre-forking production server.
+
+The master process binds the listening socket once and forks worker
+processes that all accept on it. Every worker creates its own app after
+the fork and serves requests from a fixed-size thread pool.
+
+Signals (master):
+    SIGTERM / SIGINT  stop workers gracefully (in-flight requests finish)
+    SIGHUP            graceful restart: start new workers, then stop the old ones
+
+On platforms without os.fork (Windows) a single threaded worker is run.
+"""
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+logger = logging.getLogger('sarwan.server')
+access_logger = logging.getLogger('sarwan.access')
+
+class ServerOptions:
+    def __init__(self, host='0.0.0.0', port=5000, workers=2, threads=8, timeout=120,
+                 graceful_timeout=30, keepalive=5, access_log='-', warmup=False):
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.threads = threads
+        self.timeout = timeout                    # max seconds per request before the worker is recycled
+        self.graceful_timeout = graceful_timeout  # seconds to wait for workers on stop/restart
+        self.keepalive = keepalive                # socket read timeout for idle/slow clients
+        self.access_log = access_log              # '-' = stderr, path = file, None = off
+        self.warmup = warmup                      # compile templates, open connections before accepting
+
+class AccessLogMiddleware:
+    """
+    WSGI wrapper that writes one access log line per request with latency
+    and tracks running requests so the watchdog can spot stuck ones.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.active = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        started = time.monotonic()
+        key = object()
+        state = {'status': '-', 'bytes': 0}
+        with self._lock:
+            self.active[key] = started
+
+        def _start_response(status, headers, exc_info=None):
+            state['status'] = status.split(' ', 1)[0]
+            return start_response(status, headers, exc_info)
+
+        def finish():
+            with self._lock:
+                self.active.pop(key, None)
+            access_logger.info('%s "%s %s%s" %s %d %.1fms pid=%d',
+                               environ.get('REMOTE_ADDR', '-'),
+                               environ.get('REQUEST_METHOD'),
+                               environ.get('PATH_INFO'),
+                               '?' + environ['QUERY_STRING'] if environ.get('QUERY_STRING') else '',
+                               state['status'], state['bytes'],
+                               (time.monotonic() - started) * 1000, os.getpid())
+
+        try:
+            result = self.app(environ, _start_response)
+        except BaseException:
+            state['status'] = '500'
+            finish()
+            raise
+
+        def body():
+            # Latency includes streaming the body
+            try:
+                for chunk in result:
+                    state['bytes'] += len(chunk)
+                    yield chunk
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+                finish()
+
+        return body()
+
+    def oldest_request_age(self):
+        with self._lock:
+            if not self.active:
+                return 0
+            return time.monotonic() - min(self.active.values())
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """Werkzeug handler without its own request log (AccessLogMiddleware logs instead)"""
+
+    def log_request(self, code='-', size='-'):
+        pass
+
+class PooledWSGIServer(BaseWSGIServer):
+    """Werkzeug server that handles requests on a fixed-size thread pool"""
+
+    multithread = True
+
+    def __init__(self, host, port, app, threads, handler=None, fd=None):
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='request')
+        super().__init__(host, port, app, handler=handler, fd=fd)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def serve_forever(self, poll_interval=0.5):
+        try:
+            super().serve_forever(poll_interval=poll_interval)
+        finally:
+            # Let in-flight requests finish before the worker exits
+            self.pool.shutdown(wait=True)
+
+def setup_logging(access_log):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(process)d] %(levelname)s %(name)s: %(message)s')
+    access_logger.propagate = False
+    access_logger.setLevel(logging.INFO)
+    if access_log:
+        handler = logging.StreamHandler(sys.stderr) if access_log == '-' else logging.FileHandler(access_log)
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        access_logger.addHandler(handler)
+    else:
+        access_logger.disabled = True
+
+def run_worker(options, fd=None):
+    """Create the app and serve until SIGTERM. Runs inside a worker process."""
+    from app import create_app
+    from app.metrics import start_metrics
+    from app.scheduler import start_scheduler
+
+    started = time.monotonic()
+    flask_app = create_app()
+    start_metrics(flask_app)
+    start_scheduler(flask_app)
+    if options.warmup:
+        from app.warmup import warm_up
+        warm_up(flask_app, connections=options.threads)
+    app = AccessLogMiddleware(flask_app)
+    handler = type('Handler', (QuietRequestHandler,), {'timeout': options.keepalive})
+    server = PooledWSGIServer(options.host, options.port, app, options.threads, handler=handler, fd=fd)
+
+    def stop(signum, frame):
+        # shutdown() blocks until serve_forever returns, so it can't run in this thread
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    if fd is not None:
+        # Ctrl+C goes to the whole process group, the master decides what to do
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    def watchdog():
+        while True:
+            time.sleep(1)
+            age = app.oldest_request_age()
+            if options.timeout and age > options.timeout:
+                logger.error('Request running for %.0fs (timeout %ds), recycling worker %d',
+                             age, options.timeout, os.getpid())
+                os._exit(1)
+
+    threading.Thread(target=watchdog, daemon=True).start()
+    logger.info('Worker %d ready in %.0fms (%d threads%s)', os.getpid(), (time.monotonic() - started) * 1000,
+                options.threads, ', warmed up' if options.warmup else '')
+    server.serve_forever()
+    logger.info('Worker %d stopped', os.getpid())
+
+class Master:
+    """Keeps options.workers worker processes alive on a shared socket"""
+
+    def __init__(self, options):
+        self.options = options
+        self.workers = {}  # pid -> generation
+        self.generation = 0
+        self.stopping = False
+        self.reload_requested = False
+
+    def bind(self):
+        sock = socket.create_server((self.options.host, self.options.port), backlog=2048, reuse_port=False)
+        sock.set_inheritable(True)
+        return sock
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_worker(self.options, fd=self.sock.fileno())
+                code = 0
+            except BaseException:
+                logger.exception('Worker %d crashed', os.getpid())
+                code = 1
+            os._exit(code)
+        self.workers[pid] = self.generation
+
+    def stop_workers(self, pids):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                self.workers.pop(pid, None)
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            generation = self.workers.pop(pid, None)
+            if generation is not None and status != 0:
+                logger.warning('Worker %d exited with status %d', pid, status)
+
+    def run(self):
+        self.sock = self.bind()
+        logger.info('Listening on %s:%d, %d workers x %d threads',
+                    self.options.host, self.options.port, self.options.workers, self.options.threads)
+
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_reload)
+
+        for _ in range(self.options.workers):
+            self.spawn()
+
+        while not self.stopping:
+            time.sleep(0.5)
+            self.reap()
+            if self.reload_requested:
+                self.reload_requested = False
+                self.reload()
+            # Replace workers that died (crash or timeout)
+            current = [pid for pid, gen in self.workers.items() if gen == self.generation]
+            for _ in range(self.options.workers - len(current)):
+                self.spawn()
+
+        self.shutdown()
+
+    def reload(self):
+        logger.info('Graceful restart')
+        old = [pid for pid, gen in self.workers.items() if gen == self.generation]
+        self.generation += 1
+        for _ in range(self.options.workers):
+            self.spawn()
+        self.stop_workers(old)
+
+    def shutdown(self):
+        logger.info('Stopping workers')
+        self.stop_workers(list(self.workers))
+        deadline = time.monotonic() + self.options.graceful_timeout
+        while self.workers and time.monotonic() < deadline:
+            time.sleep(0.2)
+            self.reap()
+        for pid in list(self.workers):
+            logger.warning('Killing worker %d after graceful timeout', pid)
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        self.reap()
+        self.sock.close()
+
+    def _on_stop(self, signum, frame):
+        self.stopping = True
+
+    def _on_reload(self, signum, frame):
+        self.reload_requested = True
+
+def serve(options):
+    setup_logging(options.access_log)
+    if not hasattr(os, 'fork'):
+        logger.warning('os.fork is not available, running a single worker')
+        run_worker(options)
+        return
+    Master(options).run()
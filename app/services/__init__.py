@@ -4,11 +4,12 @@ from flask_login import current_user
 from app import db
 from app.models import ActionLog
 
-def log_action(action, entity=None, entity_id=None, details=None):
-    """Log user action to database"""
-    if current_user.is_authenticated:
+def log_action(action, entity=None, entity_id=None, details=None, user=None):
+    """Log user action to database (user defaults to the logged-in one, e.g. CLI commands pass it)"""
+    user = user or (current_user if current_user.is_authenticated else None)
+    if user is not None:
         log = ActionLog(
-            user_id=current_user.id,
+            user_id=user.id,
             action=action,
             entity=entity,
             entity_id=entity_id,
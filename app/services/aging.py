@@ -0,0 +1,109 @@
+from datetime import datetime, timedelta
+from decimal import Decimal
+from app import db
+from app.models import Order, Payment, Subscriber
+
+# (key, label, max age in days) - the last bucket has no upper bound
+AGING_BUCKETS = [
+    ('current', '0-30 gün', 30),
+    ('days_30', '31-60 gün', 60),
+    ('days_60', '61-90 gün', 90),
+    ('days_90', '90+ gün', None),
+]
+
+def aging_query(client_type=None, as_of=None):
+    """
+    Build the aging report as one set-based query.
+
+    Payments are applied FIFO against orders: with cum = running sum of the
+    unpaid part of orders (oldest first) and credits = all payments plus any
+    order overpayments, an order is still open for
+    clamp(cum - credits, 0, unpaid). Open amounts are then summed per
+    subscriber into age buckets by the order date.
+    """
+    as_of = as_of or datetime.now()
+
+    unpaid = Order.total_amount - db.func.coalesce(Order.paid_amount, 0)
+    charge = db.case((unpaid > 0, unpaid), else_=0)
+    overpaid = db.case((unpaid < 0, -unpaid), else_=0)
+
+    running = db.select(
+        Order.subscriber_id.label('subscriber_id'),
+        Order.created_at.label('created_at'),
+        charge.label('charge'),
+        db.func.sum(charge).over(
+            partition_by=Order.subscriber_id,
+            order_by=(Order.created_at, Order.id)
+        ).label('cum'),
+        db.func.sum(overpaid).over(partition_by=Order.subscriber_id).label('overpaid'),
+    ).subquery()
+
+    paid = db.select(
+        Payment.subscriber_id.label('subscriber_id'),
+        db.func.sum(Payment.amount).label('amount'),
+    ).group_by(Payment.subscriber_id).subquery()
+
+    excess = running.c.cum - running.c.overpaid - db.func.coalesce(paid.c.amount, 0)
+    outstanding = db.case(
+        (excess <= 0, 0),
+        (excess >= running.c.charge, running.c.charge),
+        else_=excess
+    )
+
+    buckets = []
+    lower = None
+    for key, _, max_days in AGING_BUCKETS:
+        conditions = []
+        if max_days is not None:
+            conditions.append(running.c.created_at >= as_of - timedelta(days=max_days))
+        if lower is not None:
+            conditions.append(running.c.created_at < as_of - timedelta(days=lower))
+        in_bucket = db.and_(*conditions) if conditions else db.true()
+        buckets.append(db.func.sum(db.case((in_bucket, outstanding), else_=0)).label(key))
+        lower = max_days
+
+    total = db.func.sum(outstanding)
+    query = db.select(
+        Subscriber.id,
+        Subscriber.client_type,
+        Subscriber.address,
+        *buckets,
+        total.label('total'),
+    ).join(running, running.c.subscriber_id == Subscriber.id) \
+     .outerjoin(paid, paid.c.subscriber_id == Subscriber.id) \
+     .group_by(Subscriber.id, Subscriber.client_type, Subscriber.address) \
+     .having(total > 0) \
+     .order_by(total.desc())
+
+    if client_type:
+        query = query.where(Subscriber.client_type == client_type)
+    return query
+
+def iter_aging(client_type=None, as_of=None, totals=None, batch_size=1000):
+    """
+    Yield aging rows as dicts.
+
+    If a totals dict is given it is filled with the per-bucket sums while
+    iterating, so the grand total needs no second query.
+    """
+    keys = [key for key, _, _ in AGING_BUCKETS] + ['total']
+    if totals is not None:
+        totals.update({key: Decimal('0.00') for key in keys})
+        totals['count'] = 0
+
+    result = db.session.execute(
+        aging_query(client_type, as_of).execution_options(yield_per=batch_size)
+    )
+    for row in result:
+        item = {
+            'id': row.id,
+            'client_type': row.client_type,
+            'address': row.address,
+        }
+        for key in keys:
+            item[key] = Decimal(str(getattr(row, key) or 0)).quantize(Decimal('0.01'))
+            if totals is not None:
+                totals[key] += item[key]
+        if totals is not None:
+            totals['count'] += 1
+        yield item
@@ -0,0 +1,240 @@
+"""
+Online backups of every database (main and depots) and verified restores.
+
+SQLite databases are copied with the online backup API a few pages at a
+time, sleeping between steps, so writers wait for one step at most. A
+write from another connection makes SQLite restart the copy; if that
+happens more than MAX_RESTARTS times the rest is copied in one step.
+The copy passes PRAGMA integrity_check before it is gzipped into the
+backup directory, next to a .sha256 file (sha256sum format).
+
+MySQL databases are dumped with mysqldump --single-transaction, which
+reads one consistent snapshot without locking InnoDB tables.
+
+Snapshots are named <database>-<YYYYmmdd-HHMMSS>.sqlite.gz (or .sql.gz),
+the newest `keep` of each database are kept.
+"""
+import gzip
+import hashlib
+import os
+import re
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+from app import db
+from app.depots import all_engines, database_name
+
+MAX_RESTARTS = 20
+CHUNK = 1024 * 1024
+
+class BackupError(Exception):
+    """A backup or restore could not be completed"""
+
+class _Restarted(Exception):
+    pass
+
+def _snapshot_pattern(name):
+    return re.compile(re.escape(name) + r'-\d{8}-\d{6}\.(sqlite|sql)\.gz$')
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(CHUNK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _write_checksum(path):
+    with open(path + '.sha256', 'w') as f:
+        f.write(f'{file_sha256(path)}  {os.path.basename(path)}\n')
+
+def verify_backup(path):
+    """Raise BackupError unless path matches its .sha256 file"""
+    try:
+        with open(path + '.sha256') as f:
+            expected = f.read().split()[0]
+    except (FileNotFoundError, IndexError):
+        raise BackupError(f'no checksum for {os.path.basename(path)}')
+    if file_sha256(path) != expected:
+        raise BackupError(f'checksum mismatch for {os.path.basename(path)}')
+
+def _integrity_check(path):
+    conn = sqlite3.connect(path)
+    try:
+        result = conn.execute('PRAGMA integrity_check').fetchone()[0]
+    finally:
+        conn.close()
+    if result != 'ok':
+        raise BackupError(f'integrity check failed: {result}')
+
+def _copy_sqlite(engine, target, pages, pause):
+    """Online backup of engine's database into the file target, returns how often the copy restarted"""
+    restarts = 0
+    last = None
+
+    def progress(status, remaining, total):
+        nonlocal last, restarts
+        if last is not None and remaining > last:
+            restarts += 1
+            if restarts > MAX_RESTARTS:
+                raise _Restarted()
+        last = remaining
+
+    raw = engine.raw_connection()
+    destination = sqlite3.connect(target)
+    try:
+        try:
+            raw.driver_connection.backup(destination, pages=pages, progress=progress, sleep=pause)
+        except _Restarted:
+            # Too busy to finish in steps: copy the rest in one go
+            raw.driver_connection.backup(destination)
+    finally:
+        destination.close()
+        raw.close()
+    return restarts
+
+def _gzip_file(source, path):
+    with open(source, 'rb') as f, gzip.open(path, 'wb') as out:
+        shutil.copyfileobj(f, out, CHUNK)
+
+def _mysql_command(program, url):
+    command = [program, f'--user={url.username}', f'--host={url.host or "localhost"}']
+    if url.port:
+        command.append(f'--port={url.port}')
+    env = dict(os.environ)
+    if url.password:
+        env['MYSQL_PWD'] = url.password  # not on the command line, where ps shows it
+    return command, env
+
+def _check_exit(process, errors, program):
+    if process.wait() != 0:
+        errors.seek(0)
+        raise BackupError(f'{program} failed: {errors.read().decode(errors="replace").strip()}')
+
+def _dump_mysql(engine, path):
+    command, env = _mysql_command('mysqldump', engine.url)
+    command += ['--single-transaction', '--quick', '--routines', '--no-tablespaces', engine.url.database]
+    with tempfile.TemporaryFile() as errors:
+        try:
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=errors, env=env)
+        except FileNotFoundError:
+            raise BackupError('mysqldump not found')
+        with gzip.open(path, 'wb') as out:
+            shutil.copyfileobj(process.stdout, out, CHUNK)
+        _check_exit(process, errors, 'mysqldump')
+
+def _rotate(directory, name, keep):
+    pattern = _snapshot_pattern(name)
+    snapshots = sorted(f for f in os.listdir(directory) if pattern.match(f))
+    for old in snapshots[:-keep] if keep else []:
+        os.remove(os.path.join(directory, old))
+        if os.path.exists(os.path.join(directory, old + '.sha256')):
+            os.remove(os.path.join(directory, old + '.sha256'))
+    return len(snapshots[:-keep]) if keep else 0
+
+def backup_engine(engine, directory, keep=28, pages=100, pause=0.05):
+    """Write one verified, compressed snapshot of engine's database, returns its path and a note"""
+    os.makedirs(directory, exist_ok=True)
+    name = database_name(engine)
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    while any(os.path.exists(os.path.join(directory, f'{name}-{stamp}.{ext}.gz')) for ext in ('sqlite', 'sql')):
+        # Never overwrite a snapshot (a restore takes one right after the scheduled one)
+        time.sleep(0.2)
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    if engine.dialect.name == 'sqlite':
+        path = os.path.join(directory, f'{name}-{stamp}.sqlite.gz')
+        fd, copy = tempfile.mkstemp(suffix='.sqlite', dir=directory)
+        os.close(fd)
+        try:
+            restarts = _copy_sqlite(engine, copy, pages, pause)
+            _integrity_check(copy)
+            _gzip_file(copy, path + '.partial')
+        finally:
+            os.remove(copy)
+        note = f', {restarts} restarts' if restarts else ''
+    elif engine.dialect.name == 'mysql':
+        path = os.path.join(directory, f'{name}-{stamp}.sql.gz')
+        _dump_mysql(engine, path + '.partial')
+        note = ''
+    else:
+        raise BackupError(f'backups are not supported on {engine.dialect.name}')
+
+    # Only a complete snapshot gets its final name
+    os.replace(path + '.partial', path)
+    _write_checksum(path)
+    removed = _rotate(directory, name, keep)
+    size = os.path.getsize(path) / 1024 / 1024
+    return path, f'{os.path.basename(path)} ({size:.1f} MB{note})' + (f', {removed} old removed' if removed else '')
+
+def backup_databases(directory, keep=28, pages=100, pause=0.05):
+    """Snapshot every database into the backup directory"""
+    db.session.remove()  # the backup steps should not wait on this thread's transaction
+    return '; '.join(backup_engine(engine, directory, keep, pages, pause)[1] for engine in all_engines())
+
+def list_backups(directory):
+    """(path, database name) of the snapshots in directory, oldest first"""
+    if not os.path.isdir(directory):
+        return []
+    found = []
+    for engine in all_engines():
+        pattern = _snapshot_pattern(database_name(engine))
+        found += [(os.path.join(directory, f), database_name(engine)) for f in os.listdir(directory) if pattern.match(f)]
+    # By the time stamp after the database name
+    return sorted(found, key=lambda item: os.path.basename(item[0])[len(item[1]) + 1:])
+
+def engine_for_backup(path):
+    """The engine whose database the snapshot at path was taken from"""
+    for engine in all_engines():
+        if _snapshot_pattern(database_name(engine)).match(os.path.basename(path)):
+            return engine
+    raise BackupError(f'{os.path.basename(path)} is not a snapshot of a configured database')
+
+def restore_backup(path, directory):
+    """
+    Replace the database a snapshot was taken from with the snapshot.
+    The checksum and (for SQLite) the integrity of the snapshot are checked
+    first, and the current database is backed up into directory before it
+    is overwritten.
+    """
+    verify_backup(path)
+    engine = engine_for_backup(path)
+    db.session.remove()
+
+    if engine.dialect.name == 'sqlite':
+        fd, copy = tempfile.mkstemp(suffix='.sqlite', dir=os.path.dirname(os.path.abspath(path)))
+        os.close(fd)
+        try:
+            with gzip.open(path, 'rb') as f, open(copy, 'wb') as out:
+                shutil.copyfileobj(f, out, CHUNK)
+            _integrity_check(copy)
+            safety, _ = backup_engine(engine, directory, keep=0)
+            source = sqlite3.connect(copy)
+            raw = engine.raw_connection()
+            try:
+                # One step, so nobody sees a half restored database
+                source.backup(raw.driver_connection)
+            finally:
+                raw.close()
+                source.close()
+        finally:
+            os.remove(copy)
+    elif engine.dialect.name == 'mysql':
+        safety, _ = backup_engine(engine, directory, keep=0)
+        command, env = _mysql_command('mysql', engine.url)
+        with tempfile.TemporaryFile() as errors:
+            try:
+                process = subprocess.Popen(command + [engine.url.database], stdin=subprocess.PIPE,
+                                           stderr=errors, env=env)
+            except FileNotFoundError:
+                raise BackupError('mysql client not found')
+            with gzip.open(path, 'rb') as f:
+                shutil.copyfileobj(f, process.stdin, CHUNK)
+            process.stdin.close()
+            _check_exit(process, errors, 'mysql')
+    else:
+        raise BackupError(f'restores are not supported on {engine.dialect.name}')
+
+    engine.dispose()  # pooled connections may have cached the old schema
+    return f'{database_name(engine)} restored from {os.path.basename(path)}, previous state saved as {os.path.basename(safety)}'
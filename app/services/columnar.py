@@ -0,0 +1,34 @@
+"""
+Column-oriented JSON for the list endpoints behind the virtualized tables.
+
+A window of rows goes out as one array per column instead of one object
+per row, so keys are not repeated for every row. Columns with few distinct
+values (client types, the address of a subscriber with many orders) are
+dictionary encoded: the column holds indexes into a list of the values.
+static/js/main.js (decodeColumns) turns it back into row objects.
+"""
+from flask import request
+
+LIST_WINDOW = 50
+MAX_LIST_WINDOW = 500
+
+def list_window():
+    """(offset, limit) requested by a virtualized table"""
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = min(max(request.args.get('limit', LIST_WINDOW, type=int), 1), MAX_LIST_WINDOW)
+    return offset, limit
+
+def encode_columns(rows, columns, dictionary=()):
+    """rows (dicts) -> {'count', 'columns': {name: [...]}, 'dictionaries': {name: [...]}}"""
+    data = {name: [] for name in columns}
+    dictionaries = {name: {} for name in dictionary}
+    count = 0
+    for row in rows:
+        count += 1
+        for name in columns:
+            value = row[name]
+            if name in dictionaries:
+                value = dictionaries[name].setdefault(value, len(dictionaries[name]))
+            data[name].append(value)
+    return {'count': count, 'columns': data,
+            'dictionaries': {name: list(values) for name, values in dictionaries.items()}}
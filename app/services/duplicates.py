@@ -0,0 +1,198 @@
+"""
+Duplicate subscriber detection and merging.
+
+Comparing every pair of subscribers is quadratic, so subscribers are first
+put into blocks: one per phone (last PHONE_DIGITS digits, so +993 65...
+and 865... meet) and one per address token (lowercased, Turkmen letters
+folded to ASCII, so "Köçe" and "koce" meet). Only pairs that share a block
+are scored. Tokens shared by more than MAX_BLOCK_SIZE subscribers (street
+names, "jaý") tell nothing about a pair and are skipped.
+"""
+import re
+import unicodedata
+from collections import defaultdict
+from datetime import datetime
+from itertools import combinations
+from flask_login import current_user
+from app import db
+from app.models import Subscriber, Phone, Order, Payment, DuplicateCandidate
+from app.live import publish_subscriber_deletions
+from app.outbox import record_changes
+from app.services.ledger import recalculate_debts
+
+PHONE_DIGITS = 8
+MAX_BLOCK_SIZE = 50
+MIN_SCORE = 0.45
+PHONE_WEIGHT = 0.5
+ADDRESS_WEIGHT = 0.5
+
+_FOLD = str.maketrans('çşžňöüýä', 'csznouya')
+# Words that appear in most addresses, after folding
+ADDRESS_STOPWORDS = {'koce', 'kocesi', 'k', 'jay', 'jayy', 'j', 'sayoly', 'say', 'kw', 'kv', 'oy', 'etrap', 'mkr', 'sanly'}
+
+def fold(text):
+    """Lowercase, Turkmen letters to ASCII, other accents stripped"""
+    text = (text or '').lower().translate(_FOLD)
+    return ''.join(c for c in unicodedata.normalize('NFKD', text) if not unicodedata.combining(c))
+
+def address_tokens(address):
+    return {token for token in re.findall(r'[a-z0-9]+', fold(address)) if token not in ADDRESS_STOPWORDS}
+
+def phone_key(number):
+    digits = re.sub(r'\D', '', number or '')
+    return digits[-PHONE_DIGITS:] if len(digits) >= 6 else None
+
+def _load_profiles(batch_size=5000):
+    """{id: (client_type, address tokens, phone keys)} for every subscriber"""
+    profiles = {}
+    rows = db.session.execute(db.select(Subscriber.id, Subscriber.client_type, Subscriber.address)
+                              .execution_options(yield_per=batch_size))
+    for id, client_type, address in rows:
+        profiles[id] = (client_type, address_tokens(address), set())
+    rows = db.session.execute(db.select(Phone.subscriber_id, Phone.number).execution_options(yield_per=batch_size))
+    for subscriber_id, number in rows:
+        key = phone_key(number)
+        if key and subscriber_id in profiles:
+            profiles[subscriber_id][2].add(key)
+    return profiles
+
+def score_pair(a, b):
+    """(score, reasons) for two profiles"""
+    type_a, tokens_a, phones_a = a
+    type_b, tokens_b, phones_b = b
+    reasons = []
+    score = 0.0
+    if phones_a & phones_b:
+        score += PHONE_WEIGHT
+        reasons.append('phone')
+    if tokens_a and tokens_b:
+        similarity = len(tokens_a & tokens_b) / len(tokens_a | tokens_b)
+        score += ADDRESS_WEIGHT * similarity
+        if similarity >= 0.5:
+            reasons.append('address')
+    if type_a != type_b:
+        score *= 0.8
+    return round(score, 3), reasons
+
+def find_duplicate_pairs(profiles, min_score=MIN_SCORE):
+    """Yield (id, other_id, score, reasons) for blocked pairs scoring at least min_score"""
+    blocks = defaultdict(list)
+    for id, (_, tokens, phones) in profiles.items():
+        for key in phones:
+            blocks[('phone', key)].append(id)
+        for token in tokens:
+            blocks[('address', token)].append(id)
+
+    seen = set()
+    for members in blocks.values():
+        if len(members) < 2 or len(members) > MAX_BLOCK_SIZE:
+            continue
+        for pair in combinations(sorted(members), 2):
+            if pair in seen:
+                continue
+            seen.add(pair)
+            score, reasons = score_pair(profiles[pair[0]], profiles[pair[1]])
+            if score >= min_score:
+                yield pair[0], pair[1], score, reasons
+
+def scan_duplicates(min_score=MIN_SCORE, batch_size=1000):
+    """Refresh the review queue: add new candidate pairs, drop pending ones that no longer match"""
+    found = {(id, other): (score, reasons) for id, other, score, reasons in
+             find_duplicate_pairs(_load_profiles(), min_score)}
+    existing = {(row.subscriber_id, row.duplicate_id): (row.id, row.status) for row in db.session.execute(
+        db.select(DuplicateCandidate.id, DuplicateCandidate.subscriber_id,
+                  DuplicateCandidate.duplicate_id, DuplicateCandidate.status))}
+
+    # Dismissed and merged pairs keep their decision
+    stale = [id for pair, (id, status) in existing.items() if status == 'pending' and pair not in found]
+    for start in range(0, len(stale), batch_size):
+        DuplicateCandidate.query.filter(DuplicateCandidate.id.in_(stale[start:start + batch_size])) \
+            .delete(synchronize_session=False)
+
+    now = datetime.now()
+    new = [{'subscriber_id': id, 'duplicate_id': other, 'score': score, 'reasons': ','.join(reasons),
+            'status': 'pending', 'created_at': now}
+           for (id, other), (score, reasons) in found.items() if (id, other) not in existing]
+    for start in range(0, len(new), batch_size):
+        db.session.execute(db.insert(DuplicateCandidate), new[start:start + batch_size])
+    db.session.commit()
+    return f'{len(found)} candidate pairs, {len(new)} new, {len(stale)} resolved'
+
+def merge_subscribers(groups):
+    """
+    Merge subscribers. groups maps each kept id to the ids merged into it.
+
+    Phones, orders and payments are moved with one UPDATE per table for
+    all groups, phones the kept subscriber already has are dropped, the
+    merged subscribers are deleted and debts are recomputed once from the
+    ledger. Returns the counts; does not commit.
+    """
+    target = {drop: keep for keep, drops in groups.items() for drop in drops if drop != keep}
+    if set(target) & set(groups):
+        raise ValueError('A subscriber cannot be kept and merged at the same time')
+    moved = {'subscribers': len(target), 'orders': 0, 'payments': 0, 'phones': 0}
+    if not target:
+        return moved
+    drop_ids = sorted(target)
+    keep_ids = sorted(set(target.values()))
+
+    known = defaultdict(set)
+    for subscriber_id, number in db.session.query(Phone.subscriber_id, Phone.number) \
+            .filter(Phone.subscriber_id.in_(keep_ids)):
+        known[subscriber_id].add(phone_key(number) or number)
+    repeated = []
+    for id, subscriber_id, number in db.session.query(Phone.id, Phone.subscriber_id, Phone.number) \
+            .filter(Phone.subscriber_id.in_(drop_ids)).order_by(Phone.id):
+        key = phone_key(number) or number
+        if key in known[target[subscriber_id]]:
+            repeated.append(id)
+        known[target[subscriber_id]].add(key)
+    if repeated:
+        Phone.query.filter(Phone.id.in_(repeated)).delete(synchronize_session=False)
+
+    # Soft-deleted orders and payments move too, the subscriber row is deleted for good
+    for name, model in (('phones', Phone), ('orders', Order), ('payments', Payment)):
+        moved[name] = model.query.execution_options(include_deleted=True) \
+            .filter(model.subscriber_id.in_(drop_ids)) \
+            .update({'subscriber_id': db.case(target, value=model.subscriber_id)}, synchronize_session=False)
+
+    Subscriber.query.execution_options(include_deleted=True).filter(Subscriber.id.in_(drop_ids)) \
+        .delete(synchronize_session=False)
+    publish_subscriber_deletions(drop_ids)
+    record_changes(Subscriber, keep_ids)  # they got phones the bulk UPDATE hook can't see
+    recalculate_debts(keep_ids)
+
+    # Pairs inside a group are done, other pending pairs of merged subscribers are void
+    now = datetime.now()
+    reviewer = current_user.id if current_user.is_authenticated else None
+    for keep, drops in groups.items():
+        members = [keep] + list(drops)
+        DuplicateCandidate.query.filter(
+            DuplicateCandidate.subscriber_id.in_(members), DuplicateCandidate.duplicate_id.in_(members)
+        ).update({'status': 'merged', 'reviewed_at': now, 'reviewed_by': reviewer}, synchronize_session=False)
+    DuplicateCandidate.query.filter(
+        DuplicateCandidate.status == 'pending',
+        db.or_(DuplicateCandidate.subscriber_id.in_(drop_ids), DuplicateCandidate.duplicate_id.in_(drop_ids))
+    ).delete(synchronize_session=False)
+    return moved
+
+def group_pairs(pairs):
+    """Join overlapping (id, other) pairs into {kept id: [merged ids]}, the oldest (lowest) id is kept"""
+    parent = {}
+
+    def root(id):
+        parent.setdefault(id, id)
+        while parent[id] != id:
+            parent[id] = parent[parent[id]]
+            id = parent[id]
+        return id
+
+    for id, other in pairs:
+        a, b = root(id), root(other)
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+    groups = defaultdict(list)
+    for id in list(parent):
+        if root(id) != id:
+            groups[root(id)].append(id)
+    return {keep: sorted(drops) for keep, drops in groups.items()}
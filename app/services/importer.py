@@ -0,0 +1,231 @@
+"""
+Bulk subscriber import from CSV or XLSX.
+
+Rows are read and normalized first, then subscribers are inserted with
+multi-row INSERT ... RETURNING statements (SQLAlchemy batches them; row
+by row on MySQL, which has no RETURNING) and phones with one executemany,
+all in one transaction. Rows whose phone
+already belongs to a subscriber, or repeats within the file, are flagged
+and skipped unless collisions are allowed.
+
+Recognised columns (case and Turkmen letters don't matter): address /
+salgy, phone / telefon (several numbers may be separated by , ; or /,
+and several phone columns are fine), client_type / gornusi.
+"""
+import csv
+import io
+import re
+import zipfile
+import xml.etree.ElementTree as ET
+from app import db
+from app.models import Subscriber, Phone
+from app.outbox import record_changes
+from app.services.duplicates import fold, phone_key
+
+BATCH_SIZE = 1000
+MAX_ROWS = 50000
+
+ADDRESS_COLUMNS = {'address', 'salgy', 'adres'}
+PHONE_COLUMNS = {'phone', 'phones', 'telefon', 'telefonlar', 'tel', 'telefon belgisi'}
+TYPE_COLUMNS = {'client_type', 'type', 'gornusi', 'gornus'}
+CLIENT_TYPES = {
+    'legal': 'legal', 'magazin': 'legal', 'magazinlar': 'legal', 'yuridik': 'legal', 'yuridik sahs': 'legal',
+    'individual': 'individual', 'rayat': 'individual', 'fiziki': 'individual', 'fiziki sahs': 'individual',
+}
+
+class ImportFileError(ValueError):
+    """The file can't be read as a subscriber list"""
+
+# Reading
+
+def _read_csv(data):
+    text = data.decode('utf-8-sig', errors='replace')
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    return csv.reader(io.StringIO(text), dialect)
+
+_NS = {'m': 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'}
+_REL = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id'
+
+def _column_index(ref):
+    index = 0
+    for char in re.match(r'[A-Z]+', ref).group():
+        index = index * 26 + ord(char) - 64
+    return index - 1
+
+def _read_xlsx(data):
+    """Rows of the first worksheet, read with the standard library"""
+    try:
+        book = zipfile.ZipFile(io.BytesIO(data))
+        shared = []
+        if 'xl/sharedStrings.xml' in book.namelist():
+            for item in ET.fromstring(book.read('xl/sharedStrings.xml')).findall('m:si', _NS):
+                shared.append(''.join(t.text or '' for t in item.iter('{%s}t' % _NS['m'])))
+        sheet = ET.fromstring(book.read('xl/workbook.xml')).find('m:sheets/m:sheet', _NS)
+        rels = ET.fromstring(book.read('xl/_rels/workbook.xml.rels'))
+        target = next(rel.get('Target') for rel in rels if rel.get('Id') == sheet.get(_REL))
+        path = target.lstrip('/') if target.startswith('/') else 'xl/' + target
+        source = book.open(path)
+    except (zipfile.BadZipFile, KeyError, StopIteration, ET.ParseError, AttributeError):
+        raise ImportFileError('XLSX faýly okalmady')
+
+    for _, element in ET.iterparse(source):
+        if element.tag != '{%s}row' % _NS['m']:
+            continue
+        row = []
+        for cell in element.findall('m:c', _NS):
+            kind = cell.get('t')
+            if kind == 'inlineStr':
+                value = ''.join(t.text or '' for t in cell.iter('{%s}t' % _NS['m']))
+            else:
+                raw = cell.findtext('m:v', default='', namespaces=_NS)
+                value = shared[int(raw)] if kind == 's' and raw else raw
+                # Phone numbers typed as numbers come back as 99361123456.0
+                if kind in (None, 'n') and value.endswith('.0'):
+                    value = value[:-2]
+            index = _column_index(cell.get('r')) if cell.get('r') else len(row)
+            row.extend([''] * (index - len(row) + 1))
+            row[index] = value
+        element.clear()
+        yield row
+
+def read_rows(data, filename):
+    if filename.lower().endswith('.xlsx'):
+        return _read_xlsx(data)
+    if filename.lower().endswith(('.csv', '.txt')):
+        return _read_csv(data)
+    raise ImportFileError('Diňe CSV ýa-da XLSX faýl kabul edilýär')
+
+# Normalizing
+
+def normalize_phone(number):
+    """Turkmen numbers to +993XXXXXXXX, None if it doesn't look like a phone"""
+    digits = re.sub(r'\D', '', number or '')
+    if len(digits) == 8:
+        return '+993' + digits
+    if len(digits) == 9 and digits.startswith('8'):
+        return '+993' + digits[1:]
+    if len(digits) == 11 and digits.startswith('993'):
+        return '+' + digits
+    if 10 <= len(digits) <= 15 and (number or '').strip().startswith('+'):
+        return '+' + digits
+    return None
+
+def normalize_address(address):
+    address = re.sub(r'\s+', ' ', address or '').strip(' ,;')
+    return re.sub(r'\s*,\s*', ', ', address) or None
+
+def _columns(header):
+    columns = {'address': None, 'phones': [], 'client_type': None}
+    for index, name in enumerate(header):
+        name = fold(name).strip()
+        if name in ADDRESS_COLUMNS:
+            columns['address'] = index
+        elif name in PHONE_COLUMNS:
+            columns['phones'].append(index)
+        elif name in TYPE_COLUMNS:
+            columns['client_type'] = index
+    if columns['address'] is None and not columns['phones']:
+        raise ImportFileError('Faýlda salgy ýa-da telefon sütüni ýok')
+    return columns
+
+def parse_rows(rows, default_type='individual'):
+    """Yield (line, record or None, problem) from raw rows, the first row being the header"""
+    rows = iter(rows)
+    columns = _columns(next(rows, []))
+
+    def cell(row, index):
+        return row[index].strip() if index is not None and index < len(row) and row[index] else ''
+
+    for line, row in enumerate(rows, start=2):
+        if not any((value or '').strip() for value in row):
+            continue
+        if line > MAX_ROWS + 1:
+            raise ImportFileError(f'Faýlda {MAX_ROWS} setirden köp bar')
+        address = normalize_address(cell(row, columns['address']))
+        raw_phones = [part for index in columns['phones']
+                      for part in re.split(r'[,;/]', cell(row, index)) if part.strip()]
+        phones, invalid = [], None
+        for raw in raw_phones:
+            phone = normalize_phone(raw)
+            if phone is None:
+                invalid = raw.strip()
+                break
+            if phone not in phones:
+                phones.append(phone)
+        type_text = cell(row, columns['client_type'])
+        client_type = CLIENT_TYPES.get(fold(type_text)) if type_text else default_type
+
+        if invalid:
+            yield line, None, f'nädogry telefon: {invalid}'
+        elif client_type is None:
+            yield line, None, f'nädogry görnüş: {type_text}'
+        elif not address and not phones:
+            yield line, None, 'salgy we telefon ýok'
+        else:
+            yield line, {'address': address, 'client_type': client_type, 'phones': phones}, None
+
+# Importing
+
+def _insert_subscribers(rows):
+    """Insert subscriber rows, returns their ids in the order of rows"""
+    dialect = db.session.get_bind(mapper=Subscriber).dialect
+    if dialect.insert_executemany_returning_sort_by_parameter_order:
+        return db.session.scalars(
+            db.insert(Subscriber).returning(Subscriber.id, sort_by_parameter_order=True), rows
+        ).all()
+    # MySQL has no RETURNING: one INSERT per row
+    return [db.session.execute(db.insert(Subscriber).values(row)).inserted_primary_key[0] for row in rows]
+
+def import_subscribers(rows, default_type='individual', allow_collisions=False, dry_run=False):
+    """
+    Import raw rows (header first, see read_rows). Returns a report dict
+    with counts, the invalid rows (line, problem) and the collisions
+    (line, phone, id of the subscriber that has it, or the earlier line).
+    Nothing is committed; the caller commits (or rolls back a dry run).
+    """
+    existing = {}
+    for subscriber_id, number in db.session.query(Phone.subscriber_id, Phone.number).join(Subscriber):
+        existing.setdefault(phone_key(number), subscriber_id)
+
+    report = {'rows': 0, 'imported': 0, 'phones': 0, 'invalid': [], 'collisions': []}
+    records = []
+    seen = {}
+    for line, record, problem in parse_rows(rows, default_type):
+        report['rows'] += 1
+        if record is None:
+            report['invalid'].append((line, problem))
+            continue
+        clashes = []
+        for phone in record['phones']:
+            key = phone_key(phone)
+            if key in existing:
+                clashes.append((line, phone, existing[key]))
+            elif key in seen:
+                clashes.append((line, phone, f'setir {seen[key]}'))
+        report['collisions'].extend(clashes)
+        if clashes and not allow_collisions:
+            continue
+        for phone in record['phones']:
+            seen.setdefault(phone_key(phone), line)
+        records.append(record)
+
+    if dry_run:
+        report['imported'] = len(records)
+        report['phones'] = sum(len(record['phones']) for record in records)
+        return report
+
+    for start in range(0, len(records), BATCH_SIZE):
+        batch = records[start:start + BATCH_SIZE]
+        ids = _insert_subscribers([{'address': record['address'], 'client_type': record['client_type'], 'debt': 0}
+                                   for record in batch])
+        record_changes(Subscriber, ids, 'insert')
+        phones = [{'subscriber_id': id, 'number': phone}
+                  for id, record in zip(ids, batch) for phone in record['phones']]
+        if phones:
+            db.session.execute(db.insert(Phone), phones)
+        report['imported'] += len(batch)
+        report['phones'] += len(phones)
+    return report
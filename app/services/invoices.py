@@ -0,0 +1,193 @@
+"""
+Monthly invoices for legal clients (Magazinlar).
+
+The month's totals of every legal client come from one grouped query:
+orders, bottles by kind and amounts in the month, payments in the month,
+and the balance before the month, so each invoice can show opening and
+closing debt. Clients with no orders, no payments and no debt are skipped.
+
+The invoices are rendered from templates/invoices/ in a process pool, a
+chunk of invoices per task, into
+
+    <directory>/<YYYY-MM>/[<depot>/]invoice-<number>.html
+                                    index.html, index.csv
+
+The pages are self-contained and print to PDF from the browser (A4).
+"""
+import csv
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from decimal import Decimal
+from multiprocessing import get_all_start_methods, get_context
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+from app import db
+from app.depots import depot_names, use_depot
+from app.models import Order, Payment, Subscriber
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                            'templates', 'invoices')
+CHUNK_SIZE = 200
+
+INDEX_COLUMNS = ['number', 'subscriber_id', 'address', 'orders', 'amount', 'paid', 'opening', 'closing', 'file']
+
+def month_range(year, month):
+    start = datetime(year, month, 1)
+    return start, datetime(year + month // 12, month % 12 + 1, 1)
+
+def _money(value):
+    return Decimal(str(value or 0)).quantize(Decimal('0.01'))
+
+def invoice_totals_query(start, end):
+    """One row per legal client with activity in [start, end) or a balance before it"""
+    in_month = Order.created_at >= start
+    zero = db.literal(0)
+
+    def month_sum(value):
+        return db.func.coalesce(db.func.sum(db.case((in_month, value), else_=zero)), 0)
+
+    orders = db.select(
+        Order.subscriber_id,
+        db.func.count(db.case((in_month, Order.id))).label('orders'),
+        month_sum(Order.new_bottles).label('new_bottles'),
+        month_sum(Order.exchange_bottles).label('exchange_bottles'),
+        month_sum(Order.water_only).label('water_only'),
+        month_sum(Order.free_bottles).label('free_bottles'),
+        month_sum(Order.total_amount).label('amount'),
+        month_sum(Order.paid_amount).label('paid_with_orders'),
+        db.func.coalesce(db.func.sum(db.case(
+            (Order.created_at < start, Order.total_amount - db.func.coalesce(Order.paid_amount, 0)), else_=zero
+        )), 0).label('opening'),
+    ).where(Order.created_at < end).group_by(Order.subscriber_id).subquery()
+
+    payments = db.select(
+        Payment.subscriber_id,
+        db.func.coalesce(db.func.sum(db.case((Payment.created_at >= start, Payment.amount), else_=zero)), 0)
+            .label('payments'),
+        db.func.coalesce(db.func.sum(db.case((Payment.created_at < start, Payment.amount), else_=zero)), 0)
+            .label('paid_before'),
+    ).where(Payment.created_at < end).group_by(Payment.subscriber_id).subquery()
+
+    opening = db.func.coalesce(orders.c.opening, 0) - db.func.coalesce(payments.c.paid_before, 0)
+    return db.select(
+        Subscriber.id,
+        Subscriber.address,
+        db.func.coalesce(orders.c.orders, 0).label('orders'),
+        db.func.coalesce(orders.c.new_bottles, 0).label('new_bottles'),
+        db.func.coalesce(orders.c.exchange_bottles, 0).label('exchange_bottles'),
+        db.func.coalesce(orders.c.water_only, 0).label('water_only'),
+        db.func.coalesce(orders.c.free_bottles, 0).label('free_bottles'),
+        db.func.coalesce(orders.c.amount, 0).label('amount'),
+        db.func.coalesce(orders.c.paid_with_orders, 0).label('paid_with_orders'),
+        db.func.coalesce(payments.c.payments, 0).label('payments'),
+        opening.label('opening'),
+    ).outerjoin(orders, orders.c.subscriber_id == Subscriber.id) \
+     .outerjoin(payments, payments.c.subscriber_id == Subscriber.id) \
+     .where(Subscriber.client_type == 'legal') \
+     .where(db.or_(orders.c.orders > 0, payments.c.payments > 0, opening != 0)) \
+     .order_by(Subscriber.id)
+
+def iter_invoice_totals(year, month, prefix=''):
+    """Invoice dicts (totals of one client each) for the month"""
+    start, end = month_range(year, month)
+    for row in db.session.execute(invoice_totals_query(start, end)):
+        amount, opening = _money(row.amount), _money(row.opening)
+        paid = _money(row.paid_with_orders) + _money(row.payments)
+        yield {
+            'number': f'{prefix}{year}{month:02d}-{row.id:05d}',
+            'subscriber_id': row.id,
+            'address': row.address or '',
+            'orders': row.orders,
+            'new_bottles': int(row.new_bottles),
+            'exchange_bottles': int(row.exchange_bottles),
+            'water_only': int(row.water_only),
+            'free_bottles': int(row.free_bottles),
+            'amount': amount,
+            'paid_with_orders': _money(row.paid_with_orders),
+            'payments': _money(row.payments),
+            'paid': paid,
+            'opening': opening,
+            'closing': opening + amount - paid,
+        }
+
+# Rendering (runs in the pool workers)
+
+_environment = None
+
+def _env():
+    global _environment
+    if _environment is None:
+        _environment = Environment(loader=FileSystemLoader(TEMPLATE_DIR), autoescape=select_autoescape(['html']))
+    return _environment
+
+def invoice_filename(invoice):
+    return f"invoice-{invoice['number']}.html"
+
+def render_chunk(task):
+    """Write the invoices of one chunk, returns how many were written"""
+    directory, period, issued, invoices = task
+    template = _env().get_template('invoice.html')
+    for invoice in invoices:
+        path = os.path.join(directory, invoice_filename(invoice))
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(template.render(invoice=invoice, period=period, issued=issued))
+        os.replace(path + '.tmp', path)
+    return len(invoices)
+
+def _write_index(directory, period, issued, invoices):
+    totals = {key: sum((invoice[key] for invoice in invoices), Decimal('0.00'))
+              for key in ('amount', 'paid', 'opening', 'closing')}
+    with open(os.path.join(directory, 'index.html'), 'w', encoding='utf-8') as f:
+        f.write(_env().get_template('index.html').render(
+            invoices=invoices, period=period, issued=issued, totals=totals, filename=invoice_filename))
+    with open(os.path.join(directory, 'index.csv'), 'w', encoding='utf-8-sig', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(INDEX_COLUMNS)
+        for invoice in invoices:
+            writer.writerow([invoice_filename(invoice) if key == 'file' else invoice[key] for key in INDEX_COLUMNS])
+
+def generate_invoices(year, month, directory, workers=None, prefix=''):
+    """
+    Render the month's invoices of the current depot into directory (with
+    an index), using `workers` processes (None: one per CPU, 1: this process).
+    Returns a short report.
+    """
+    invoices = list(iter_invoice_totals(year, month, prefix))
+    os.makedirs(directory, exist_ok=True)
+    period = f'{month:02d}.{year}'
+    issued = datetime.now().strftime('%d.%m.%Y')
+    tasks = [(directory, period, issued, invoices[start:start + CHUNK_SIZE])
+             for start in range(0, len(invoices), CHUNK_SIZE)]
+    workers = min(workers or os.cpu_count() or 1, len(tasks)) or 1
+
+    if workers == 1:
+        written = sum(map(render_chunk, tasks))
+    else:
+        # fork starts fastest, but forking a process that runs threads (server, scheduler) is not safe
+        fork = threading.active_count() == 1 and 'fork' in get_all_start_methods()
+        with ProcessPoolExecutor(workers, mp_context=get_context('fork' if fork else 'spawn')) as pool:
+            written = sum(pool.map(render_chunk, tasks))
+    _write_index(directory, period, issued, invoices)
+    total = sum((invoice['amount'] for invoice in invoices), Decimal('0.00'))
+    return f'{written} invoices for {period} ({total} TMT) in {directory}, {workers} processes'
+
+def previous_month(today=None):
+    today = today or datetime.now()
+    return (today.year, today.month - 1) if today.month > 1 else (today.year - 1, 12)
+
+def invoice_month_dir(directory, year, month):
+    return os.path.join(directory, f'{year}-{month:02d}')
+
+def generate_monthly_invoices(directory, year, month, workers=None):
+    """Invoices of every depot for the month, a subdirectory per depot when there are several"""
+    month_dir = invoice_month_dir(directory, year, month)
+    names = depot_names()
+    if len(names) == 1:
+        return generate_invoices(year, month, month_dir, workers)
+    results = []
+    for name in names:
+        with use_depot(name):
+            results.append(f'{name}: ' + generate_invoices(year, month, os.path.join(month_dir, name), workers,
+                                                           prefix=f'{name}-'))
+    return '; '.join(results)
@@ -0,0 +1,32 @@
+from app import db
+from app.models import Subscriber, Order, Payment
+from app.live import publish_debts
+
+def ledger_debt():
+    """Debt of the Subscriber row in the enclosing statement: unpaid order amounts minus payments"""
+    ordered = db.select(db.func.coalesce(db.func.sum(
+        db.func.coalesce(Order.total_amount, 0) - db.func.coalesce(Order.paid_amount, 0)), 0)) \
+        .where(Order.subscriber_id == Subscriber.id).scalar_subquery()
+    paid = db.select(db.func.coalesce(db.func.sum(Payment.amount), 0)) \
+        .where(Payment.subscriber_id == Subscriber.id).scalar_subquery()
+    return ordered - paid
+
+def recalculate_debts(subscriber_ids=None):
+    """
+    Set debt from the ledger for the given subscribers (all when None)
+    with one UPDATE. Only rows that differ are written; returns their count.
+    Live debt events are published for explicit ids. Does not commit.
+    """
+    expected = ledger_debt()
+    statement = db.update(Subscriber) \
+        .where(db.func.round(db.func.coalesce(Subscriber.debt, 0) - expected, 2) != 0) \
+        .values(debt=expected) \
+        .execution_options(synchronize_session=False)
+    if subscriber_ids is not None:
+        if not subscriber_ids:
+            return 0
+        statement = statement.where(Subscriber.id.in_(list(subscriber_ids)))
+    fixed = db.session.execute(statement).rowcount
+    if subscriber_ids is not None and fixed:
+        publish_debts(subscriber_ids)
+    return fixed
@@ -0,0 +1,144 @@
+"""
+Maintenance jobs run by the scheduler (see app.scheduler).
+
+Jobs on depot data run once per depot, database jobs once per database.
+"""
+import gzip
+import json
+import os
+from datetime import datetime, timedelta
+from sqlalchemy import inspect, text
+from app import db
+from app.depots import all_engines, current_depot, depot_names, for_each_depot
+from app.models import Subscriber, ActionLog, JobRun
+from app.services.ledger import recalculate_debts
+
+def reconcile_debts():
+    """Recompute every subscriber's debt from orders and payments"""
+    # One UPDATE with correlated sums, so orders written meanwhile can't be overwritten by stale totals
+    checked = db.session.query(db.func.count(Subscriber.id)).scalar()
+    fixed = recalculate_debts()
+    db.session.commit()
+    return f'{fixed} of {checked} subscribers corrected'
+
+def archive_logs(directory, retention_days, batch_size=1000):
+    """Move action logs older than retention_days into gzipped JSONL files"""
+    cutoff = datetime.now() - timedelta(days=retention_days)
+    os.makedirs(directory, exist_ok=True)
+    prefix = 'action_logs' if len(depot_names()) == 1 else f'action_logs-{current_depot()}'
+    path = os.path.join(directory, f'{prefix}-{datetime.now():%Y%m}.jsonl.gz')
+
+    archived = 0
+    while True:
+        rows = ActionLog.query.filter(ActionLog.created_at < cutoff) \
+            .order_by(ActionLog.id).limit(batch_size).all()
+        if not rows:
+            break
+        # Appending to a gzip file adds a member, readers see one stream
+        with gzip.open(path, 'at', encoding='utf-8') as f:
+            for log in rows:
+                f.write(json.dumps({
+                    'id': log.id, 'user_id': log.user_id, 'action': log.action, 'entity': log.entity,
+                    'entity_id': log.entity_id, 'details': log.details,
+                    'created_at': log.created_at.isoformat() if log.created_at else None,
+                }, ensure_ascii=False) + '\n')
+        # Commit per batch so the log table is never locked for long
+        ActionLog.query.filter(ActionLog.id.in_([log.id for log in rows])).delete(synchronize_session=False)
+        db.session.commit()
+        archived += len(rows)
+
+    # Job history is kept for the same period
+    pruned = JobRun.query.filter(JobRun.started_at < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+    return f'{archived} logs archived to {os.path.basename(path)}, {pruned} job runs pruned' if archived \
+        else f'nothing to archive, {pruned} job runs pruned'
+
+def _maintain(engine, sqlite_statements, mysql_statement):
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        if engine.dialect.name == 'sqlite':
+            for statement in sqlite_statements:
+                conn.execute(text(statement))
+            return ', '.join(sqlite_statements)
+        if engine.dialect.name == 'mysql' and mysql_statement:
+            present = set(inspect(conn).get_table_names())
+            names = [t.name for t in db.metadata.sorted_tables if t.name in present]
+            conn.execute(text(f"{mysql_statement} TABLE {', '.join(f'`{name}`' for name in names)}"))
+            return f'{mysql_statement} TABLE on {len(names)} tables'
+    return f'not supported on {engine.dialect.name}'
+
+def _run_maintenance(sqlite_statements, mysql_statement):
+    db.session.remove()  # VACUUM can't run while this thread holds a transaction
+    results = [_maintain(engine, sqlite_statements, mysql_statement) for engine in all_engines()]
+    if len(results) == 1:
+        return results[0]
+    return '; '.join(f'{engine.url.database}: {result}' for engine, result in zip(all_engines(), results))
+
+def optimize_database():
+    """Let SQLite refresh statistics where the query planner needs them"""
+    return _run_maintenance(['PRAGMA optimize'], None)
+
+def analyze_database():
+    """Rebuild query planner statistics"""
+    return _run_maintenance(['ANALYZE'], 'ANALYZE')
+
+def vacuum_database():
+    """Rebuild the database file to reclaim free pages"""
+    return _run_maintenance(['VACUUM'], 'OPTIMIZE')
+
+def backup_dir(app):
+    return app.config['BACKUP_DIR'] or os.path.join(app.instance_path, 'backups')
+
+def invoice_dir(app):
+    return app.config['INVOICE_DIR'] or os.path.join(app.instance_path, 'invoices')
+
+def register_jobs(scheduler, app):
+    from app.scheduler import Cron, Interval
+    from app.live import prune_events
+    from app.outbox import outbox_dir, relay_outbox
+    from app.services.backup import backup_databases
+    from app.services.duplicates import scan_duplicates
+    from app.services.invoices import generate_monthly_invoices, previous_month
+    from app.services.refills import predict_refills
+    from app.services.trash import purge_deleted
+
+    app.config.setdefault('LOG_RETENTION_DAYS', 365)
+    app.config.setdefault('LOG_ARCHIVE_DIR', None)
+    app.config.setdefault('PURGE_AFTER_HOURS', 48)
+    app.config.setdefault('BACKUP_DIR', None)
+    app.config.setdefault('BACKUP_KEEP', 28)
+    app.config.setdefault('BACKUP_STEP_PAGES', 100)
+    app.config.setdefault('BACKUP_STEP_PAUSE', 0.05)
+    app.config.setdefault('INVOICE_DIR', None)
+    app.config.setdefault('INVOICE_WORKERS', None)  # processes rendering invoices, None = one per CPU
+    app.config.setdefault('REFILL_HISTORY_DAYS', 365)
+    archive_dir = app.config['LOG_ARCHIVE_DIR'] or os.path.join(app.instance_path, 'archive')
+
+    scheduler.add_job('reconcile_debts', lambda: for_each_depot(reconcile_debts), Cron('30 2 * * *'),
+                      description=reconcile_debts.__doc__)
+    scheduler.add_job('find_duplicates', lambda: for_each_depot(scan_duplicates), Cron('0 1 * * *'),
+                      description=scan_duplicates.__doc__)
+    scheduler.add_job('purge_deleted', lambda: for_each_depot(purge_deleted, app.config['PURGE_AFTER_HOURS']),
+                      Interval(minutes=30), description=purge_deleted.__doc__)
+    scheduler.add_job('archive_logs',
+                      lambda: for_each_depot(archive_logs, archive_dir, app.config['LOG_RETENTION_DAYS']),
+                      Cron('0 3 * * *'), description=archive_logs.__doc__)
+    scheduler.add_job('prune_live_events',
+                      lambda: for_each_depot(prune_events, app.config['LIVE_EVENT_RETENTION_HOURS']),
+                      Interval(hours=1), description=prune_events.__doc__)
+    scheduler.add_job('relay_outbox',
+                      lambda: relay_outbox(outbox_dir(app), app.config['OUTBOX_BATCH_SIZE'],
+                                           app.config['OUTBOX_SEGMENT_EVENTS'], app.config['OUTBOX_RETENTION_DAYS']),
+                      Interval(minutes=1), description=relay_outbox.__doc__)
+    scheduler.add_job('backup_databases',
+                      lambda: backup_databases(backup_dir(app), app.config['BACKUP_KEEP'],
+                                               app.config['BACKUP_STEP_PAGES'], app.config['BACKUP_STEP_PAUSE']),
+                      Cron('15 */6 * * *'), description=backup_databases.__doc__)
+    scheduler.add_job('monthly_invoices',
+                      lambda: generate_monthly_invoices(invoice_dir(app), *previous_month(),
+                                                        workers=app.config['INVOICE_WORKERS']),
+                      Cron('0 5 1 * *'), description=generate_monthly_invoices.__doc__)
+    scheduler.add_job('predict_refills', lambda: for_each_depot(predict_refills, app.config['REFILL_HISTORY_DAYS']),
+                      Cron('45 0 * * *'), description=predict_refills.__doc__)
+    scheduler.add_job('optimize_database', optimize_database, Interval(hours=6), timeout=600)
+    scheduler.add_job('analyze_database', analyze_database, Cron('0 4 * * 0'))
+    scheduler.add_job('vacuum_database', vacuum_database, Cron('30 4 * * 0'))
@@ -1,59 +1,164 @@
-from app.models import Settings, Order
+import threading
+from app import db
+from app.models import Settings, Order, Price, Subscriber
 from decimal import Decimal
 
+OPERATIONS = ['new_bottle', 'exchange', 'water_only', 'container']
+
+# Used when a price row is missing
+DEFAULT_PRICES = {
+    'new_bottle': Decimal('105'),
+    'exchange': Decimal('50'),
+    'water_only': Decimal('15'),
+    'container': Decimal('90'),
+}
+
+# Order column -> price operation
+QUANTITY_OPERATIONS = {
+    'new_bottles': 'new_bottle',
+    'exchange_bottles': 'exchange',
+    'water_only': 'water_only',
+    'free_bottles': 'container',
+}
+
+PRICING_VERSION_KEY = 'pricing_version'
+
+class PricingSnapshot:
+    """
+    Prices and promo rules compiled into a matrix:
+    (client_type, promo applies) -> {operation: unit price}.
+
+    Built once per pricing version and shared by quoting and order creation.
+    """
+
+    def __init__(self, version, prices, settings):
+        self.version = version
+
+        # Promo settings; missing promo_active means ON (behaviour before the switch existed)
+        active = settings.get('promo_active')
+        self.promo_active = active.lower() in ['true', '1', 'on'] if active is not None else True
+        self.promo_price = Decimal(settings['promo_water_price']) if settings.get('promo_water_price') else Decimal('10.00')
+        self.promo_limit = int(settings['promo_water_limit']) if settings.get('promo_water_limit') else 10
+
+        self.matrix = {}
+        for client_type in ['legal', 'individual']:
+            base = {}
+            for op in OPERATIONS:
+                price = prices.get(op)
+                if price is None:
+                    base[op] = DEFAULT_PRICES[op]
+                elif client_type == 'legal':
+                    base[op] = Decimal(str(price.legal_price))
+                else:
+                    base[op] = Decimal(str(price.individual_price))
+            self.matrix[(client_type, False)] = base
+            self.matrix[(client_type, True)] = self._apply_promo(base)
+
+    def _apply_promo(self, base):
+        # Promo sets water to the promo price and takes the same discount
+        # off the other water-containing products. Container is unchanged.
+        promo = dict(base)
+        delta = base['water_only'] - self.promo_price
+        if delta > 0:
+            promo['water_only'] = self.promo_price
+            promo['new_bottle'] = base['new_bottle'] - delta
+            promo['exchange'] = base['exchange'] - delta
+        return promo
+
+    def unit_prices(self, client_type, promo=False):
+        client_type = 'legal' if client_type == 'legal' else 'individual'
+        return self.matrix[(client_type, bool(promo) and self.promo_active)]
+
+    def limit_for(self, subscriber):
+        # promo_custom_limit overrides the global limit for this subscriber
+        if subscriber is not None and subscriber.promo_custom_limit is not None:
+            return subscriber.promo_custom_limit
+        return self.promo_limit
+
+    def promo_applies(self, subscriber, order_count):
+        return self.promo_active and order_count < self.limit_for(subscriber)
+
+    def quote(self, client_type, promo=False, **quantities):
+        """Total for order quantities given by column name (new_bottles, exchange_bottles, ...)"""
+        prices = self.unit_prices(client_type, promo)
+        return sum((Decimal(quantities.get(column) or 0) * prices[op]
+                    for column, op in QUANTITY_OPERATIONS.items()), Decimal('0'))
+
+_cache = {'version': None, 'snapshot': None, 'hits': 0, 'misses': 0}
+_cache_lock = threading.Lock()
+
+def get_pricing_version():
+    setting = db.session.get(Settings, PRICING_VERSION_KEY)
+    return setting.value if setting else '0'
+
+def bump_pricing_version():
+    """Mark prices/promo settings as changed. Call before committing the change."""
+    setting = db.session.get(Settings, PRICING_VERSION_KEY)
+    if not setting:
+        setting = Settings(key=PRICING_VERSION_KEY, value='0', description='Incremented on every price or promo change')
+        db.session.add(setting)
+    setting.value = str(int(setting.value or 0) + 1)
+
+def get_pricing():
+    """Return the compiled pricing snapshot, rebuilding it only when the version changed"""
+    version = get_pricing_version()
+    snapshot = _cache['snapshot']
+    if snapshot is not None and _cache['version'] == version:
+        _cache['hits'] += 1
+        return snapshot
+    _cache['misses'] += 1
+
+    prices = {p.operation_type: p for p in Price.query.all()}
+    settings = {s.key: s.value for s in Settings.query.filter(
+        Settings.key.in_(['promo_water_price', 'promo_water_limit', 'promo_active'])
+    )}
+    snapshot = PricingSnapshot(version, prices, settings)
+    with _cache_lock:
+        _cache['version'] = version
+        _cache['snapshot'] = snapshot
+    return snapshot
+
+def pricing_cache_stats():
+    return _cache['hits'], _cache['misses']
+
+def promo_order_counts(subscriber_ids):
+    """
+    Count promo-relevant orders for many subscribers with one grouped query.
+    Only orders after the subscriber's promo_start_date are counted.
+    """
+    if not subscriber_ids:
+        return {}
+    rows = db.session.query(Order.subscriber_id, db.func.count(Order.id)) \
+        .join(Subscriber, Subscriber.id == Order.subscriber_id) \
+        .filter(Order.subscriber_id.in_(subscriber_ids)) \
+        .filter(db.or_(Subscriber.promo_start_date.is_(None),
+                       Order.created_at >= Subscriber.promo_start_date)) \
+        .group_by(Order.subscriber_id).all()
+    counts = {sid: 0 for sid in subscriber_ids}
+    counts.update(dict(rows))
+    return counts
+
 def get_promo_water_price(subscriber_id):
     """
     Check if promo price applies for "Water Only".
-    
+
     Returns:
         Decimal: The promo price (e.g. 10.00) if applicable.
         None: If promo does not apply (use standard pricing).
     """
     try:
-        # Get promo settings
-        promo_price_setting = Settings.query.get('promo_water_price')
-        promo_limit_setting = Settings.query.get('promo_water_limit')
-        promo_active_setting = Settings.query.get('promo_active')
-        
-        # Check if promo is globally active
-        # Default to False if setting is missing, or True? 
-        # Plan said: "If value is not true/1/on, return None".
-        # Let's default to True for backward compatibility if not set, or False?
-        # User said "activation button", implying it might be off by default or they want control.
-        # Let's treat missing as False to be safe, or True to not break existing flow?
-        # Safe approach: If missing, assume it's ON (since it was working before). 
-        # But if they want to "turn it on", maybe default OFF?
-        # Let's check the setting. If it has 'true', '1', 'on', it's active.
-        
-        is_active = True # Default behavior before this feature
-        if promo_active_setting:
-             is_active = promo_active_setting.value.lower() in ['true', '1', 'on']
-        
-        if not is_active:
-             return None
-
-        # Defaults if settings missing (fallback)
-        promo_price = Decimal(promo_price_setting.value) if promo_price_setting else Decimal('10.00')
-        limit = int(promo_limit_setting.value) if promo_limit_setting else 10
-        
-        # Check subscriber specific settings
-        from app.models import Subscriber
-        subscriber = Subscriber.query.get(subscriber_id)
-        
-        # Count existing orders for this subscriber
-        # If start date set, only count orders after that date
-        query = Order.query.filter_by(subscriber_id=subscriber_id)
-        
-        if subscriber and subscriber.promo_start_date:
-            query = query.filter(Order.created_at >= subscriber.promo_start_date)
-            
-        order_count = query.count()
-        
-        if order_count < limit:
-            return promo_price
-            
+        pricing = get_pricing()
+        if not pricing.promo_active:
+            return None
+
+        subscriber = db.session.get(Subscriber, subscriber_id)
+        order_count = promo_order_counts([subscriber_id])[subscriber_id]
+
+        if pricing.promo_applies(subscriber, order_count):
+            return pricing.promo_price
+
         return None
-        
+
     except Exception as e:
         # Log error? Return None to be safe and fall back to standard pricing
         print(f"Error calculating promo price: {e}")
@@ -0,0 +1,82 @@
+from app import db
+from app.models import Order, Subscriber
+from app.services.pricing import get_pricing
+
+def promo_eligibility_query(pricing, client_type=None, status=None):
+    """
+    Promo order count, limit and remaining orders for every subscriber in
+    one grouped query.
+
+    Only orders on or after promo_start_date are counted and
+    promo_custom_limit overrides the global limit, same as order pricing.
+    status: 'eligible' (orders remaining), 'exhausted' or None for all.
+    """
+    counted = db.and_(
+        Order.subscriber_id == Subscriber.id,
+        db.or_(Subscriber.promo_start_date.is_(None), Order.created_at >= Subscriber.promo_start_date)
+    )
+    order_count = db.func.count(Order.id)
+    limit = db.func.coalesce(Subscriber.promo_custom_limit, pricing.promo_limit)
+    remaining = db.case((limit - order_count > 0, limit - order_count), else_=0)
+
+    query = db.select(
+        Subscriber.id,
+        Subscriber.client_type,
+        Subscriber.address,
+        Subscriber.promo_start_date,
+        Subscriber.promo_custom_limit,
+        order_count.label('order_count'),
+        limit.label('promo_limit'),
+        remaining.label('remaining'),
+    ).outerjoin(Order, counted) \
+     .group_by(Subscriber.id, Subscriber.client_type, Subscriber.address,
+               Subscriber.promo_start_date, Subscriber.promo_custom_limit) \
+     .order_by(Subscriber.id.desc())
+
+    if client_type:
+        query = query.where(Subscriber.client_type == client_type)
+    if status == 'eligible':
+        query = query.having(remaining > 0)
+    elif status == 'exhausted':
+        query = query.having(remaining <= 0)
+    return query
+
+def iter_promo_eligibility(client_type=None, status=None, pricing=None, batch_size=1000):
+    """Yield per-subscriber promo state as dicts"""
+    pricing = pricing or get_pricing()
+    result = db.session.execute(
+        promo_eligibility_query(pricing, client_type, status).execution_options(yield_per=batch_size)
+    )
+    for row in result:
+        yield {
+            'id': row.id,
+            'client_type': row.client_type,
+            'address': row.address,
+            'promo_start_date': row.promo_start_date,
+            'promo_custom_limit': row.promo_custom_limit,
+            'order_count': row.order_count,
+            'promo_limit': row.promo_limit,
+            'remaining': row.remaining,
+            # Promo switched off globally means nobody gets the price
+            'eligible': pricing.promo_active and row.remaining > 0,
+        }
+
+def promo_summary(client_type=None, pricing=None):
+    """Counts of eligible / exhausted subscribers and remaining promo orders in one query"""
+    pricing = pricing or get_pricing()
+    per_subscriber = promo_eligibility_query(pricing, client_type).order_by(None).subquery()
+    row = db.session.execute(db.select(
+        db.func.count(),
+        db.func.sum(db.case((per_subscriber.c.remaining > 0, 1), else_=0)),
+        db.func.sum(per_subscriber.c.remaining),
+    ).select_from(per_subscriber)).one()
+    total, with_remaining, remaining = row[0], row[1] or 0, row[2] or 0
+    return {
+        'active': pricing.promo_active,
+        'price': pricing.promo_price,
+        'limit': pricing.promo_limit,
+        'subscribers': total,
+        'eligible': with_remaining if pricing.promo_active else 0,
+        'exhausted': total - with_remaining,
+        'remaining_orders': remaining,
+    }
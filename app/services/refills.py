@@ -0,0 +1,153 @@
+"""
+Refill-due prediction from order history.
+
+A subscriber uses up the water of all their orders but the last one
+between their first and last order, which gives a consumption rate in
+bottles per day; the last order lasts its bottles / rate days from its
+date. Subscribers with fewer than two orders, or all of them within a
+day, get no forecast.
+
+The history is loaded as three columns (subscriber id, day, bottles)
+sorted by subscriber and date, and the forecast is computed on whole
+arrays with NumPy: group boundaries where the subscriber id changes,
+sums per group with np.add.reduceat. Without NumPy the same columns are
+walked group by group in Python. Results replace the refill_forecasts
+table of the depot.
+"""
+from array import array
+from datetime import datetime, timedelta
+from app import db
+from app.models import Order, Phone, RefillForecast, Subscriber
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+EPOCH = datetime(2000, 1, 1)
+MIN_SPAN_DAYS = 1.0
+MIN_DAYS_LEFT = 1.0
+MAX_DAYS_LEFT = 120.0
+
+def _to_day(value):
+    return (value - EPOCH).total_seconds() / 86400
+
+def _from_day(day):
+    return EPOCH + timedelta(days=day)
+
+def load_order_history(since, batch_size=10000):
+    """(subscriber ids, days since EPOCH, bottles) of the orders since `since`, by subscriber and date"""
+    bottles = db.func.coalesce(Order.new_bottles, 0) + db.func.coalesce(Order.exchange_bottles, 0) + \
+        db.func.coalesce(Order.water_only, 0)
+    result = db.session.execute(
+        db.select(Order.subscriber_id, Order.created_at, bottles)
+        .where(Order.created_at >= since)
+        .order_by(Order.subscriber_id, Order.created_at)
+        .execution_options(yield_per=batch_size)
+    )
+    ids, days, quantities = array('q'), array('d'), array('d')
+    for partition in result.partitions():
+        for subscriber_id, created_at, quantity in partition:
+            ids.append(subscriber_id)
+            days.append(_to_day(created_at))
+            quantities.append(quantity)
+    return ids, days, quantities
+
+def _forecast_numpy(ids, days, quantities):
+    ids = np.frombuffer(ids, dtype=np.int64)
+    days = np.frombuffer(days, dtype=np.float64)
+    quantities = np.frombuffer(quantities, dtype=np.float64)
+    starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+    ends = np.r_[starts[1:], len(ids)] - 1
+
+    counts = ends - starts + 1
+    span = days[ends] - days[starts]
+    consumed = np.add.reduceat(quantities, starts) - quantities[ends]
+    ok = (counts >= 2) & (span >= MIN_SPAN_DAYS) & (consumed > 0)
+
+    starts, ends, counts, span, consumed = starts[ok], ends[ok], counts[ok], span[ok], consumed[ok]
+    rate = consumed / span
+    days_left = np.clip(quantities[ends] / rate, MIN_DAYS_LEFT, MAX_DAYS_LEFT)
+    return list(zip(ids[ends].tolist(), counts.tolist(), (span / (counts - 1)).tolist(), rate.tolist(),
+                    days[ends].tolist(), quantities[ends].tolist(), (days[ends] + days_left).tolist()))
+
+def _forecast_python(ids, days, quantities):
+    forecasts = []
+    start = 0
+    for end in range(1, len(ids) + 1):
+        if end < len(ids) and ids[end] == ids[start]:
+            continue
+        last = end - 1
+        count = end - start
+        span = days[last] - days[start]
+        consumed = sum(quantities[start:last])
+        if count >= 2 and span >= MIN_SPAN_DAYS and consumed > 0:
+            rate = consumed / span
+            days_left = min(max(quantities[last] / rate, MIN_DAYS_LEFT), MAX_DAYS_LEFT)
+            forecasts.append((ids[last], count, span / (count - 1), rate, days[last], quantities[last],
+                              days[last] + days_left))
+        start = end
+    return forecasts
+
+def forecast_refills(ids, days, quantities):
+    """[(subscriber id, orders, interval days, bottles per day, last order day, last bottles, due day)]"""
+    if not ids:
+        return []
+    return (_forecast_numpy if np is not None else _forecast_python)(ids, days, quantities)
+
+def predict_refills(history_days=365, batch_size=1000):
+    """Estimate each subscriber's next refill date from their order history"""
+    now = datetime.now()
+    ids, days, quantities = load_order_history(now - timedelta(days=history_days))
+    forecasts = forecast_refills(ids, days, quantities)
+
+    rows = [{'subscriber_id': subscriber_id, 'orders': count, 'interval_days': round(interval, 2),
+             'bottles_per_day': round(rate, 3), 'last_order_at': _from_day(last_day), 'last_bottles': int(last_bottles),
+             'due_at': _from_day(due_day).replace(microsecond=0), 'computed_at': now}
+            for subscriber_id, count, interval, rate, last_day, last_bottles, due_day in forecasts]
+    db.session.execute(db.delete(RefillForecast))
+    for start in range(0, len(rows), batch_size):
+        db.session.execute(db.insert(RefillForecast), rows[start:start + batch_size])
+    db.session.commit()
+
+    due = sum(1 for row in rows if row['due_at'] < now + timedelta(days=1))
+    return f"{len(rows)} forecasts from {len(ids)} orders ({'numpy' if np is not None else 'python'}), " \
+           f"{due} due by tomorrow"
+
+def iter_due_refills(until, since=None, client_type=None, batch_size=500):
+    """
+    Forecasts due before `until` (and from `since`), soonest first, as dicts
+    with the subscriber's address and phones. Subscribers who ordered after
+    the forecast was computed are left out.
+    """
+    ordered_since = db.exists().where(Order.subscriber_id == RefillForecast.subscriber_id,
+                                      Order.created_at > RefillForecast.last_order_at)
+    query = db.select(RefillForecast, Subscriber.client_type, Subscriber.address) \
+        .join(Subscriber, Subscriber.id == RefillForecast.subscriber_id) \
+        .where(RefillForecast.due_at < until, ~ordered_since) \
+        .order_by(RefillForecast.due_at, RefillForecast.subscriber_id)
+    if since:
+        query = query.where(RefillForecast.due_at >= since)
+    if client_type:
+        query = query.where(Subscriber.client_type == client_type)
+
+    result = db.session.execute(query.execution_options(yield_per=batch_size))
+    for partition in result.partitions():
+        ids = [forecast.subscriber_id for forecast, _, _ in partition]
+        phones = {}
+        for subscriber_id, number in db.session.query(Phone.subscriber_id, Phone.number) \
+                .filter(Phone.subscriber_id.in_(ids)).order_by(Phone.id):
+            phones.setdefault(subscriber_id, []).append(number)
+        for forecast, client_type_, address in partition:
+            yield {
+                'id': forecast.subscriber_id,
+                'client_type': client_type_,
+                'address': address,
+                'phones': ', '.join(phones.get(forecast.subscriber_id, [])),
+                'due_at': forecast.due_at,
+                'last_order_at': forecast.last_order_at,
+                'last_bottles': forecast.last_bottles,
+                'interval_days': forecast.interval_days,
+                'bottles_per_day': forecast.bottles_per_day,
+                'orders': forecast.orders,
+            }
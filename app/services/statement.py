@@ -0,0 +1,69 @@
+from decimal import Decimal
+from app import db
+from app.models import Order, Payment
+
+STATEMENT_COLUMNS = ['kind', 'id', 'created_at', 'new_bottles', 'exchange_bottles',
+                     'water_only', 'free_bottles', 'debit', 'credit', 'balance']
+
+def statement_query(subscriber_id):
+    """
+    Build one ordered query with all orders and payments of a subscriber.
+
+    Orders add total_amount to the balance and subtract paid_amount,
+    payments subtract amount. The running balance is a window SUM over the
+    merged rows, so the database does the work and we only iterate.
+    """
+    orders = db.select(
+        db.literal('order').label('kind'),
+        Order.id.label('id'),
+        Order.created_at.label('created_at'),
+        Order.new_bottles.label('new_bottles'),
+        Order.exchange_bottles.label('exchange_bottles'),
+        Order.water_only.label('water_only'),
+        Order.free_bottles.label('free_bottles'),
+        Order.total_amount.label('debit'),
+        db.func.coalesce(Order.paid_amount, 0).label('credit'),
+    ).where(Order.subscriber_id == subscriber_id)
+
+    payments = db.select(
+        db.literal('payment').label('kind'),
+        Payment.id.label('id'),
+        Payment.created_at.label('created_at'),
+        db.literal(0).label('new_bottles'),
+        db.literal(0).label('exchange_bottles'),
+        db.literal(0).label('water_only'),
+        db.literal(0).label('free_bottles'),
+        db.literal(0).label('debit'),
+        Payment.amount.label('credit'),
+    ).where(Payment.subscriber_id == subscriber_id)
+
+    ledger = db.union_all(orders, payments).subquery()
+    # Orders sort before payments made at the same moment
+    ordering = (ledger.c.created_at, ledger.c.kind, ledger.c.id)
+
+    return db.select(
+        *ledger.c,
+        db.func.sum(ledger.c.debit - ledger.c.credit).over(order_by=ordering).label('balance'),
+    ).order_by(*ordering)
+
+def iter_statement(subscriber_id, batch_size=500):
+    """Yield statement rows as dicts, fetching from the cursor in batches"""
+    result = db.session.execute(
+        statement_query(subscriber_id).execution_options(yield_per=batch_size)
+    )
+    for row in result:
+        yield {
+            'kind': row.kind,
+            'id': row.id,
+            'created_at': row.created_at,
+            'new_bottles': row.new_bottles or 0,
+            'exchange_bottles': row.exchange_bottles or 0,
+            'water_only': row.water_only or 0,
+            'free_bottles': row.free_bottles or 0,
+            'debit': _money(row.debit),
+            'credit': _money(row.credit),
+            'balance': _money(row.balance),
+        }
+
+def _money(value):
+    return Decimal(str(value or 0)).quantize(Decimal('0.01'))
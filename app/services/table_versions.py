@@ -0,0 +1,60 @@
+from datetime import datetime
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+from app import db
+from app.depots import engine_for_table
+from app.models import TableVersion
+
+# Tables whose changes invalidate cached pages and JSON
+TRACKED_TABLES = {'subscribers', 'phones', 'orders', 'payments', 'prices', 'settings', 'users'}
+
+def bump_table_versions(connection, names):
+    """Increment the version of each table name on the given connection"""
+    now = datetime.now()
+    table = TableVersion.__table__
+    for name in sorted(names):
+        result = connection.execute(
+            table.update().where(table.c.name == name).values(version=table.c.version + 1, updated_at=now)
+        )
+        if result.rowcount == 0:
+            connection.execute(table.insert().values(name=name, version=1, updated_at=now))
+
+def _by_engine(names):
+    """Group table names by the engine holding them (a version lives next to its table)"""
+    groups = {}
+    for name in names:
+        groups.setdefault(engine_for_table(name), []).append(name)
+    return groups.items()
+
+def get_table_versions(names):
+    """Return {name: (version, updated_at)} for the given tables, one query per database"""
+    versions = {name: (0, None) for name in names}
+    for engine, group in _by_engine(names):
+        rows = db.session.execute(
+            select(TableVersion.name, TableVersion.version, TableVersion.updated_at)
+            .where(TableVersion.name.in_(group)),
+            bind_arguments={'bind': engine}
+        ).all()
+        versions.update({name: (version, updated_at) for name, version, updated_at in rows})
+    return versions
+
+@event.listens_for(Session, 'after_flush')
+def _bump_after_flush(session, flush_context):
+    # new/dirty/deleted still describe what was just flushed
+    names = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        name = getattr(obj, '__tablename__', None)
+        if name in TRACKED_TABLES:
+            names.add(name)
+    for engine, group in _by_engine(names):
+        bump_table_versions(session.connection(bind_arguments={'bind': engine}), group)
+
+@event.listens_for(Session, 'do_orm_execute')
+def _bump_on_bulk_write(orm_execute_state):
+    # Query.delete() / update() and bulk inserts bypass the flush
+    if not (orm_execute_state.is_delete or orm_execute_state.is_update or orm_execute_state.is_insert):
+        return
+    mapper = orm_execute_state.bind_mapper
+    name = mapper.local_table.name if mapper is not None else None
+    if name in TRACKED_TABLES:
+        bump_table_versions(orm_execute_state.session.connection(bind_arguments={'bind': engine_for_table(name)}), [name])
@@ -0,0 +1,96 @@
+"""
+Soft delete for subscribers and orders.
+
+Deleting only sets deleted_at, one row, so the write lock is held for a
+moment. The listener below hides deleted subscribers and orders, and the
+orders and payments of deleted subscribers, from every ORM statement
+(lists, search, debt recalculation, promo counts, reports). Pass the
+execution option include_deleted=True to see them.
+
+Within PURGE_AFTER_HOURS a deletion can be undone. After that the
+purge_deleted job removes the rows in batches, each in its own short
+transaction, so other writers get the database between batches.
+"""
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session, with_loader_criteria
+from flask_login import current_user
+from app import db
+from app.models import Subscriber, Phone, Order, Payment, DuplicateCandidate
+
+_deleted_subscribers = select(Subscriber.__table__.c.id).where(Subscriber.__table__.c.deleted_at.isnot(None))
+
+def _subscriber_alive(cls):
+    return cls.subscriber_id.not_in(_deleted_subscribers)
+
+@event.listens_for(Session, 'do_orm_execute')
+def _hide_deleted(orm_execute_state):
+    state = orm_execute_state
+    if not (state.is_select or state.is_update or state.is_delete) or state.execution_options.get('include_deleted'):
+        return
+    state.statement = state.statement.options(
+        with_loader_criteria(Subscriber, Subscriber.deleted_at.is_(None), include_aliases=True),
+        with_loader_criteria(Order, lambda cls: cls.deleted_at.is_(None) & _subscriber_alive(cls),
+                             include_aliases=True),
+        with_loader_criteria(Payment, _subscriber_alive, include_aliases=True),
+    )
+
+def _deleted_by():
+    return current_user.id if current_user.is_authenticated else None
+
+def soft_delete_subscriber(subscriber):
+    """Hide the subscriber with its orders and payments; does not commit"""
+    subscriber.deleted_at = datetime.now()
+    subscriber.deleted_by = _deleted_by()
+
+def soft_delete_order(order):
+    order.deleted_at = datetime.now()
+    order.deleted_by = _deleted_by()
+
+def deleted_query(model):
+    """Soft-deleted rows of model that can still be restored, newest first"""
+    return model.query.execution_options(include_deleted=True) \
+        .filter(model.deleted_at.isnot(None)).order_by(model.deleted_at.desc())
+
+def restore(model, id):
+    """Undo a soft delete, returns the row or None if it is gone (purged or never deleted)"""
+    row = deleted_query(model).filter(model.id == id).first()
+    if row is not None:
+        row.deleted_at = None
+        row.deleted_by = None
+    return row
+
+def _purge_batches(model, condition, batch_size, pause):
+    deleted = 0
+    while True:
+        ids = db.session.execute(select(model.id).where(condition).limit(batch_size),
+                                 execution_options={'include_deleted': True}).scalars().all()
+        if not ids:
+            return deleted
+        db.session.execute(db.delete(model).where(model.id.in_(ids)),
+                           execution_options={'include_deleted': True, 'synchronize_session': False})
+        db.session.commit()
+        deleted += len(ids)
+        if pause:
+            time.sleep(pause)
+
+def purge_deleted(older_than_hours, batch_size=500, pause=0.05):
+    """Remove subscribers and orders deleted more than older_than_hours ago, in batches"""
+    cutoff = datetime.now() - timedelta(hours=older_than_hours)
+    orders = _purge_batches(Order, Order.deleted_at < cutoff, batch_size, pause)
+
+    subscriber_ids = db.session.execute(select(Subscriber.id).where(Subscriber.deleted_at < cutoff),
+                                        execution_options={'include_deleted': True}).scalars().all()
+    db.session.rollback()  # don't hold the read transaction between batches
+    payments = 0
+    for subscriber_id in subscriber_ids:
+        orders += _purge_batches(Order, Order.subscriber_id == subscriber_id, batch_size, pause)
+        payments += _purge_batches(Payment, Payment.subscriber_id == subscriber_id, batch_size, pause)
+        _purge_batches(Phone, Phone.subscriber_id == subscriber_id, batch_size, pause)
+        db.session.execute(db.delete(DuplicateCandidate).where(db.or_(
+            DuplicateCandidate.subscriber_id == subscriber_id, DuplicateCandidate.duplicate_id == subscriber_id)))
+        db.session.execute(db.delete(Subscriber).where(Subscriber.id == subscriber_id),
+                           execution_options={'include_deleted': True, 'synchronize_session': False})
+        db.session.commit()
+    return f'{len(subscriber_ids)} subscribers, {orders} orders, {payments} payments purged'
@@ -0,0 +1,88 @@
+"""
+Warm start for new workers.
+
+Jinja compiles every template to Python code the first time it is used.
+The compiled code is kept on disk in a bytecode cache (JINJA_CACHE_DIR,
+instance/jinja_cache by default), so a worker started after the first one
+only loads it; a changed template is compiled again, the cache is keyed
+on the source.
+
+warm_up() does the rest of what the first requests would do: loads every
+template, builds the URL matcher and the pricing snapshot, and opens the
+database pool connections. serve.py --warmup runs it in each worker
+before it starts accepting, `flask warm-up` fills the bytecode cache
+during a deploy.
+"""
+import logging
+import os
+import time
+from jinja2 import FileSystemBytecodeCache
+
+logger = logging.getLogger('sarwan.warmup')
+
+def template_cache_dir(app):
+    return app.config['JINJA_CACHE_DIR'] or os.path.join(app.instance_path, 'jinja_cache')
+
+def init_template_cache(app):
+    app.config.setdefault('JINJA_BYTECODE_CACHE', True)
+    app.config.setdefault('JINJA_CACHE_DIR', None)
+    if not app.config['JINJA_BYTECODE_CACHE']:
+        return
+    directory = template_cache_dir(app)
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError as e:
+        logger.warning('Jinja bytecode cache disabled, %s', e)
+        return
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+
+def _open_connections(engine, count):
+    """Check out up to count connections at once so the pool keeps them open"""
+    size = getattr(engine.pool, 'size', None)
+    count = min(count, size()) if callable(size) else 1
+    connections = []
+    try:
+        for _ in range(count):
+            connection = engine.connect()
+            connections.append(connection)
+            connection.exec_driver_sql('SELECT 1')
+    finally:
+        for connection in connections:
+            connection.close()
+    return len(connections)
+
+def warm_up(app, connections=4):
+    """Do the first requests' one-time work now, returns {step: milliseconds}"""
+    from app import db
+    from app.depots import all_engines
+    from app.services.pricing import get_pricing
+
+    timings = {}
+    started = step = time.perf_counter()
+
+    def done(name):
+        nonlocal step
+        now = time.perf_counter()
+        timings[name] = round((now - step) * 1000, 1)
+        step = now
+
+    with app.app_context():
+        names = [name for name in app.jinja_env.list_templates() if name.endswith(('.html', '.txt', '.xml'))]
+        for name in names:
+            app.jinja_env.get_template(name)
+        done('templates')
+
+        app.url_map.bind('localhost').match('/')
+        done('routes')
+
+        opened = sum(_open_connections(engine, connections) for engine in all_engines())
+        done('connections')
+
+        get_pricing()
+        db.session.remove()
+        done('pricing')
+
+    timings['total'] = round((time.perf_counter() - started) * 1000, 1)
+    logger.info('Warmed up in %.0fms: %d templates, %d connections (%s)', timings['total'], len(names), opened,
+                ', '.join(f'{name} {ms:.0f}ms' for name, ms in timings.items() if name != 'total'))
+    return timings
@@ -0,0 +1,144 @@
+"""
+Cold-start benchmark: how long a freshly started worker takes to serve.
+
+Starts serve.py with one worker on a free port, three times:
+
+    cold       empty Jinja bytecode cache, no warm-up
+    bytecode   bytecode cache filled by the previous run, no warm-up
+    warmup     bytecode cache filled, serve.py --warmup
+
+and measures the time from start until /healthz answers, then the first
+and the second load of the main pages as admin. The difference between
+first and second load is the work a worker does once. Run it against a
+seeded database:
+
+    DATABASE_URL=sqlite:////path/to/suw_crm.db python cold_start.py --output cold_start.json
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+PAGES = ['/subscribers/', '/orders/', '/admin/users', '/admin/prices', '/admin/settings', '/reports/aging']
+SCENARIOS = [
+    ('cold', False),
+    ('bytecode', False),
+    ('warmup', True),
+]
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    """Time each page on its own, a redirect is not followed"""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+def timed(opener, url, data=None, status=200):
+    started = time.perf_counter()
+    try:
+        with opener.open(url, data=data, timeout=60) as response:
+            response.read()
+            code = response.status
+    except urllib.error.HTTPError as e:
+        e.read()
+        code = e.code
+    if code != status:
+        raise SystemExit(f'{url} answered {code}, expected {status}')
+    return round((time.perf_counter() - started) * 1000, 1)
+
+def run_scenario(name, warmup, cache_dir, args):
+    port = free_port()
+    base = f'http://127.0.0.1:{port}'
+    command = [sys.executable, 'serve.py', '--workers', '1', '--threads', str(args.threads),
+               '--port', str(port), '--host', '127.0.0.1', '--access-log', '']
+    if warmup:
+        command.append('--warmup')
+    env = dict(os.environ, JINJA_CACHE_DIR=cache_dir, SCHEDULER_ENABLED='')
+    env.pop('WARMUP', None)
+
+    started = time.perf_counter()
+    server = subprocess.Popen(command, env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+                                             NoRedirect())
+        while True:
+            if server.poll() is not None:
+                raise SystemExit(f'{name}: server exited with status {server.returncode}')
+            try:
+                timed(opener, base + '/healthz')
+                break
+            except (urllib.error.URLError, ConnectionError, SystemExit):
+                time.sleep(0.02)
+        ready = round((time.perf_counter() - started) * 1000, 1)
+
+        login = urllib.parse.urlencode({'username': args.username, 'password': args.password}).encode()
+        first = {'/auth/login': timed(opener, base + '/auth/login')}
+        first['POST /auth/login'] = timed(opener, base + '/auth/login', login, status=302)
+        for page in PAGES:
+            first[page] = timed(opener, base + page)
+        second = {page: timed(opener, base + page) for page in PAGES}
+    finally:
+        server.send_signal(signal.SIGTERM)
+        try:
+            server.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+    return {
+        'scenario': name,
+        'warmup': warmup,
+        'ready_ms': ready,
+        'first_ms': first,
+        'second_ms': second,
+        'first_pages_ms': round(sum(first[page] for page in PAGES), 1),
+        'second_pages_ms': round(sum(second[page] for page in PAGES), 1),
+    }
+
+def main(args):
+    cache_dir = tempfile.mkdtemp(prefix='jinja-cache-')
+    try:
+        results = [run_scenario(name, warmup, cache_dir, args) for name, warmup in SCENARIOS]
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    print("\n" + "=" * 72)
+    print(f"{'scenario':10} {'ready':>9} {'1st login':>10} {'1st pages':>10} {'2nd pages':>10} {'to warm':>10}")
+    print("=" * 72)
+    for r in results:
+        print(f"{r['scenario']:10} {r['ready_ms']:>7}ms {r['first_ms']['/auth/login']:>8}ms "
+              f"{r['first_pages_ms']:>8}ms {r['second_pages_ms']:>8}ms "
+              f"{round(r['ready_ms'] + r['first_ms']['/auth/login'] + r['first_pages_ms'], 1):>8}ms")
+    print("=" * 72)
+    print("ready: start to first /healthz answer; to warm: ready + first login page + first page loads")
+    for page in PAGES:
+        print(f"  {page:22} " + '  '.join(f"{r['scenario']} {r['first_ms'][page]}/{r['second_ms'][page]}ms"
+                                          for r in results))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'config': {'threads': args.threads, 'pages': PAGES}, 'scenarios': results},
+                      f, indent=2, ensure_ascii=False)
+        print(f"💾 Summary written to {args.output}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Suw CRM worker cold-start benchmark')
+    parser.add_argument('--threads', type=int, default=4, help='request threads of the worker')
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', default='admin123')
+    parser.add_argument('--output', help='write JSON summary here')
+    main(parser.parse_args())
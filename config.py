@@ -4,3 +4,10 @@ class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'suw-crm-turkmenistan-2024'
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///suw_crm.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Depots with their own database, e.g. "main,north=sqlite:///north.db" (a depot
+    # without a URL uses DATABASE_URL). Users, prices and settings stay in DATABASE_URL.
+    DEPOT_DATABASES = os.environ.get('DEPOT_DATABASES', '')
+    # Run scheduled maintenance jobs in this process (or use `flask jobs worker`)
+    SCHEDULER_ENABLED = os.environ.get('SCHEDULER_ENABLED', '').lower() in ('1', 'true', 'yes')
+    # Compiled templates are cached here (default instance/jinja_cache, see app/warmup.py)
+    JINJA_CACHE_DIR = os.environ.get('JINJA_CACHE_DIR') or None
@@ -0,0 +1,34 @@
+import contextlib
+import io
+import os
+import pytest
+
+@pytest.fixture
+def app(tmp_path):
+    """An app on a freshly seeded SQLite database"""
+    # Config reads DATABASE_URL at import, so set both (as stress_test.py does)
+    database_url = 'sqlite:///' + str(tmp_path / 'test.db')
+    os.environ['DATABASE_URL'] = database_url
+    import config
+    config.Config.SQLALCHEMY_DATABASE_URI = database_url
+    import seed
+    with contextlib.redirect_stdout(io.StringIO()):
+        seed.seed()
+    from app import create_app, db
+    app = create_app()
+    app.config['TESTING'] = True
+    yield app
+    with app.app_context():
+        db.session.remove()
+        for engine in db.engines.values():
+            engine.dispose()
+
+@pytest.fixture
+def client(app):
+    """Test client logged in as admin, with the id of the first subscriber"""
+    client = app.test_client()
+    client.post('/auth/login', data={'username': 'admin', 'password': 'admin123'})
+    with app.app_context():
+        from app.models import Subscriber
+        client.subscriber_id = Subscriber.query.order_by(Subscriber.id).first().id
+    return client
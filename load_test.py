@@ -0,0 +1,315 @@
+"""
+Load test for Suw CRM with realistic operator workflows.
+Run against a local server (seeded users admin / accountant / operator):
+
+    python load_test.py --concurrency 20 --duration 60 --output summary.json
+
+Each virtual user logs in with one role and keeps replaying weighted
+workflows. The report has throughput, p50/p95/p99 latency per endpoint,
+error and lock-timeout rates, and is also written as JSON so runs can be
+diffed between releases. Uses only asyncio (no extra packages).
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from collections import defaultdict
+from urllib.parse import urlencode, urlsplit
+
+DEFAULT_USERS = {
+    'admin': ('admin', 'admin123'),
+    'accountant': ('accountant', 'acc123'),
+    'operator': ('operator', 'operator123'),
+}
+
+class HTTPError(Exception):
+    pass
+
+class Client:
+    """Minimal HTTP/1.1 keep-alive client with a cookie jar"""
+
+    def __init__(self, base_url, timeout):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.timeout = timeout
+        self.cookies = {}
+        self.reader = self.writer = None
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+        self.reader = self.writer = None
+
+    async def request(self, method, path, form=None):
+        # A kept-alive connection may have been closed by the server, retry once on a fresh one
+        for attempt in range(2):
+            reused = self.writer is not None
+            try:
+                return await asyncio.wait_for(self._request(method, path, form), self.timeout)
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                await self.close()
+                if not reused or attempt:
+                    raise HTTPError(str(e))
+            except asyncio.TimeoutError:
+                await self.close()
+                raise
+
+    async def _request(self, method, path, form):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+        body = urlencode(form, doseq=True).encode() if form is not None else b''
+        headers = [f'{method} {path} HTTP/1.1', f'Host: {self.host}:{self.port}', 'Connection: keep-alive']
+        if self.cookies:
+            headers.append('Cookie: ' + '; '.join(f'{k}={v}' for k, v in self.cookies.items()))
+        if form is not None:
+            headers.append('Content-Type: application/x-www-form-urlencoded')
+        headers.append(f'Content-Length: {len(body)}')
+        self.writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode() + body)
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError('connection closed')
+        status = int(status_line.split()[1])
+        response_headers = {}
+        while True:
+            line = (await self.reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            name, value = name.strip().lower(), value.strip()
+            if name == 'set-cookie':
+                cookie_name, _, rest = value.partition('=')
+                self.cookies[cookie_name] = rest.split(';', 1)[0]
+            else:
+                response_headers[name] = value
+
+        if method == 'HEAD' or status in (204, 304):
+            data = b''
+        elif response_headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await self.reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    await self.reader.readline()
+                    break
+                chunks.append(await self.reader.readexactly(size))
+                await self.reader.readline()
+            data = b''.join(chunks)
+        elif 'content-length' in response_headers:
+            data = await self.reader.readexactly(int(response_headers['content-length']))
+        else:
+            data = await self.reader.read()
+            response_headers['connection'] = 'close'
+
+        if response_headers.get('connection', '').lower() == 'close':
+            await self.close()
+        return status, response_headers, data
+
+class Stats:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.lock_timeouts = defaultdict(int)
+        self.timeouts = defaultdict(int)
+        self.workflows = defaultdict(int)
+
+    def summary(self, elapsed):
+        endpoints = {}
+        total = errors = locks = timeouts = 0
+        for name in sorted(set(self.latencies) | set(self.errors) | set(self.timeouts)):
+            values = sorted(self.latencies[name])
+            count = len(values) + self.timeouts[name]
+            endpoints[name] = {
+                'count': count,
+                'rps': round(count / elapsed, 2),
+                'errors': self.errors[name],
+                'error_rate': round(self.errors[name] / count, 4) if count else 0,
+                'lock_timeouts': self.lock_timeouts[name],
+                'timeouts': self.timeouts[name],
+                'mean_ms': round(sum(values) / len(values) * 1000, 1) if values else None,
+                'p50_ms': percentile(values, 50),
+                'p95_ms': percentile(values, 95),
+                'p99_ms': percentile(values, 99),
+                'max_ms': round(values[-1] * 1000, 1) if values else None,
+            }
+            total += count
+            errors += self.errors[name]
+            locks += self.lock_timeouts[name]
+            timeouts += self.timeouts[name]
+        return {
+            'elapsed_s': round(elapsed, 2),
+            'requests': total,
+            'rps': round(total / elapsed, 2) if elapsed else 0,
+            'error_rate': round(errors / total, 4) if total else 0,
+            'lock_timeout_rate': round(locks / total, 4) if total else 0,
+            'timeout_rate': round(timeouts / total, 4) if total else 0,
+            'workflows': dict(self.workflows),
+            'endpoints': endpoints,
+        }
+
+def percentile(values, p):
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return round(values[index] * 1000, 1)
+
+class VirtualUser:
+    def __init__(self, role, client, stats, subscriber_ids):
+        self.role = role
+        self.client = client
+        self.stats = stats
+        self.subscriber_ids = subscriber_ids
+
+    async def call(self, name, method, path, form=None, expect=(200,)):
+        started = time.perf_counter()
+        try:
+            status, headers, body = await self.client.request(method, path, form)
+        except asyncio.TimeoutError:
+            self.stats.timeouts[name] += 1
+            self.stats.errors[name] += 1
+            return None, b''
+        except HTTPError:
+            self.stats.latencies[name].append(time.perf_counter() - started)
+            self.stats.errors[name] += 1
+            return None, b''
+        self.stats.latencies[name].append(time.perf_counter() - started)
+        if status not in expect:
+            self.stats.errors[name] += 1
+            # The app answers 503 with X-Lock-Timeout when a database lock wait timed out
+            if status == 503 and 'x-lock-timeout' in headers:
+                self.stats.lock_timeouts[name] += 1
+        return status, body
+
+    async def login(self, username, password):
+        status, _ = await self.call('POST /auth/login', 'POST', '/auth/login',
+                                    {'username': username, 'password': password}, expect=(302,))
+        return status == 302
+
+    # Workflows
+
+    async def search_subscriber(self):
+        term = str(random.randint(10, 99))
+        await self.call('GET /subscribers/?search', 'GET', '/subscribers/?' + urlencode({'search': term, 'type': 'phone'}))
+
+    async def order_modal(self):
+        # Open the orders page, then type a subscriber id digit by digit
+        await self.call('GET /orders/', 'GET', '/orders/')
+        typed = ''
+        for digit in str(random.choice(self.subscriber_ids)):
+            typed += digit
+            await self.call('GET /subscribers/<id>/json', 'GET', f'/subscribers/{typed}/json', expect=(200, 404))
+            await asyncio.sleep(random.uniform(0.05, 0.2))
+
+    async def create_order(self):
+        form = {'subscriber_id': random.choice(self.subscriber_ids)}
+        if random.random() < 0.3:
+            form.update({'gap_bilen': random.randint(0, 2), 'dine_suw': random.randint(1, 5)})
+        else:
+            form.update({'new_bottles': random.randint(0, 2), 'exchange_bottles': random.randint(0, 3),
+                         'water_only': random.randint(0, 5), 'free_bottles': 0})
+        await self.call('POST /orders/create', 'POST', '/orders/create', form, expect=(302,))
+
+    async def post_payment(self):
+        form = {'subscriber_id': random.choice(self.subscriber_ids), 'amount': random.randint(5, 100)}
+        await self.call('POST /orders/payment', 'POST', '/orders/payment', form, expect=(302,))
+
+    async def browse_logs(self):
+        # Page through the audit log as long as there is a next page link
+        page = 1
+        while page <= 3:
+            _, body = await self.call('GET /admin/logs', 'GET', f'/admin/logs?page={page}')
+            page += 1
+            if f'page={page}'.encode() not in body:
+                break
+            await asyncio.sleep(random.uniform(0.1, 0.3))
+
+# role -> [(workflow, weight)]
+WORKFLOWS = {
+    'operator': [('search_subscriber', 4), ('order_modal', 3), ('create_order', 3)],
+    'accountant': [('search_subscriber', 2), ('post_payment', 3), ('create_order', 1)],
+    'admin': [('browse_logs', 2), ('search_subscriber', 1), ('order_modal', 1)],
+}
+
+async def discover_subscribers(args):
+    client = Client(args.base_url, args.timeout)
+    user = VirtualUser('admin', client, Stats(), [])
+    if not await user.login(*DEFAULT_USERS['admin']):
+        raise SystemExit('Admin login failed, is the server running and seeded?')
+    _, _, body = await client.request('GET', '/subscribers/list.json?limit=500')
+    await client.close()
+    ids = sorted(json.loads(body)['columns']['id']) if body else []
+    if not ids:
+        raise SystemExit('No subscribers found')
+    return ids
+
+async def run_user(index, args, stats, subscriber_ids, deadline):
+    role = args.roles[index % len(args.roles)]
+    client = Client(args.base_url, args.timeout)
+    user = VirtualUser(role, client, stats, subscriber_ids)
+    try:
+        if not await user.login(*DEFAULT_USERS[role]):
+            return
+        names, weights = zip(*WORKFLOWS[role])
+        while time.monotonic() < deadline:
+            workflow = random.choices(names, weights)[0]
+            stats.workflows[workflow] += 1
+            await getattr(user, workflow)()
+            if args.think_time:
+                await asyncio.sleep(random.uniform(0, args.think_time))
+    finally:
+        await client.close()
+
+async def main(args):
+    subscriber_ids = await discover_subscribers(args)
+    print(f"\n🚀 {args.concurrency} users ({', '.join(args.roles)}) for {args.duration}s "
+          f"against {args.base_url}, {len(subscriber_ids)} subscribers")
+
+    stats = Stats()
+    started = time.monotonic()
+    deadline = started + args.duration
+    await asyncio.gather(*(run_user(i, args, stats, subscriber_ids, deadline) for i in range(args.concurrency)))
+    summary = stats.summary(time.monotonic() - started)
+    summary['config'] = {k: getattr(args, k) for k in ('base_url', 'concurrency', 'duration', 'roles', 'think_time')}
+
+    print("\n" + "=" * 100)
+    print(f"{'Endpoint':40} {'count':>7} {'rps':>7} {'err%':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}")
+    print("=" * 100)
+    for name, e in summary['endpoints'].items():
+        print(f"{name:40} {e['count']:>7} {e['rps']:>7} {e['error_rate'] * 100:>6.2f} "
+              f"{e['p50_ms'] or '-':>8} {e['p95_ms'] or '-':>8} {e['p99_ms'] or '-':>8} {e['max_ms'] or '-':>8}")
+    print("=" * 100)
+    print(f"📊 {summary['requests']} requests, {summary['rps']} req/s, "
+          f"errors {summary['error_rate'] * 100:.2f}%, lock timeouts {summary['lock_timeout_rate'] * 100:.2f}%, "
+          f"client timeouts {summary['timeout_rate'] * 100:.2f}%")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2, ensure_ascii=False)
+        print(f"💾 Summary written to {args.output}")
+    return summary
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Suw CRM load test')
+    parser.add_argument('--base-url', default='http://localhost:5000')
+    parser.add_argument('--concurrency', type=int, default=10, help='virtual users')
+    parser.add_argument('--duration', type=float, default=30, help='seconds')
+    parser.add_argument('--roles', default='operator,operator,accountant,admin',
+                        help='roles assigned to users round-robin')
+    parser.add_argument('--think-time', type=float, default=0.0, help='max random pause between workflows (s)')
+    parser.add_argument('--timeout', type=float, default=30, help='per-request timeout (s)')
+    parser.add_argument('--output', help='write JSON summary here')
+    args = parser.parse_args()
+    args.roles = [r.strip() for r in args.roles.split(',') if r.strip()]
+    unknown = set(args.roles) - set(WORKFLOWS)
+    if unknown:
+        sys.exit(f"Unknown roles: {', '.join(sorted(unknown))}")
+    asyncio.run(main(args))
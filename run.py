@@ -1,8 +1,16 @@
-from app import create_app, db
+import os
+from app import create_app
+from app.metrics import start_metrics
+from app.scheduler import start_scheduler
+from app.schema import upgrade_schema
 
 app = create_app()
 
 if __name__ == '__main__':
     with app.app_context():
-        db.create_all()
+        upgrade_schema()
+    # The reloader runs the app in a child process, start there only
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_metrics(app)
+        start_scheduler(app)
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -3,11 +3,12 @@ from decimal import Decimal
 from datetime import datetime, timedelta
 from app import create_app, db
 from app.models import User, Price, Subscriber, Phone, Order, Payment
+from app.schema import upgrade_schema
 
 def seed():
     app = create_app()
     with app.app_context():
-        db.create_all()
+        upgrade_schema()
         
         # Create admin user
         if not User.query.filter_by(username='admin').first():
@@ -0,0 +1,46 @@
+"""
+Production server: pre-forked workers on a shared socket.
+Run: python serve.py --workers 4 --threads 8 --port 5000
+
+Unlike run.py this does not reload on changes and does not create tables,
+set up the database with seed.py (or run.py once) beforehand.
+Send SIGHUP to the master for a graceful restart. With --warmup each worker
+compiles the templates and opens its database connections before it
+takes requests (see app/warmup.py).
+"""
+import argparse
+import os
+from app.server import ServerOptions, serve
+
+def main():
+    parser = argparse.ArgumentParser(description='Sarwan production server')
+    parser.add_argument('--host', default=os.environ.get('HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 5000)))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('WEB_CONCURRENCY', os.cpu_count() or 2)),
+                        help='worker processes (default: CPU count)')
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('WEB_THREADS', 8)),
+                        help='request threads per worker')
+    parser.add_argument('--timeout', type=int, default=120,
+                        help='recycle a worker when a request runs longer than this (seconds, 0 = off)')
+    parser.add_argument('--graceful-timeout', type=int, default=30)
+    parser.add_argument('--keepalive', type=int, default=5, help='client socket timeout (seconds)')
+    parser.add_argument('--access-log', default='-', help="'-' for stderr, a file path, or '' to disable")
+    parser.add_argument('--warmup', action='store_true',
+                        default=os.environ.get('WARMUP', '').lower() in ('1', 'true', 'yes'),
+                        help='compile templates and open database connections before a worker accepts requests')
+    args = parser.parse_args()
+
+    serve(ServerOptions(
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        threads=args.threads,
+        timeout=args.timeout,
+        graceful_timeout=args.graceful_timeout,
+        keepalive=args.keepalive,
+        access_log=args.access_log or None,
+        warmup=args.warmup
+    ))
+
+if __name__ == '__main__':
+    main()
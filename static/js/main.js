@@ -97,10 +97,14 @@ function confirmDelete(form, message) {
 }
 
 // Edit user modal
-function editUser(id, username, role) {
+function editUser(id, username, role, depot) {
     document.getElementById('edit-user-id').value = id;
     document.getElementById('edit-username').value = username;
     document.getElementById('edit-role').value = role;
+    const depotSelect = document.getElementById('edit-depot');
+    if (depotSelect) {
+        depotSelect.value = depot;
+    }
     document.getElementById('edit-user-form').action = `/admin/users/${id}/edit`;
     openModal('edit-user-modal');
 }
@@ -112,3 +116,396 @@ function openPaymentModal(subscriberId, name, debt) {
     document.getElementById('payment-current-debt').textContent = debt + ' TMT';
     openModal('payment-modal');
 }
+
+// Offline queue: orders and payments entered without a connection are kept
+// in localStorage and sent to /orders/sync when the browser is back online.
+// Every item has a key, so resending a batch never creates duplicates.
+const SYNC_QUEUE_KEY = 'sarwan-sync-queue';
+const SYNC_FAILED_KEY = 'sarwan-sync-failed';
+let syncInProgress = false;
+
+function newClientKey() {
+    if (window.crypto && crypto.randomUUID) {
+        return crypto.randomUUID();
+    }
+    return Date.now().toString(36) + '-' + Math.random().toString(36).slice(2) + Math.random().toString(36).slice(2);
+}
+
+function readStoredList(name) {
+    try {
+        return JSON.parse(localStorage.getItem(name)) || [];
+    } catch (e) {
+        return [];
+    }
+}
+
+function writeStoredList(name, items) {
+    localStorage.setItem(name, JSON.stringify(items));
+}
+
+function showSyncStatus(message, isError) {
+    const box = document.getElementById('sync-status');
+    if (!box) {
+        return;
+    }
+    box.textContent = message;
+    box.className = 'alert ' + (isError ? 'alert-error' : 'alert-success');
+    box.style.display = message ? 'block' : 'none';
+}
+
+function updateSyncStatus() {
+    const pending = readStoredList(SYNC_QUEUE_KEY).length;
+    const failed = readStoredList(SYNC_FAILED_KEY).length;
+    if (failed) {
+        showSyncStatus(failed + ' ýazgy kabul edilmedi, administratora ýüz tutuň', true);
+    } else if (pending) {
+        showSyncStatus(pending + ' ýazgy internet gelende iberiler', false);
+    } else {
+        showSyncStatus('', false);
+    }
+}
+
+function queueSyncItem(item) {
+    const queue = readStoredList(SYNC_QUEUE_KEY);
+    queue.push(item);
+    writeStoredList(SYNC_QUEUE_KEY, queue);
+    updateSyncStatus();
+}
+
+function formToSyncItem(form) {
+    const item = { type: form.dataset.sync, captured_at: Date.now() };
+    new FormData(form).forEach(function (value, name) {
+        item[name === 'client_key' ? 'key' : name] = value;
+    });
+    item.key = item.key || newClientKey();
+    return item;
+}
+
+function flushSyncQueue() {
+    const queue = readStoredList(SYNC_QUEUE_KEY);
+    if (syncInProgress || !queue.length || !navigator.onLine) {
+        return;
+    }
+    syncInProgress = true;
+    const batch = queue.slice(0, 500);
+
+    fetch('/orders/sync', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ items: batch })
+    })
+        .then(function (response) {
+            if (!response.ok) {
+                throw new Error('Sync failed: ' + response.status);
+            }
+            return response.json();
+        })
+        .then(function (data) {
+            const done = {};
+            const failed = readStoredList(SYNC_FAILED_KEY);
+            data.results.forEach(function (result, i) {
+                done[batch[i].key] = true;
+                if (result.status === 'error') {
+                    failed.push(Object.assign({}, batch[i], { error: result.error }));
+                }
+            });
+            writeStoredList(SYNC_FAILED_KEY, failed);
+            // Items queued while the request was running stay in the queue
+            writeStoredList(SYNC_QUEUE_KEY, readStoredList(SYNC_QUEUE_KEY).filter(function (item) {
+                return !done[item.key];
+            }));
+            syncInProgress = false;
+            updateSyncStatus();
+            if (data.created) {
+                window.location.reload();
+            } else {
+                flushSyncQueue();
+            }
+        })
+        .catch(function () {
+            // Network error or server down, keep everything for the next attempt
+            syncInProgress = false;
+            updateSyncStatus();
+        });
+}
+
+// Forms with data-sync get a key against double submits, and are queued instead of posted while offline
+document.addEventListener('submit', function (e) {
+    const form = e.target;
+    if (!form.dataset || !form.dataset.sync || e.defaultPrevented || navigator.onLine) {
+        return;
+    }
+    e.preventDefault();
+    queueSyncItem(formToSyncItem(form));
+    form.reset();
+    // reset() restores the used key, the next entry needs its own
+    const keyInput = form.querySelector('input[name="client_key"]');
+    if (keyInput) {
+        keyInput.value = newClientKey();
+    }
+    const modal = form.closest('.modal-overlay');
+    if (modal) {
+        modal.classList.remove('active');
+    }
+});
+
+document.addEventListener('DOMContentLoaded', function () {
+    document.querySelectorAll('form[data-sync] input[name="client_key"]').forEach(function (input) {
+        input.value = newClientKey();
+    });
+    updateSyncStatus();
+    flushSyncQueue();
+});
+
+window.addEventListener('online', flushSyncQueue);
+setInterval(flushSyncQueue, 30000);
+
+// Live feed: handlers maps event names (order, payment, debt, order_deleted,
+// subscriber_deleted) to functions that get the parsed event data.
+// EventSource reconnects by itself and resumes from the last event id.
+function startLiveFeed(handlers) {
+    if (!window.EventSource) {
+        return null;
+    }
+    const source = new EventSource('/live/events');
+    Object.keys(handlers).forEach(function (name) {
+        source.addEventListener(name, function (e) {
+            handlers[name](JSON.parse(e.data));
+        });
+    });
+    return source;
+}
+
+function formatAmount(value) {
+    // Same text as the |round(2) filter in the templates (12.0, 12.5)
+    const rounded = Math.round(Number(value) * 100) / 100;
+    return Number.isInteger(rounded) ? rounded.toFixed(1) : String(rounded);
+}
+
+function flashRow(row) {
+    row.classList.add('row-updated');
+    setTimeout(function () {
+        row.classList.remove('row-updated');
+    }, 2000);
+}
+
+// Virtualized tables: only the rows in view (and a margin around them) are in
+// the DOM, whatever the number of rows. Rows come from a list endpoint in
+// windows of `limit` rows as columns (see app/services/columnar.py) and are
+// fetched when they scroll into view. The page renders the first window
+// itself; it is kept until the table scrolls past it or is refreshed.
+function decodeColumns(data) {
+    const names = Object.keys(data.columns);
+    const rows = [];
+    for (let i = 0; i < data.count; i++) {
+        const row = {};
+        names.forEach(function (name) {
+            const value = data.columns[name][i];
+            const dictionary = data.dictionaries[name];
+            row[name] = dictionary ? dictionary[value] : value;
+        });
+        rows.push(row);
+    }
+    return rows;
+}
+
+function tableCell(row, content) {
+    const cell = document.createElement('td');
+    if (content instanceof Node) {
+        cell.appendChild(content);
+    } else {
+        cell.textContent = content;
+    }
+    row.appendChild(cell);
+    return cell;
+}
+
+function VirtualTable(options) {
+    this.scroller = options.scroller;     // the element that scrolls
+    this.body = options.body;             // its tbody
+    this.url = options.url;               // list endpoint, with the page's filters
+    this.renderRow = options.renderRow;   // row object -> <tr>
+    this.rowSelector = options.rowSelector;  // matches rendered rows, e.g. 'tr[data-order-id]'
+    this.columns = options.columns;
+    this.emptyText = options.emptyText || '';
+    this.limit = options.limit || 50;
+    this.total = options.total || 0;
+    this.overscan = 10;
+    this.maxWindows = 6;
+    this.windows = new Map();  // window number -> rows
+    this.stale = new Map();    // rows from before refresh(), shown until reloaded
+    this.loading = new Map();  // window number -> generation it was requested in
+    this.generation = 0;
+    this.range = null;
+    this.scheduled = false;
+
+    // Rows rendered by the server, with a spacer below them for the rest
+    this.initialRows = this.body.querySelectorAll(this.rowSelector).length;
+    this.rowHeight = this.measure() || 49;
+    if (this.total > this.initialRows) {
+        this.body.appendChild(this.spacer(this.total - this.initialRows));
+    }
+
+    const table = this;
+    this.scroller.addEventListener('scroll', function () {
+        table.schedule();
+    }, { passive: true });
+    window.addEventListener('resize', function () {
+        table.schedule(true);
+    });
+}
+
+VirtualTable.prototype.measure = function () {
+    const row = this.body.querySelector(this.rowSelector);
+    return row ? row.offsetHeight : 0;
+};
+
+VirtualTable.prototype.spacer = function (count) {
+    const row = document.createElement('tr');
+    row.className = 'virtual-spacer';
+    const cell = tableCell(row, '');
+    cell.colSpan = this.columns;
+    cell.style.height = (count * this.rowHeight) + 'px';
+    return row;
+};
+
+VirtualTable.prototype.placeholder = function () {
+    const row = document.createElement('tr');
+    row.className = 'virtual-placeholder';
+    row.style.height = this.rowHeight + 'px';
+    tableCell(row, '…').colSpan = this.columns;
+    return row;
+};
+
+VirtualTable.prototype.schedule = function (force) {
+    this.force = this.force || force;
+    if (this.scheduled) {
+        return;
+    }
+    this.scheduled = true;
+    const table = this;
+    window.requestAnimationFrame(function () {
+        table.scheduled = false;
+        const force = table.force;
+        table.force = false;
+        table.render(force);
+    });
+};
+
+VirtualTable.prototype.render = function (force) {
+    const top = this.scroller.scrollTop;
+    const first = Math.max(0, Math.floor(top / this.rowHeight) - this.overscan);
+    const last = Math.min(this.total, Math.ceil((top + this.scroller.clientHeight) / this.rowHeight) + this.overscan);
+    if (this.initialRows !== null) {
+        if (last <= this.initialRows) {
+            return;
+        }
+        this.initialRows = null;
+    }
+    if (!force && this.range && this.range[0] === first && this.range[1] === last) {
+        return;
+    }
+    this.range = [first, last];
+
+    const rows = document.createDocumentFragment();
+    if (first > 0) {
+        rows.appendChild(this.spacer(first));
+    }
+    for (let i = first; i < last; i++) {
+        const number = Math.floor(i / this.limit);
+        const window_ = this.windows.get(number) || this.stale.get(number);
+        if (!this.windows.has(number)) {
+            this.load(number);
+        }
+        const record = window_ && window_[i - number * this.limit];
+        rows.appendChild(record ? this.renderRow(record) : this.placeholder());
+    }
+    if (last < this.total) {
+        rows.appendChild(this.spacer(this.total - last));
+    }
+    if (!this.total) {
+        const empty = document.createElement('tr');
+        empty.className = 'empty-row';
+        const cell = tableCell(empty, this.emptyText);
+        cell.colSpan = this.columns;
+        cell.className = 'text-center';
+        rows.appendChild(empty);
+    }
+    this.body.replaceChildren(rows);
+
+    // Rows can be taller than measured on a narrow screen
+    const height = this.measure();
+    if (height && Math.abs(height - this.rowHeight) > 1) {
+        this.rowHeight = height;
+        this.schedule(true);
+    }
+    this.evict(Math.floor(first / this.limit));
+};
+
+VirtualTable.prototype.load = function (number) {
+    if (this.loading.has(number)) {
+        return;
+    }
+    const table = this;
+    const generation = this.generation;
+    this.loading.set(number, generation);
+    const separator = this.url.indexOf('?') === -1 ? '?' : '&';
+    fetch(this.url + separator + 'offset=' + (number * this.limit) + '&limit=' + this.limit)
+        .then(function (response) {
+            return response.ok ? response.json() : Promise.reject(response.status);
+        })
+        .then(function (data) {
+            if (table.loading.get(number) === generation) {
+                table.loading.delete(number);
+            }
+            if (generation !== table.generation) {
+                return;
+            }
+            table.total = data.total;
+            table.windows.set(number, decodeColumns(data));
+            table.stale.delete(number);
+            table.schedule(true);
+        })
+        .catch(function () {
+            if (table.loading.get(number) === generation) {
+                table.loading.delete(number);
+            }
+        });
+};
+
+VirtualTable.prototype.evict = function (current) {
+    const table = this;
+    [this.windows, this.stale].forEach(function (windows) {
+        windows.forEach(function (rows, number) {
+            if (Math.abs(number - current) > table.maxWindows / 2) {
+                windows.delete(number);
+            }
+        });
+    });
+};
+
+// Reload the rows in view (rows were added or removed)
+VirtualTable.prototype.refresh = function () {
+    const table = this;
+    this.generation++;
+    this.windows.forEach(function (rows, number) {
+        table.stale.set(number, rows);
+    });
+    this.windows.clear();
+    this.loading.clear();
+    this.initialRows = null;
+    this.schedule(true);
+};
+
+// Change a loaded row in place (the visible <tr> is updated by the caller)
+VirtualTable.prototype.update = function (id, changes) {
+    [this.windows, this.stale].forEach(function (windows) {
+        windows.forEach(function (rows) {
+            rows.forEach(function (row) {
+                if (row.id === id) {
+                    Object.assign(row, changes);
+                }
+            });
+        });
+    });
+};
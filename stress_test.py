@@ -0,0 +1,273 @@
+"""
+Concurrency stress test for debt and bottle-count correctness.
+
+Several workers (threads, or processes to get past the GIL and behave like
+separate server workers) create orders, delete their own orders and post
+payments for the same few subscribers at once, through the Flask test
+client against a fresh temporary SQLite database:
+
+    python stress_test.py --workers 1,2,4,8 --ops 100 --mode process --output stress.json
+
+Requests that fail with "database is locked" are retried with the same
+client_key, as a browser resubmit would be, and counted as lock retries.
+After each level every subscriber's stored debt must equal the ledger
+(orders minus payments) and the bottles on live orders must equal what
+the workers created minus what they deleted. The report has throughput,
+lock retries, errors and mismatches per worker count; the exit status is
+1 if any level is inconsistent.
+"""
+import argparse
+import contextlib
+import functools
+import io
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+USERS = {
+    'operator': ('operator', 'operator123'),
+    'accountant': ('accountant', 'acc123'),
+}
+
+# role -> [(operation, weight)]; only accountants may post payments
+OPERATIONS = {
+    'operator': [('create_order', 7), ('delete_order', 3)],
+    'accountant': [('create_order', 4), ('post_payment', 4), ('delete_order', 2)],
+}
+
+MAX_ATTEMPTS = 8
+
+def make_app(database_url):
+    """An app on database_url (Config reads DATABASE_URL at import, so both are set)"""
+    os.environ['DATABASE_URL'] = database_url
+    import config
+    config.Config.SQLALCHEMY_DATABASE_URI = database_url
+    from app import create_app
+    app = create_app()
+    # Errors reach the worker as exceptions, so a lock can be told apart from other failures
+    app.config['PROPAGATE_EXCEPTIONS'] = True
+    return app
+
+def prepare_database(directory, subscriber_count):
+    """Seed a fresh database, returns its URL and the ids of the contended subscribers"""
+    database_url = 'sqlite:///' + os.path.join(directory, 'stress.db')
+    os.environ['DATABASE_URL'] = database_url
+    import config
+    config.Config.SQLALCHEMY_DATABASE_URI = database_url
+    import seed
+    with contextlib.redirect_stdout(io.StringIO()):
+        seed.seed()
+    app = make_app(database_url)
+    from app import db
+    from app.models import Subscriber
+    from app.services.ledger import recalculate_debts
+    with app.app_context():
+        # The seed's debts are made up, start from the ledger
+        recalculate_debts()
+        db.session.commit()
+        ids = [id for (id,) in db.session.query(Subscriber.id).order_by(Subscriber.id).limit(subscriber_count)]
+        db.engine.dispose()
+    return database_url, ids
+
+class Worker:
+    def __init__(self, app, role, rng):
+        self.app = app
+        self.client = app.test_client()
+        self.role = role
+        self.rng = rng
+        self.created = []  # (order id, subscriber id, bottles) of live orders this worker made
+        self.bottles = Counter()
+        self.stats = Counter()
+
+    def post(self, path, form):
+        """POST, retrying while the database is locked; returns the response or None"""
+        from sqlalchemy.exc import OperationalError
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                return self.client.post(path, data=form)
+            except OperationalError as e:
+                if 'locked' not in str(e):
+                    self.stats['errors'] += 1
+                    return None
+                self.stats['lock_retries'] += 1
+                time.sleep(self.rng.uniform(0, 0.02 * 2 ** attempt))
+            except Exception:
+                self.stats['errors'] += 1
+                return None
+        self.stats['gave_up'] += 1
+        return None
+
+    def login(self):
+        username, password = USERS[self.role]
+        response = self.client.post('/auth/login', data={'username': username, 'password': password})
+        if response.status_code != 302:
+            raise SystemExit(f'{username} login failed, status {response.status_code}')
+
+    def create_order(self, subscriber_ids):
+        subscriber_id = self.rng.choice(subscriber_ids)
+        quantities = {'new_bottles': self.rng.randint(0, 2), 'exchange_bottles': self.rng.randint(0, 3),
+                      'water_only': self.rng.randint(0, 4), 'free_bottles': 0}
+        if not any(quantities.values()):
+            quantities['water_only'] = 1
+        form = dict(quantities, subscriber_id=subscriber_id, client_key=f'stress-{uuid.uuid4().hex}')
+        if self.rng.random() < 0.5:
+            form['paid_amount'] = self.rng.choice([0, 10, 50])
+        self.post('/orders/create', form)
+        # The order exists if any attempt committed it
+        from app import db
+        from app.models import Order
+        with self.app.app_context():
+            order_id = db.session.query(Order.id).filter(Order.client_key == form['client_key']).scalar()
+        if order_id is not None:
+            bottles = sum(quantities.values())
+            self.created.append((order_id, subscriber_id, bottles))
+            self.bottles[subscriber_id] += bottles
+            self.stats['orders'] += 1
+
+    def delete_order(self, subscriber_ids):
+        if not self.created:
+            return self.create_order(subscriber_ids)
+        order_id, subscriber_id, bottles = self.created.pop(self.rng.randrange(len(self.created)))
+        response = self.post(f'/orders/{order_id}/delete', {})
+        if response is not None and response.status_code == 302:
+            self.bottles[subscriber_id] -= bottles
+            self.stats['deletes'] += 1
+        else:
+            self.created.append((order_id, subscriber_id, bottles))
+
+    def post_payment(self, subscriber_ids):
+        form = {'subscriber_id': self.rng.choice(subscriber_ids), 'amount': self.rng.randint(5, 80),
+                'client_key': f'stress-{uuid.uuid4().hex}'}
+        response = self.post('/orders/payment', form)
+        if response is not None:
+            self.stats['payments'] += 1
+
+def run_worker(task, app=None):
+    """One worker's share of a level; returns its stats and per-subscriber bottle balance"""
+    index, database_url, subscriber_ids, ops, seed = task
+    app = app or make_app(database_url)
+    role = 'accountant' if index % 2 else 'operator'
+    worker = Worker(app, role, random.Random(seed * 1000 + index))
+    worker.login()
+    names, weights = zip(*OPERATIONS[role])
+    for _ in range(ops):
+        getattr(worker, worker.rng.choices(names, weights)[0])(subscriber_ids)
+    return dict(worker.stats), dict(worker.bottles)
+
+def live_bottles(db, Order):
+    total = Order.new_bottles + Order.exchange_bottles + Order.water_only + Order.free_bottles
+    return dict(db.session.query(Order.subscriber_id, db.func.coalesce(db.func.sum(total), 0))
+                .group_by(Order.subscriber_id).all())
+
+def check_consistency(database_url, expected_bottles):
+    """Subscribers whose debt differs from the ledger, and whose live bottles differ from the expected"""
+    app = make_app(database_url)
+    from app import db
+    from app.models import Subscriber, Order
+    from app.services.ledger import ledger_debt
+    with app.app_context():
+        debts = [(id, float(debt or 0), float(ledger))
+                 for id, debt, ledger in db.session.query(Subscriber.id, Subscriber.debt, ledger_debt())
+                 if round(float(debt or 0) - float(ledger), 2) != 0]
+        actual = live_bottles(db, Order)
+        bottles = [(id, expected, actual.get(id, 0)) for id, expected in sorted(expected_bottles.items())
+                   if actual.get(id, 0) != expected]
+        db.engine.dispose()
+    return debts, bottles
+
+def run_level(workers, args):
+    directory = tempfile.mkdtemp(prefix='stress-')
+    database_url, subscriber_ids = prepare_database(directory, args.subscribers)
+    app = make_app(database_url)
+    from app import db
+    from app.models import Order
+    with app.app_context():
+        expected = Counter(live_bottles(db, Order))
+        db.engine.dispose()
+
+    tasks = [(index, database_url, subscriber_ids, args.ops, args.seed) for index in range(workers)]
+    started = time.perf_counter()
+    if args.mode == 'process':
+        with multiprocessing.get_context('spawn').Pool(workers) as pool:
+            results = pool.map(run_worker, tasks)
+    else:
+        # Threads share one app, as in a threaded server
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(functools.partial(run_worker, app=app), tasks))
+    elapsed = time.perf_counter() - started
+
+    stats = Counter()
+    for worker_stats, bottles in results:
+        stats.update(worker_stats)
+        for subscriber_id, count in bottles.items():
+            expected[int(subscriber_id)] += count
+    debts, bottles = check_consistency(database_url, expected)
+    operations = workers * args.ops
+    return {
+        'workers': workers,
+        'operations': operations,
+        'elapsed_s': round(elapsed, 2),
+        'ops_per_s': round(operations / elapsed, 1),
+        'orders': stats['orders'],
+        'deletes': stats['deletes'],
+        'payments': stats['payments'],
+        'lock_retries': stats['lock_retries'],
+        'gave_up': stats['gave_up'],
+        'errors': stats['errors'],
+        'debt_mismatches': [{'subscriber_id': id, 'debt': debt, 'ledger': ledger} for id, debt, ledger in debts],
+        'bottle_mismatches': [{'subscriber_id': id, 'expected': e, 'actual': a} for id, e, a in bottles],
+        'database': database_url,
+    }
+
+def main(args):
+    print(f"\n🚀 {args.mode} workers {', '.join(map(str, args.workers))}, {args.ops} operations each, "
+          f"{args.subscribers} subscribers")
+    levels = [run_level(workers, args) for workers in args.workers]
+
+    print("\n" + "=" * 100)
+    print(f"{'workers':>7} {'ops':>7} {'secs':>7} {'ops/s':>7} {'orders':>7} {'deletes':>7} {'payments':>8} "
+          f"{'retries':>7} {'gave up':>7} {'errors':>6} {'debt ✗':>6} {'bottle ✗':>8}")
+    print("=" * 100)
+    for level in levels:
+        print(f"{level['workers']:>7} {level['operations']:>7} {level['elapsed_s']:>7} {level['ops_per_s']:>7} "
+              f"{level['orders']:>7} {level['deletes']:>7} {level['payments']:>8} {level['lock_retries']:>7} "
+              f"{level['gave_up']:>7} {level['errors']:>6} {len(level['debt_mismatches']):>6} "
+              f"{len(level['bottle_mismatches']):>8}")
+    print("=" * 100)
+
+    failed = [level for level in levels if level['debt_mismatches'] or level['bottle_mismatches']]
+    for level in failed:
+        for mismatch in level['debt_mismatches'][:5]:
+            print(f"❌ {level['workers']} workers: subscriber {mismatch['subscriber_id']} debt {mismatch['debt']} "
+                  f"!= ledger {mismatch['ledger']}")
+        for mismatch in level['bottle_mismatches'][:5]:
+            print(f"❌ {level['workers']} workers: subscriber {mismatch['subscriber_id']} has "
+                  f"{mismatch['actual']} bottles, expected {mismatch['expected']}")
+    if not failed:
+        print("✅ Debts match the ledger and bottle counts match at every level")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'config': {k: getattr(args, k) for k in ('mode', 'workers', 'ops', 'subscribers', 'seed')},
+                       'levels': levels}, f, indent=2, ensure_ascii=False)
+        print(f"💾 Summary written to {args.output}")
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Suw CRM concurrency stress test')
+    parser.add_argument('--workers', default='1,2,4,8', help='worker counts to run, one level each')
+    parser.add_argument('--mode', choices=['thread', 'process'], default='thread')
+    parser.add_argument('--ops', type=int, default=100, help='operations per worker')
+    parser.add_argument('--subscribers', type=int, default=3, help='subscribers the workers compete for')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write JSON summary here')
+    args = parser.parse_args()
+    args.workers = [int(w) for w in args.workers.split(',') if w.strip()]
+    sys.exit(main(args))
@@ -0,0 +1,32 @@
+"""
+Tests for merging duplicate subscribers (app/services/duplicates.py)
+Run: python -m pytest test_duplicates.py
+"""
+from app import db
+from app.models import Subscriber, Order, Payment
+from app.services.duplicates import merge_subscribers
+
+def test_merge_moves_soft_deleted_orders(app, client):
+    with app.app_context():
+        keep, drop = [id for (id,) in db.session.query(Subscriber.id).order_by(Subscriber.id).limit(2)]
+        order = Order(subscriber_id=drop, user_id=1, water_only=1, total_amount=15, paid_amount=15)
+        payment = Payment(subscriber_id=drop, user_id=1, amount=10)
+        db.session.add_all([order, payment])
+        db.session.commit()
+        order_id, payment_id = order.id, payment.id
+    assert client.post(f'/orders/{order_id}/delete').status_code == 302
+
+    with app.test_request_context():
+        merge_subscribers({keep: [drop]})
+        db.session.commit()
+        deleted = db.session.get(Order, order_id, execution_options={'include_deleted': True})
+        assert deleted.subscriber_id == keep
+        assert deleted.deleted_at is not None
+        assert db.session.get(Payment, payment_id).subscriber_id == keep
+
+        subscriber_ids = db.select(Subscriber.id)
+        for model in (Order, Payment):
+            orphans = db.session.execute(db.select(db.func.count(model.id))
+                                         .where(model.subscriber_id.not_in(subscriber_ids)),
+                                         execution_options={'include_deleted': True}).scalar()
+            assert orphans == 0
@@ -0,0 +1,45 @@
+"""
+Tests for the subscriber import (app/services/importer.py)
+Run: python -m pytest test_importer.py
+"""
+import pytest
+from app import db
+from app.models import Phone, Subscriber
+from app.services.importer import import_subscribers
+
+ROWS = [
+    ['Salgy', 'Telefon', 'Görnüşi'],
+    ['Täze köçe, jaý 1', '+99365100001', 'magazin'],
+    ['Täze köçe, jaý 2', '+99365100002, +99312100002', ''],
+    ['Täze köçe, jaý 3', '+99365100003', 'fiziki'],
+]
+
+def imported(app):
+    with app.app_context():
+        report = import_subscribers(ROWS)
+        db.session.commit()
+        phones = {}
+        for address, number in db.session.query(Subscriber.address, Phone.number).join(Phone) \
+                .filter(Subscriber.address.like('Täze köçe%')):
+            phones.setdefault(address, set()).add(number)
+        types = dict(db.session.query(Subscriber.address, Subscriber.client_type)
+                     .filter(Subscriber.address.like('Täze köçe%')))
+    return report, phones, types
+
+@pytest.mark.parametrize('returning', [True, False], ids=['returning', 'row-by-row'])
+def test_phones_go_to_their_subscriber(app, monkeypatch, returning):
+    if not returning:
+        # As on MySQL, which has no RETURNING for executemany
+        with app.app_context():
+            monkeypatch.setattr(db.engine.dialect, 'insert_executemany_returning', False)
+            monkeypatch.setattr(db.engine.dialect, 'insert_executemany_returning_sort_by_parameter_order', False)
+    report, phones, types = imported(app)
+
+    assert (report['imported'], report['phones']) == (3, 4)
+    assert phones == {
+        'Täze köçe, jaý 1': {'+99365100001'},
+        'Täze köçe, jaý 2': {'+99365100002', '+99312100002'},
+        'Täze köçe, jaý 3': {'+99365100003'},
+    }
+    assert types == {'Täze köçe, jaý 1': 'legal', 'Täze köçe, jaý 2': 'individual',
+                     'Täze köçe, jaý 3': 'individual'}
@@ -224,9 +224,8 @@ Features verified:
 • API endpoints
 
 Recommendations for production:
-1. Use gunicorn instead of Flask dev server:
-   pip install gunicorn
-   gunicorn -w 4 -b 0.0.0.0:5000 'app:create_app()'
+1. Use serve.py instead of Flask dev server:
+   python serve.py --workers 4 --threads 8 --port 5000
 
 2. Set DEBUG=False in config.py
 
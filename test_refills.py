@@ -0,0 +1,58 @@
+"""
+Tests for the refill forecast (app/services/refills.py)
+Run: python -m pytest test_refills.py
+"""
+from array import array
+from datetime import datetime
+import pytest
+from app.services import refills
+
+def history(orders):
+    """Array columns as load_order_history returns them, from (subscriber id, date, bottles)"""
+    ids, days, quantities = array('q'), array('d'), array('d')
+    for subscriber_id, created_at, bottles in sorted(orders):
+        ids.append(subscriber_id)
+        days.append(refills._to_day(created_at))
+        quantities.append(bottles)
+    return ids, days, quantities
+
+ORDERS = [
+    # Regular: 2 bottles every 5 days
+    (1, datetime(2026, 3, 1, 9), 2), (1, datetime(2026, 3, 6, 9), 2), (1, datetime(2026, 3, 11, 9), 2),
+    # Irregular amounts and times
+    (2, datetime(2026, 3, 2, 8, 30), 1), (2, datetime(2026, 3, 9, 17), 3), (2, datetime(2026, 3, 12, 12), 2),
+    (2, datetime(2026, 3, 20, 10), 4),
+    # One order only: no forecast
+    (3, datetime(2026, 3, 5, 10), 5),
+    # All orders within a day: no forecast
+    (4, datetime(2026, 3, 5, 10), 1), (4, datetime(2026, 3, 5, 18), 1),
+    # Nothing consumed before the last order: no forecast
+    (5, datetime(2026, 3, 1, 10), 0), (5, datetime(2026, 3, 8, 10), 3),
+    # Slow consumption, due date capped at MAX_DAYS_LEFT
+    (6, datetime(2025, 1, 1, 10), 1), (6, datetime(2026, 1, 1, 10), 20),
+    # Fast consumption, due date at least MIN_DAYS_LEFT away
+    (7, datetime(2026, 3, 1, 10), 30), (7, datetime(2026, 3, 3, 10), 1),
+]
+
+def test_numpy_and_python_forecasts_match():
+    ids, days, quantities = history(ORDERS)
+    expected = refills._forecast_python(ids, days, quantities)
+    result = refills._forecast_numpy(ids, days, quantities)
+
+    assert [row[0] for row in expected] == [1, 2, 6, 7]
+    assert [row[0] for row in result] == [row[0] for row in expected]
+    for got, want in zip(result, expected):
+        assert got == pytest.approx(want)
+
+def test_forecast_values():
+    ids, days, quantities = history(ORDERS)
+    forecasts = {row[0]: row for row in refills.forecast_refills(ids, days, quantities)}
+
+    subscriber_id, orders, interval, rate, last_day, last_bottles, due_day = forecasts[1]
+    assert (orders, interval, rate, last_bottles) == (3, pytest.approx(5), pytest.approx(0.4), 2)
+    assert due_day == pytest.approx(refills._to_day(datetime(2026, 3, 16, 9)))
+    assert forecasts[6][6] - forecasts[6][4] == pytest.approx(refills.MAX_DAYS_LEFT)
+    assert forecasts[7][6] - forecasts[7][4] == pytest.approx(refills.MIN_DAYS_LEFT)
+
+def test_empty_history():
+    assert refills.forecast_refills(array('q'), array('d'), array('d')) == []
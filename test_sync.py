@@ -0,0 +1,33 @@
+"""
+Tests for the offline sync endpoint (/orders/sync)
+Run: python -m pytest test_sync.py
+"""
+
+def sync(client, items):
+    response = client.post('/orders/sync', json={'items': items})
+    assert response.status_code == 200, response.data
+    return {result['key']: result for result in response.get_json()['results']}
+
+def test_resend_after_order_deleted(client):
+    items = [{'key': 'dev1-order-1', 'type': 'order', 'subscriber_id': client.subscriber_id, 'new_bottles': 2}]
+    order_id = sync(client, items)['dev1-order-1']['id']
+    assert client.post(f'/orders/{order_id}/delete').status_code == 302
+
+    for _ in range(2):
+        result = sync(client, items)['dev1-order-1']
+        assert result['status'] == 'duplicate'
+        assert result['id'] == order_id
+
+def test_resend_after_subscriber_deleted(client):
+    items = [
+        {'key': 'dev1-order-2', 'type': 'order', 'subscriber_id': client.subscriber_id, 'water_only': 1},
+        {'key': 'dev1-payment-1', 'type': 'payment', 'subscriber_id': client.subscriber_id, 'amount': '20'},
+    ]
+    first = sync(client, items)
+    assert [first[key]['status'] for key in ('dev1-order-2', 'dev1-payment-1')] == ['created', 'created']
+    assert client.post(f'/subscribers/{client.subscriber_id}/delete').status_code == 302
+
+    again = sync(client, items)
+    for key in ('dev1-order-2', 'dev1-payment-1'):
+        assert again[key]['status'] == 'duplicate'
+        assert again[key]['id'] == first[key]['id']